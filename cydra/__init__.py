@@ -25,6 +25,7 @@ try:
 except DistributionNotFound:
     __version__ = '0.1.0'
 
+import copy
 import logging
 logger = logging.getLogger(__name__)
 
@@ -70,6 +71,10 @@ class Cydra(Component, ComponentManager):
 
         ComponentManager.__init__(self)
 
+        # configuration given to the constructor. Other processes create
+        # an equivalent instance from it
+        self.initial_config = copy.deepcopy(config)
+
         load_components(self, 'cydra.config')
 
         self.config = Configuration(self)
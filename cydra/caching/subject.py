@@ -17,8 +17,20 @@
 # You should have received a copy of the GNU General Public License
 # along with Cydra.  If not, see http://www.gnu.org/licenses
 
+import os.path
+import time
+import threading
+import Queue
+import sqlite3
+import json
+
 from cydra.component import Interface, Component, implements
+from cydra.error import InsufficientConfiguration
 from cydra.util import SimpleCache
+from cydra.permission import Subject
+
+import logging
+logger = logging.getLogger(__name__)
 
 
 class ISubjectCache(Interface):
@@ -44,9 +56,87 @@ class ISubjectCache(Interface):
         pass
 
 
+class SubjectRefresher(object):
+    """Worker refreshing cached subjects in the background
+
+    Refreshes are de-duplicated and performed at most rate times per second
+    to protect the user directory. Requests exceeding the queue size are dropped,
+    the entry will then simply expire."""
+
+    def __init__(self, compmgr, rate=1, queue_size=100):
+        self.compmgr = compmgr
+        self.interval = 1.0 / rate
+        self.queue = Queue.Queue(queue_size)
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.worker = None
+
+    def schedule(self, kind, subjectid):
+        """Schedule a refresh of a 'user' or 'group'"""
+        with self.lock:
+            if (kind, subjectid) in self.pending:
+                return
+
+            try:
+                self.queue.put_nowait((kind, subjectid))
+            except Queue.Full:
+                logger.debug("Refresh queue full, dropping refresh of %s %s", kind, subjectid)
+                return
+
+            self.pending.add((kind, subjectid))
+
+            # the worker is started lazily, this also covers forked processes
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.run, name='SubjectRefresher')
+                self.worker.daemon = True
+                self.worker.start()
+
+    def refresh(self, kind, subjectid):
+        # update all cache levels, not just the one that scheduled the refresh
+        if kind == 'user':
+            user = self.compmgr.translator.userid_to_user(subjectid)
+            if user is not None:
+                for cache in self.compmgr.subject_cache:
+                    cache.add_users([user])
+        elif kind == 'group':
+            group = self.compmgr.translator.groupid_to_group(subjectid)
+            if group is not None:
+                for cache in self.compmgr.subject_cache:
+                    cache.add_groups([group])
+
+    def run(self):
+        while True:
+            kind, subjectid = self.queue.get()
+            started = time.time()
+
+            try:
+                self.refresh(kind, subjectid)
+            except Exception:
+                logger.exception("Refreshing %s %s failed", kind, subjectid)
+            finally:
+                with self.lock:
+                    self.pending.discard((kind, subjectid))
+
+            wait = self.interval - (time.time() - started)
+            if wait > 0:
+                time.sleep(wait)
+
+
 class MemorySubjectCache(Component):
     """Caches subjects in memory
-    """
+
+    This is meant to be the first level of caching. If a second level
+    like :class:`SQLiteSubjectCache` is enabled, make sure this cache comes
+    first in the ISubjectCache extension point order.
+
+    Configuration:
+    - user_ttl, group_ttl: Lifetime of cached users resp. groups in seconds
+    - user_size, group_size: Maximum number of cached users resp. groups
+    - refresh_ahead: Fraction of the lifetime after which an accessed entry is
+      refreshed in the background while the cached value is still served.
+      Disabled by default, 0.8 is a reasonable value
+    - refresh_rate: Maximum number of background refreshes per second. Defaults to 1
+    - refresh_queue_size: Maximum number of pending refreshes. Defaults to 100"""
 
     implements(ISubjectCache)
 
@@ -57,6 +147,15 @@ class MemorySubjectCache(Component):
         userttl = config.get('user_ttl', 5 * 60)
         usersize = config.get('user_size', 500)
 
+        self.refresher = None
+        refresh_ahead = config.get('refresh_ahead')
+        if refresh_ahead is not None:
+            self.refresh_user_after = userttl * refresh_ahead
+            self.refresh_group_after = groupttl * refresh_ahead
+            self.refresher = SubjectRefresher(self.compmgr,
+                                              rate=config.get('refresh_rate', 1),
+                                              queue_size=config.get('refresh_queue_size', 100))
+
         self.groupcache = SimpleCache(
             lifetime=groupttl,
             killtime=groupttl,
@@ -64,15 +163,32 @@ class MemorySubjectCache(Component):
         self.usercache = SimpleCache(
             lifetime=userttl,
             killtime=userttl,
-            maxsize=usersize)
+            maxsize=usersize,
+            on_remove=self._user_removed)
         self.usernamemap = {}
 
+        # the refresher updates the caches from its own thread, SimpleCache
+        # and the username map must not be modified concurrently
+        self.lock = threading.Lock()
+
+    def _user_removed(self, userid, user):
+        # keep the username map in sync with the user cache. Called with the lock held
+        if self.usernamemap.get(user.username) == userid:
+            self.usernamemap.pop(user.username, None)
+
     def get_user(self, userid):
-        return self.usercache.get(userid)
+        with self.lock:
+            user = self.usercache.get(userid)
+
+        if user is not None and self.refresher is not None and self.usercache.age(userid) > self.refresh_user_after:
+            self.refresher.schedule('user', userid)
+
+        return user
 
     def get_user_by_name(self, username):
-        if username in self.usernamemap:
-            return self.get_user(self.usernamemap[username])
+        userid = self.usernamemap.get(username)
+        if userid is not None:
+            return self.get_user(userid)
 
     def get_users(self, userids):
         res = {}
@@ -81,12 +197,19 @@ class MemorySubjectCache(Component):
         return res
 
     def add_users(self, users):
-        for user in users:
-            self.usercache.set(user.userid, user)
-            self.usernamemap[user.username] = user.userid
+        with self.lock:
+            for user in users:
+                self.usercache.set(user.userid, user)
+                self.usernamemap[user.username] = user.userid
 
     def get_group(self, groupid):
-        return self.groupcache.get(groupid)
+        with self.lock:
+            group = self.groupcache.get(groupid)
+
+        if group is not None and self.refresher is not None and self.groupcache.age(groupid) > self.refresh_group_after:
+            self.refresher.schedule('group', groupid)
+
+        return group
 
     def get_groups(self, groupids):
         res = {}
@@ -95,5 +218,116 @@ class MemorySubjectCache(Component):
         return res
 
     def add_groups(self, groups):
-        for group in groups:
-            self.groupcache.set(group.groupid, group)
+        with self.lock:
+            for group in groups:
+                self.groupcache.set(group.groupid, group)
+
+
+class SQLiteSubjectCache(Component):
+    """Caches subjects in a SQLite database shared by all processes on a host
+
+    This is meant to be used as second level behind :class:`MemorySubjectCache`.
+    Subjects are stored as JSON, see :meth:`cydra.permission.Subject.to_dict`.
+
+    Configuration:
+    - path: Path to the database file. Has to be writable by all Cydra processes
+    - user_ttl: Lifetime of cached users in seconds. Defaults to 5 minutes
+    - group_ttl: Lifetime of cached groups in seconds. Defaults to 14 days"""
+
+    implements(ISubjectCache)
+
+    #: Maximum number of ids used in a single query
+    batch_size = 500
+
+    def __init__(self):
+        config = self.get_component_config()
+
+        if 'path' not in config:
+            raise InsufficientConfiguration(missing='path', component=self.get_component_name())
+
+        self.path = os.path.abspath(config['path'])
+        self.user_ttl = config.get('user_ttl', 5 * 60)
+        self.group_ttl = config.get('group_ttl', 60 * 60 * 24 * 14)
+        self._local = threading.local()
+
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS users (userid TEXT PRIMARY KEY, username TEXT, data TEXT, created REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS users_username ON users (username)')
+            conn.execute('CREATE TABLE IF NOT EXISTS groups (groupid TEXT PRIMARY KEY, data TEXT, created REAL)')
+
+    def _connection(self):
+        # connections cannot be shared between threads
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.text_factory = str
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = conn
+        return conn
+
+    def _load(self, data):
+        # subjects are stored as plain attributes, the database must never
+        # be able to make us instantiate anything but a known subject
+        return Subject.from_dict(self.compmgr, json.loads(data))
+
+    def _dump(self, subject):
+        return json.dumps(subject.to_dict())
+
+    def _rows(self, subjects, row):
+        rows = []
+        for subject in subjects:
+            try:
+                rows.append(row(subject, self._dump(subject)))
+            except (TypeError, ValueError):
+                logger.exception("Unable to cache subject %s", subject.id)
+        return rows
+
+    def _get_many(self, table, keycolumn, ttl, keys):
+        res = dict((key, None) for key in keys)
+        keys = list(keys)
+        conn = self._connection()
+        mintime = time.time() - ttl
+
+        for i in range(0, len(keys), self.batch_size):
+            batch = keys[i:i + self.batch_size]
+            query = 'SELECT %s, data FROM %s WHERE created > ? AND %s IN (%s)' % (
+                keycolumn, table, keycolumn, ', '.join('?' * len(batch)))
+            for key, data in conn.execute(query, [mintime] + batch):
+                try:
+                    res[key] = self._load(data)
+                except Exception:
+                    logger.exception("Unable to load cached subject %s", key)
+
+        return res
+
+    def get_user(self, userid):
+        return self.get_users([userid])[userid]
+
+    def get_user_by_name(self, username):
+        row = self._connection().execute('SELECT userid, data FROM users WHERE created > ? AND username = ?',
+                                         (time.time() - self.user_ttl, username)).fetchone()
+        if row is not None:
+            return self._load(row[1])
+
+    def get_users(self, userids):
+        return self._get_many('users', 'userid', self.user_ttl, userids)
+
+    def add_users(self, users):
+        now = time.time()
+        with self._connection() as conn:
+            conn.executemany('INSERT OR REPLACE INTO users (userid, username, data, created) VALUES (?, ?, ?, ?)',
+                             self._rows(users, lambda user, data: (user.userid, user.username, data, now)))
+            conn.execute('DELETE FROM users WHERE created <= ?', (now - self.user_ttl,))
+
+    def get_group(self, groupid):
+        return self.get_groups([groupid])[groupid]
+
+    def get_groups(self, groupids):
+        return self._get_many('groups', 'groupid', self.group_ttl, groupids)
+
+    def add_groups(self, groups):
+        now = time.time()
+        with self._connection() as conn:
+            conn.executemany('INSERT OR REPLACE INTO groups (groupid, data, created) VALUES (?, ?, ?)',
+                             self._rows(groups, lambda group, data: (group.groupid, data, now)))
+            conn.execute('DELETE FROM groups WHERE created <= ?', (now - self.group_ttl,))
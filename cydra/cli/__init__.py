@@ -17,9 +17,12 @@
 # You should have received a copy of the GNU General Public License
 # along with Cydra.  If not, see http://www.gnu.org/licenses
 import sys
+import json
+from optparse import OptionParser
 from cydra import Cydra
 from cydra.cli.common import Command, ICliProjectCommandProvider
 from cydra.cli.project import ProjectCommand
+from cydra.cli.sync import sync_projects
 
 
 class RootCommand(Command):
@@ -28,19 +31,40 @@ class RootCommand(Command):
         return ProjectCommand(self.cydra)(args)
 
     def sync(self, args):
-        """Sync all projects"""
-        projects = self.cydra.get_project_names()
+        """Sync all projects
 
-        for projectname in projects:
-            project = self.cydra.get_project(projectname)
+        Syntax: sync [--jobs N] [--timeout SECONDS] [--checkpoint FILE] [--summary FILE]
 
-            if not project:
-                print "Unknown Project:", projectname
-            else:
-                if project.sync():
-                    print "Synced Project:", projectname
-                else:
-                    print "Synced FAILED:", projectname
+        --jobs: number of processes syncing projects, 0 for one per CPU. Defaults to 1
+        --timeout: seconds a single project may take. Defaults to no limit
+        --checkpoint: file recording synced projects. An interrupted sync
+                      resumes where it stopped if given the same file
+        --summary: write a JSON summary including all failures to this file, - for stdout"""
+        parser = OptionParser(usage="sync [options]")
+        parser.add_option('-j', '--jobs', type='int', default=1)
+        parser.add_option('-t', '--timeout', type='int', default=0)
+        parser.add_option('-c', '--checkpoint')
+        parser.add_option('-s', '--summary')
+        (options, args) = parser.parse_args(args)
+
+        def progress(count, total, result):
+            print "[%d/%d] %s: %s (%.1fs)" % (count, total, result['project'], result['status'], result['duration'])
+            sys.stdout.flush()
+
+        summary = sync_projects(self.cydra, self.cydra.get_project_names(), jobs=options.jobs,
+                                timeout=options.timeout, checkpoint=options.checkpoint, progress=progress)
+
+        print "Synced %d of %d projects in %.1fs, %d skipped, %d failed" % (
+              summary['synced'], summary['total'], summary['duration'], summary['skipped'], len(summary['failed']))
+        for result in summary['failed']:
+            print "Sync FAILED: %s (%s)" % (result['project'], result['status'])
+
+        if options.summary == '-':
+            json.dump(summary, sys.stdout, indent=2)
+            print
+        elif options.summary:
+            with open(options.summary, 'w') as f:
+                json.dump(summary, f, indent=2)
 
     def listcomponents(self, args):
         """List all known components"""
@@ -50,9 +74,10 @@ class RootCommand(Command):
 
 def main():
     import logging
-    from optparse import OptionParser
 
     parser = OptionParser()
+    # options following the command belong to the command
+    parser.disable_interspersed_args()
     parser.add_option('-v', '--verbose',
                       action='store_true', dest='verbose', default=False)
     (options, args) = parser.parse_args()
@@ -16,11 +16,14 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with Cydra.  If not, see http://www.gnu.org/licenses
+import sys
 import types
 from pprint import pprint
+from optparse import OptionParser
 
 from cydra.component import ExtensionPoint
 from cydra.cli.common import Command, ICliProjectCommandProvider
+from cydra.cli.sync import sync_repositories
 
 
 class ProjectCommand(Command):
@@ -73,15 +76,25 @@ class ProjectCommand(Command):
             print("Sync failed")
 
     def syncrepos(self, args):
-        """Sync all repositories in project"""
-        repos = []
-        for repotype in self.project.get_repository_types():
-            repos.extend(repotype.get_repositories(self.project))
+        """Sync all repositories in project
+
+        Syntax: syncrepos [--jobs N] [--timeout SECONDS]
+
+        --jobs: number of processes syncing repositories, 0 for one per CPU. Defaults to 1
+        --timeout: seconds a single repository may take. Defaults to no limit"""
+        parser = OptionParser(usage="syncrepos [options]")
+        parser.add_option('-j', '--jobs', type='int', default=1)
+        parser.add_option('-t', '--timeout', type='int', default=0)
+        (options, args) = parser.parse_args(args)
 
-        for repo in repos:
-            print("Syncing: %s (%s)" % (repo.name, repo.type))
+        def progress(count, total, result):
+            print("[%d/%d] %s: %s (%.1fs)" % (count, total, result['repository'], result['status'], result['duration']))
+            sys.stdout.flush()
 
-            repo.sync()
+        summary = sync_repositories(self.cydra, self.project, jobs=options.jobs,
+                                    timeout=options.timeout, progress=progress)
+        for result in summary['failed']:
+            print("Sync FAILED: %s (%s)" % (result['repository'], result['status']))
 
     def createrepo(self, args):
         """Create a new repository
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of Cydra.
+#
+# Cydra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cydra is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cydra.  If not, see http://www.gnu.org/licenses
+import os
+import time
+import signal
+import traceback
+import multiprocessing
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class SyncTimeout(BaseException):
+    """A project took longer than allowed
+
+    Like KeyboardInterrupt, this does not derive from Exception. The alarm
+    goes off anywhere within a sync and must not be caught by the error
+    handling of the code being run"""
+
+
+def _on_alarm(signum, frame):
+    raise SyncTimeout()
+
+
+def _run_sync(result, timeout, sync):
+    """Run sync, which returns the status, and record status and duration in result"""
+    start = time.time()
+
+    if timeout:
+        previous_handler = signal.signal(signal.SIGALRM, _on_alarm)
+        signal.alarm(timeout)
+    try:
+        result['status'] = sync()
+    except SyncTimeout:
+        result['status'] = 'timeout'
+    except Exception:
+        logger.exception("Sync of %s failed", result.get('repository', result['project']))
+        result['status'] = 'error'
+        result['error'] = traceback.format_exc()
+    finally:
+        if timeout:
+            signal.alarm(0)
+            signal.signal(signal.SIGALRM, previous_handler)
+
+    result['duration'] = time.time() - start
+    return result
+
+
+def sync_project(cydra_instance, projectname, timeout=0):
+    """Sync a single project
+
+    The timeout is enforced with SIGALRM, so this has to run in the main
+    thread of a process.
+
+    :param timeout: seconds the sync may take, 0 for no limit
+    :returns: dict with project, status (ok, failed, unknown, timeout or error),
+              duration in seconds and error if an exception occured"""
+    def sync():
+        project = cydra_instance.get_project(projectname)
+        if project is None:
+            return 'unknown'
+        return 'ok' if project.sync() else 'failed'
+
+    return _run_sync({'project': projectname}, timeout, sync)
+
+
+def sync_repository(cydra_instance, projectname, repository_type, repository_name, timeout=0):
+    """Sync a single repository. Same as :func:`sync_project`
+
+    :returns: dict with project, repository (type/name), status, duration
+              and error if an exception occured"""
+    def sync():
+        project = cydra_instance.get_project(projectname)
+        repository = project.get_repository(repository_type, repository_name) if project is not None else None
+        if repository is None:
+            return 'unknown'
+        # None is not considered a failure
+        return 'failed' if repository.sync() == False else 'ok'
+
+    return _run_sync({'project': projectname, 'repository': repository_type + '/' + repository_name},
+                     timeout, sync)
+
+
+# Cydra instance of pool workers
+_worker_cydra = None
+
+
+def _init_worker(config):
+    global _worker_cydra
+
+    # Ctrl-C is handled by the parent, which terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # the instance of the parent is not fork-safe (datasource connections,
+    # caches and locks), every worker creates its own
+    from cydra import Cydra
+    _worker_cydra = Cydra(config)
+
+
+def _sync_in_worker(args):
+    func, args = args
+    return func(_worker_cydra, *args)
+
+
+def _run_all(cydra_instance, func, arglist, jobs):
+    """Call func with the Cydra instance and each of arglist, in parallel if jobs is larger than 1
+
+    :returns: iterator over the results in order of completion and the pool
+              running them or None"""
+    if not jobs:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, len(arglist))
+
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, _init_worker, (cydra_instance.initial_config,))
+        return pool.imap_unordered(_sync_in_worker, [(func, args) for args in arglist]), pool
+    return (func(cydra_instance, *args) for args in arglist), None
+
+
+def read_checkpoint(filename):
+    """Names of the projects recorded as synced in a checkpoint file"""
+    if not filename or not os.path.exists(filename):
+        return set()
+    with open(filename, 'r') as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+def sync_projects(cydra_instance, projectnames, jobs=1, timeout=0, checkpoint=None, progress=None):
+    """Sync several projects, in parallel if jobs is larger than 1
+
+    Projects listed in the checkpoint file are skipped and successfully
+    synced projects are added to it, so an interrupted run can be resumed.
+    The checkpoint is removed once every project has been synced.
+
+    :param jobs: number of processes, 0 for one per CPU
+    :param timeout: seconds a single project may take, 0 for no limit
+    :param checkpoint: name of the checkpoint file
+    :param progress: called with the number of projects done, the total and
+                     the result of :func:`sync_project` after every project
+    :returns: summary dict with total, skipped, synced, failed (list of
+              results) and duration"""
+    start = time.time()
+    done = read_checkpoint(checkpoint)
+    pending = [name for name in projectnames if name not in done]
+    summary = {'total': len(projectnames),
+               'skipped': len(projectnames) - len(pending),
+               'synced': 0,
+               'failed': []}
+
+    results, pool = _run_all(cydra_instance, sync_project, [(name, timeout) for name in pending], jobs)
+
+    checkpoint_file = open(checkpoint, 'a') if checkpoint else None
+    try:
+        for count, result in enumerate(results, 1):
+            if result['status'] == 'ok':
+                summary['synced'] += 1
+                if checkpoint_file is not None:
+                    checkpoint_file.write(result['project'] + '\n')
+                    checkpoint_file.flush()
+            else:
+                summary['failed'].append(result)
+
+            if progress is not None:
+                progress(count + summary['skipped'], summary['total'], result)
+
+        if pool is not None:
+            pool.close()
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+        if checkpoint_file is not None:
+            checkpoint_file.close()
+
+    if checkpoint and not summary['failed'] and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    summary['duration'] = time.time() - start
+    return summary
+
+
+def sync_repositories(cydra_instance, project, jobs=1, timeout=0, progress=None):
+    """Sync the repositories of a project, in parallel if jobs is larger than 1
+
+    Parameters are the same as for :func:`sync_projects`, the timeout applies
+    to every repository and progress gets the results of :func:`sync_repository`.
+
+    :returns: summary dict with total, synced, failed (list of results) and duration"""
+    start = time.time()
+    arglist = []
+    for repotype in project.get_repository_types():
+        arglist.extend((project.name, repo.type, repo.name, timeout) for repo in repotype.get_repositories(project))
+    summary = {'total': len(arglist),
+               'synced': 0,
+               'failed': []}
+
+    results, pool = _run_all(cydra_instance, sync_repository, arglist, jobs)
+    try:
+        for count, result in enumerate(results, 1):
+            if result['status'] == 'ok':
+                summary['synced'] += 1
+            else:
+                summary['failed'].append(result)
+
+            if progress is not None:
+                progress(count, summary['total'], result)
+
+        if pool is not None:
+            pool.close()
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+
+    summary['duration'] = time.time() - start
+    return summary
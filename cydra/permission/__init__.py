@@ -19,16 +19,85 @@
 import copy
 
 from cydra.permission.interfaces import IPermissionProvider
-from cydra.component import Component, implements, ExtensionPoint
+from cydra.component import Component, ComponentManager, ComponentMeta, implements, ExtensionPoint
 
 import logging
 from argparse import ArgumentError
 logger = logging.getLogger(__name__)
 
 
+def _class_name(cls):
+    return cls.__module__ + '.' + cls.__name__
+
+
+def _subclasses(cls):
+    for subclass in cls.__subclasses__():
+        yield subclass
+        for subsubclass in _subclasses(subclass):
+            yield subsubclass
+
+
 class Subject(object):
     id = None
 
+    def to_dict(self):
+        """Attributes of the subject as a JSON serializable dict
+
+        The component manager is left out and references to components
+        are stored by name. Use :meth:`from_dict` to restore the subject"""
+        attributes = {}
+        for key, value in self.__dict__.items():
+            if isinstance(value, ComponentManager):
+                continue
+            attributes[key] = Subject._encode(value)
+        return {'type': _class_name(self.__class__), 'attributes': attributes}
+
+    @staticmethod
+    def _encode(value):
+        if isinstance(value, Subject):
+            return {'subject': value.to_dict()}
+        elif isinstance(value, Component):
+            return {'component': _class_name(value.__class__)}
+        elif isinstance(value, (list, tuple)):
+            return [Subject._encode(item) for item in value]
+        elif isinstance(value, dict):
+            return {'dict': dict((key, Subject._encode(item)) for key, item in value.items())}
+        return value
+
+    @staticmethod
+    def _decode(component_manager, value):
+        if isinstance(value, dict):
+            if 'subject' in value:
+                return Subject.from_dict(component_manager, value['subject'])
+            elif 'component' in value:
+                for cls in ComponentMeta._components:
+                    if _class_name(cls) == value['component']:
+                        return component_manager[cls]
+                raise ValueError("Unknown component %s" % value['component'])
+            elif 'dict' in value:
+                return dict((key, Subject._decode(component_manager, item)) for key, item in value['dict'].items())
+        elif isinstance(value, list):
+            return [Subject._decode(component_manager, item) for item in value]
+        return value
+
+    @staticmethod
+    def from_dict(component_manager, data):
+        """Restore a subject serialized with :meth:`to_dict`
+
+        Only subclasses of :class:`Subject` that are already loaded are
+        instantiated, nothing is imported."""
+        for cls in _subclasses(Subject):
+            if _class_name(cls) == data['type']:
+                break
+        else:
+            raise ValueError("Unknown subject type %s" % data['type'])
+
+        subject = cls.__new__(cls)
+        subject.compmgr = component_manager
+        for key, value in data['attributes'].items():
+            setattr(subject, str(key), Subject._decode(component_manager, value))
+        return subject
+
     def __repr__(self):
         return '<%s: %s>' % (self.__class__.__name__, self.id)
 
@@ -83,6 +152,8 @@ class User(Subject):
     supports_check_password = False
     supports_set_password = False
     valid_for_authentication = False
+    #: changes whenever the credentials of the user change. Auth tokens are bound to it
+    auth_token_salt = None
 
     def __init__(self, component_manager, userid, **kwargs):
         self.compmgr = component_manager
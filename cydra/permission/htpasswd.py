@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import os
+import hmac
 import hashlib
 from passlib.apache import HtpasswdFile
 
@@ -7,6 +8,7 @@ from cydra.component import Component, implements
 from cydra.permission import User
 from cydra.permission.interfaces import IUserTranslator, IUserAuthenticator, IUserStore
 from cydra.error import InsufficientConfiguration
+from cydra.util import SimpleCache
 
 import logging
 logger = logging.getLogger(__name__)
@@ -22,19 +24,67 @@ class HtpasswdUser(User):
 
     def __init__(self, htpasswdusers, userid, **kwargs):
         super(HtpasswdUser, self).__init__(htpasswdusers.compmgr, userid, **kwargs)
-        self.htpasswd = htpasswdusers.htpasswd
+        self._htpasswdusers = htpasswdusers
 
     def check_password(self, password):
-        self.htpasswd.load_if_changed()
-        return self.htpasswd.check_password(self.userid, password)
+        return self._htpasswdusers.user_password(self, password)
 
     def set_password(self, password):
-        self.htpasswd.load_if_changed()
-        self.htpasswd.set_password(self.id, password)
-        self.htpasswd.save()
+        self._htpasswdusers.set_user_password(self, password)
+
+    @property
+    def auth_token_salt(self):
+        return self._htpasswdusers.password_hash(self)
+
+
+def _to_bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+class CredentialCache(object):
+    """Remembers credentials that have been verified successfully
+
+    Only a keyed hash of user and password is kept. The key is generated
+    per process and never leaves it."""
+
+    def __init__(self, lifetime=5 * 60, maxsize=1000):
+        self._key = os.urandom(32)
+        self.cache = SimpleCache(lifetime=lifetime, killtime=lifetime, maxsize=maxsize)
+
+    def _digest(self, userid, password):
+        return hmac.new(self._key, _to_bytes(userid) + '\0' + _to_bytes(password), hashlib.sha256).digest()
+
+    def add(self, userid, password):
+        self.cache.set(self._digest(userid, password), userid)
+
+    def __contains__(self, credentials):
+        userid, password = credentials
+        return self._digest(userid, password) in self.cache
+
+    def invalidate_user(self, userid):
+        """Forget all credentials of the given user"""
+        for key, item in self.cache.data.items():
+            if item._value == userid:
+                self.cache.remove(key)
+
+    def clear(self):
+        self.cache.clear()
 
 
 class HtpasswdUsers(Component):
+    """Users stored in a htpasswd file
+
+    Configuration:
+    - file: Path to the htpasswd file
+    - credential_cache_ttl: Seconds a successfully verified password is remembered.
+      Set to 0 to disable the cache. Defaults to 5 minutes
+    - credential_cache_size: Maximum number of remembered credentials. Defaults to 1000
+    - append_only: Add new users by appending to the file instead of rewriting it.
+      Defaults to False
+    - compact_after: Number of appended users after which the file is rewritten
+      in append_only mode. Defaults to 1000"""
 
     implements(IUserAuthenticator)
     implements(IUserTranslator)
@@ -47,10 +97,65 @@ class HtpasswdUsers(Component):
             raise InsufficientConfiguration(missing='file', component=self.get_component_name())
 
         self.htpasswd = HtpasswdFile(config['file'])
+        self._mtime = self.htpasswd.mtime
+        self._userids = set(self.htpasswd.users())
+
+        self.append_only = config.get('append_only', False)
+        self.compact_after = config.get('compact_after', 1000)
+        self._appended = 0
+
+        self.credential_cache = None
+        cache_ttl = config.get('credential_cache_ttl', 5 * 60)
+        if cache_ttl:
+            self.credential_cache = CredentialCache(
+                lifetime=cache_ttl,
+                maxsize=config.get('credential_cache_size', 1000))
+
+    def _load_if_changed(self):
+        """Reload the htpasswd file if it has been modified
+
+        Since the file might have been changed by someone else,
+        all remembered credentials are dropped on reload."""
+        if self._mtime and self._mtime == os.path.getmtime(self.htpasswd.path):
+            return
+
+        self.htpasswd.load()
+        self._mtime = self.htpasswd.mtime
+        self._userids = set(self.htpasswd.users())
+        self._appended = 0
+
+        if self.credential_cache is not None:
+            self.credential_cache.clear()
+
+    def _save(self):
+        self.htpasswd.save()
+        self._mtime = self.htpasswd.mtime
+        self._appended = 0
+
+    def _append(self, userid):
+        """Append the record of a new user to the file
+
+        The in-memory state already contains the user, the file is only
+        rewritten once compact_after users have been appended."""
+        if self._appended >= self.compact_after:
+            return self._save()
+
+        record = '%s:%s\n' % (_to_bytes(userid), _to_bytes(self.htpasswd.get_hash(userid)))
+
+        with open(self.htpasswd.path, 'ab+') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != '\n':
+                    record = '\n' + record
+            f.write(record)
+
+        self._mtime = os.path.getmtime(self.htpasswd.path)
+        self._appended += 1
 
     def username_to_user(self, username):
-        self.htpasswd.load_if_changed()
-        if username in self.htpasswd.users():
+        self._load_if_changed()
+        if username in self._userids:
             return HtpasswdUser(self, username, username=username, full_name=username)
 
     def userid_to_user(self, userid):
@@ -58,8 +163,8 @@ class HtpasswdUsers(Component):
             warnings.warn("You should not call this directly. Use cydra.get_user()", DeprecationWarning, stacklevel=2)
             return self.compmgr.get_user(userid='*')
 
-        self.htpasswd.load_if_changed()
-        if userid in self.htpasswd.users():
+        self._load_if_changed()
+        if userid in self._userids:
             return HtpasswdUser(self, userid, username=userid, full_name=userid)
         else:
             # since the client was looking for a specific ID,
@@ -69,12 +174,36 @@ class HtpasswdUsers(Component):
     def groupid_to_group(self, groupid):
         pass
 
+    def password_hash(self, user):
+        """The stored hash of the password of the user"""
+        self._load_if_changed()
+        return self.htpasswd.get_hash(user.userid)
+
     def user_password(self, user, password):
-        self.htpasswd.load_if_changed()
-        return self.htpasswd.check_password(user.userid, password)
+        self._load_if_changed()
+
+        if self.credential_cache is None:
+            return self.htpasswd.check_password(user.userid, password)
+
+        if (user.userid, password) in self.credential_cache:
+            return True
+
+        result = self.htpasswd.check_password(user.userid, password)
+        if result:
+            self.credential_cache.add(user.userid, password)
+        return result
+
+    def set_user_password(self, user, password):
+        self._load_if_changed()
+        self.htpasswd.set_password(user.userid, password)
+        self._save()
+        self._userids.add(user.userid)
+
+        if self.credential_cache is not None:
+            self.credential_cache.invalidate_user(user.userid)
 
     def create_user(self, **kwargs):
-        self.htpasswd.load_if_changed()
+        self._load_if_changed()
 
         userid = None
         if 'id' in kwargs:
@@ -84,9 +213,13 @@ class HtpasswdUsers(Component):
         else:
             raise ValueError("No username/id specified")
 
-        if userid in self.htpasswd.users():
+        if userid in self._userids:
             raise ValueError("User with this id already exists")
         else:
             self.htpasswd.set_password(userid, hashlib.sha1(os.urandom(8)).hexdigest())
-            self.htpasswd.save()
+            if self.append_only:
+                self._append(userid)
+            else:
+                self._save()
+            self._userids.add(userid)
             return userid
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of Cydra.
+#
+# Cydra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cydra is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cydra.  If not, see http://www.gnu.org/licenses
+import os
+import time
+import resource
+import threading
+import subprocess
+from distutils.spawn import find_executable
+
+from cydra.error import CydraError
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ProcessLauncher(object):
+    """Spawns external commands from argv lists without going through a shell
+
+    Configured environment variables and resource limits are applied to
+    every process. Spawns are accounted, see :attr:`stats`.
+
+    Processes are spawned from threads of web servers, where a preexec_fn
+    is not safe to use. Resource limits are therefore applied by running the
+    command through prlimit. A command that cannot be executed then makes
+    prlimit fail instead of raising OSError. Without prlimit, limits fall back
+    to a preexec_fn.
+
+    :param env: dict of environment variables to set
+    :param rlimits: dict mapping resource names (as, cpu, nofile, nproc, ...) to limits
+    """
+
+    def __init__(self, env=None, rlimits=None):
+        self.env = dict(env or {})
+
+        self.rlimits = []
+        for name, limit in sorted((rlimits or {}).items()):
+            res = getattr(resource, 'RLIMIT_' + name.upper(), None)
+            if res is None:
+                raise CydraError("Unknown resource limit", name=name)
+            self.rlimits.append((name.lower(), res, limit))
+
+        self.wrapper = []
+        if self.rlimits:
+            prlimit = find_executable('prlimit')
+            if prlimit is not None:
+                self.wrapper = [prlimit] + ['--%s=%d:%d' % (name, limit, limit) for name, _, limit in self.rlimits] + ['--']
+            else:
+                logger.warning("prlimit not found, applying resource limits in a preexec_fn")
+
+        self._lock = threading.Lock()
+        self.spawned = 0
+        self.failed = 0
+        self.spawn_time = 0.0
+        self.max_spawn_time = 0.0
+
+    @classmethod
+    def from_config(cls, config):
+        """Create a launcher from the env and rlimits keys of a component config"""
+        return cls(env=config.get('env'), rlimits=config.get('rlimits'))
+
+    def environment(self, env=None):
+        """Environment for a new process
+
+        :param env: base environment. Defaults to ours
+        :returns: None if the base environment can be used as is"""
+        if not self.env:
+            return env
+
+        result = dict(os.environ if env is None else env)
+        result.update(self.env)
+        return result
+
+    def _preexec(self):
+        for _, res, limit in self.rlimits:
+            resource.setrlimit(res, (limit, limit))
+
+    def popen(self, argv, env=None, **kwargs):
+        """Start a process. Takes the same arguments as :class:`subprocess.Popen`
+
+        Only argv lists are accepted, there is no shell involved."""
+        if isinstance(argv, basestring):
+            raise TypeError("argv has to be a list")
+
+        kwargs.setdefault('close_fds', True)
+        if self.wrapper:
+            argv = self.wrapper + list(argv)
+        elif self.rlimits:
+            kwargs['preexec_fn'] = self._preexec
+
+        start = time.time()
+        try:
+            process = subprocess.Popen(argv, env=self.environment(env), **kwargs)
+        except OSError:
+            with self._lock:
+                self.failed += 1
+            raise
+        elapsed = time.time() - start
+
+        with self._lock:
+            self.spawned += 1
+            self.spawn_time += elapsed
+            self.max_spawn_time = max(self.max_spawn_time, elapsed)
+
+        return process
+
+    def run(self, argv, input=None, env=None):
+        """Run a process to completion
+
+        :returns: tuple of returncode, stdout and stderr"""
+        process = self.popen(argv, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate(input)
+        return process.returncode, stdout, stderr
+
+    @property
+    def stats(self):
+        """Number of spawned and failed processes and spawn latencies in seconds"""
+        with self._lock:
+            return {'spawned': self.spawned,
+                    'failed': self.failed,
+                    'spawn_time_total': self.spawn_time,
+                    'spawn_time_max': self.max_spawn_time,
+                    'spawn_time_avg': self.spawn_time / self.spawned if self.spawned else 0.0}
@@ -126,6 +126,11 @@ class Project(object):
             if repo.sync() == False:  # Don't use not here, None should not be considered a failure
                 res = False
 
+        # refresh the repository index with what is on disk now
+        for repotype in self.get_repository_types():
+            if hasattr(repotype, 'index'):
+                repotype.index.reconcile(self)
+
         return res
 
     def sync(self):
@@ -19,16 +19,41 @@
 
 import os
 import os.path
+import stat
+import json
 import shutil
+import hashlib
 import uuid
 from cydra.component import Component, ExtensionPoint, implements
+from cydra.util import FileParseCache, atomic_write
 from cydra.repository.interfaces import ISyncParticipant, IRepositoryObserver, IRepositoryProvider
+from cydra.repository.index import RepositoryIndex
 from cydra.project.interfaces import IProjectObserver
 
 import logging
 logger = logging.getLogger(__name__)
 
 
+def compile_template(path):
+    """Compile the jinja2 template in the file at path"""
+    from jinja2 import Template
+
+    with open(path, 'r') as f:
+        return Template(f.read())
+
+
+class RevisionList(list):
+    """List of revisions passed to post-commit observers
+
+    Behaves like a plain list of revision strings. ref_updates lists the
+    (ref, old, new) tuples of the push that brought the revisions in,
+    if the repository type knows about refs."""
+
+    def __init__(self, revisions=(), ref_updates=()):
+        super(RevisionList, self).__init__(revisions)
+        self.ref_updates = list(ref_updates)
+
+
 class RepositoryParameter(object):
     def __init__(self, keyword, name, optional=True, description=""):
         self.keyword = keyword
@@ -48,10 +73,54 @@ class RepositoryProviderComponent(Component):
 
     abstract = True
 
+    _index = None
+
+    @property
+    def index(self):
+        """The :class:`RepositoryIndex` of this provider"""
+        if self._index is None:
+            self._index = RepositoryIndex(self, max_age=self.get_component_config().get('index_max_age', 300))
+        return self._index
+
+    _templates = None
+
+    def get_hook_template(self, path, resource):
+        """Compiled template for a hook
+
+        Templates are compiled once. Configured template files are
+        recompiled when they change.
+
+        :param path: configured template file or None
+        :param resource: name of the built-in template in cydra.repository, used if path is None"""
+        if self._templates is None:
+            self._templates = {'files': FileParseCache(compile_template)}
+
+        if path:
+            return self._templates['files'].get(path)
+
+        if resource not in self._templates:
+            from jinja2 import Template
+            from pkg_resources import resource_string
+            self._templates[resource] = Template(resource_string('cydra.repository', resource))
+        return self._templates[resource]
+
+    def get_project_path(self, project):
+        """Directory the repositories of the project are stored in"""
+        return os.path.join(self._base, project.name)
+
+    def get_params_bulk(self, project):
+        """Parameters of all repositories of a project, as kept in the index
+
+        :returns: dict mapping repository names to dicts of parameter values"""
+        keywords = [param.keyword for param in self.get_params()]
+        return dict((info.name, dict((keyword, info.params.get(keyword)) for keyword in keywords))
+                    for info in self.index.get(project))
+
     def pre_delete_project(self, project, archiver=None):
         """Handle project delete by deleting all repositories"""
         for repo in self.get_repositories(project):
             repo.delete(archiver, project_deletion=True)
+        self.index.invalidate(project)
 
 
 class Repository(object):
@@ -74,6 +143,11 @@ class Repository(object):
     #: Project this repository belongs to
     project = None
 
+    @property
+    def info(self):
+        """Indexed metadata of this repository, see :class:`cydra.repository.index.RepositoryInfo`"""
+        return self.repository_provider.index.lookup(self.project, self.name)
+
     sync_participants = ExtensionPoint(ISyncParticipant)
     repository_observers = ExtensionPoint(IRepositoryObserver)
 
@@ -90,6 +164,53 @@ class Repository(object):
 
         self.sync_participants.sync_repository(self)
 
+    #: File recording the state of the files written by sync
+    sync_manifest_path = None
+
+    def load_sync_manifest(self):
+        """The sync manifest, a dict mapping names to the recorded state"""
+        try:
+            with open(self.sync_manifest_path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def save_sync_manifest(self, manifest):
+        atomic_write(self.sync_manifest_path, json.dumps(manifest, sort_keys=True))
+
+    def sync_file(self, manifest, path, content, executable=False):
+        """Make sure the file at path has the given content
+
+        Files the manifest records with the same content, mtime and size are
+        left alone without reading them. Otherwise the file is compared and
+        only written if it differs.
+
+        :returns: True if the manifest has been updated"""
+        key = os.path.relpath(path, self.path)
+        digest = hashlib.sha1(content).hexdigest()
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+
+        executable_bits = stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+        if st is not None and (not executable or st.st_mode & executable_bits == executable_bits):
+            if manifest.get(key) == [digest, st.st_mtime, st.st_size]:
+                return False
+            if st.st_size == len(content):
+                with open(path, 'rb') as f:
+                    if f.read() == content:
+                        manifest[key] = [digest, st.st_mtime, st.st_size]
+                        return True
+
+        logger.debug("Writing %s", path)
+        atomic_write(path, content)
+        if executable:
+            os.chmod(path, stat.S_IMODE(os.stat(path).st_mode) | executable_bits)
+        st = os.stat(path)
+        manifest[key] = [digest, st.st_mtime, st.st_size]
+        return True
+
     def delete(self, archiver=None, project_deletion=False):
         """Delete the repository"""
         if not archiver:
@@ -106,6 +227,7 @@ class Repository(object):
         logger.info("Deleted repository %s of type %s: %s", self.name, self.type, tmppath)
 
         shutil.rmtree(tmppath)
+        self.repository_provider.index.invalidate(self.project)
 
         self.repository_observers.post_delete_repository(self)
 
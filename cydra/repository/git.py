@@ -16,16 +16,22 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with Cydra.  If not, see http://www.gnu.org/licenses
+import os
 import os.path
-import stat
-import subprocess
 import re
+import fcntl
 
 import cydra
 from cydra.component import ExtensionPoint
-from cydra.repository import RepositoryProviderComponent, Repository, RepositoryParameter
+from cydra.repository import RepositoryProviderComponent, Repository, RepositoryParameter, RevisionList
+from cydra.repository.index import RepositoryInfo
 from cydra.error import CydraError, InsufficientConfiguration, UnknownRepository
 from cydra.permission import IPermissionProvider
+from cydra.process import ProcessLauncher
+from cydra.util import FileParseCache, atomic_write
+
+import logging
+logger = logging.getLogger(__name__)
 
 
 def is_valid_repository_name(name):
@@ -40,12 +46,24 @@ param_description = RepositoryParameter(
         description='Description of the repository')
 
 
+def read_file(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
 class GitRepositories(RepositoryProviderComponent):
     """Component for git based repositories
 
     Configuration:
     - base: Path to the directory where repositories are stored
-    - gitcommand: Path to git command. Defaults to git"""
+    - gitcommand: Path to git command. Defaults to git
+    - update_server_info: Run git update-server-info in the background after pushes
+      so dumb HTTP clients see new refs. Defaults to True. Can be disabled for
+      a single repository with git config cydra.updateserverinfo false
+    - env: Environment variables to set for git processes
+    - rlimits: Resource limits for git processes, e.g. {'as': 2147483648, 'cpu': 3600}
+    - index_max_age: Seconds after which the repository list of a project is rescanned
+      even if the project directory did not change. Defaults to 300"""
 
     repository_type = 'git'
     repository_type_title = 'Git'
@@ -58,22 +76,35 @@ class GitRepositories(RepositoryProviderComponent):
 
         self._base = config['base']
         self.gitcommand = config.get('gitcommand', 'git')
+        self.update_server_info = config.get('update_server_info', True)
+        self.launcher = ProcessLauncher.from_config(config)
+        # contents of description files
+        self.param_cache = FileParseCache(read_file)
 
     def get_repositories(self, project):
         """Returns a list of repositories for the project
 
-        This list is based on the filesystem"""
-        if not os.path.exists(os.path.join(self._base, project.name)):
-            return []
-
-        return [GitRepository(self.compmgr, self._base, project, x[:-4]) for x in os.listdir(os.path.join(self._base, project.name)) if x[-4:] == '.git']
+        This list is based on the repository index"""
+        return [GitRepository(self.compmgr, self._base, project, info.name, verify=False)
+                for info in self.index.get(project)]
 
     def get_repository(self, project, repository_name):
         """Return a GitRepository instance for a repository"""
         if not self._repo_exists(project, repository_name):
             return
         else:
-            return GitRepository(self.compmgr, self._base, project, repository_name)
+            return GitRepository(self.compmgr, self._base, project, repository_name, verify=False)
+
+    def scan_repositories(self, project):
+        """Lists the repositories of a project on the filesystem"""
+        path = self.get_project_path(project)
+        result = []
+        for x in os.listdir(path):
+            repo_path = os.path.abspath(os.path.join(path, x))
+            if x[-4:] == '.git' and os.path.isdir(repo_path):
+                description = self.param_cache.get(os.path.join(repo_path, 'description'))
+                result.append(RepositoryInfo(x[:-4], 'git', repo_path, {'description': description}))
+        return result
 
     def can_create(self, project, user=None):
         """Returns whether the user create a new repository"""
@@ -97,15 +128,15 @@ class GitRepositories(RepositoryProviderComponent):
         if not os.path.exists(os.path.join(self._base, project.name)):
             os.mkdir(os.path.join(self._base, project.name))
 
-        git_cmd = subprocess.Popen([self.gitcommand, 'init', '--bare', path], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        _, errors = git_cmd.communicate()
+        try:
+            returncode, _, errors = self.launcher.run([self.gitcommand, 'init', '--bare', path])
+        except OSError as e:
+            raise CydraError('Command not found encountered while calling git', stderr=str(e))
 
-        if git_cmd.returncode != 0:
-            if git_cmd.returncode == 127:
-                # assume this is command not found
-                raise CydraError('Command not found encountered while calling git', stderr=errors)
-            else:
-                raise CydraError('Error encountered while calling git', stderr=errors, code=git_cmd.returncode)
+        if returncode != 0:
+            raise CydraError('Error encountered while calling git', stderr=errors, code=returncode)
+
+        self.index.invalidate(project)
 
         # Customize config
         repository = GitRepository(self.compmgr, self._base, project, repository_name)
@@ -127,17 +158,18 @@ class GitRepositories(RepositoryProviderComponent):
         if not is_valid_repository_name(name):
             raise CydraError("Invalid Repository Name", name=name)
 
-        path = os.path.join(self._base, project.name, name + '.git')
-
-        return os.path.exists(path)
+        return self.index.lookup(project, name) is not None
 
 
 class GitRepository(Repository):
 
     permission = ExtensionPoint(IPermissionProvider)
 
-    def __init__(self, component_manager, base, project, name):
-        """Construct an instance"""
+    def __init__(self, component_manager, base, project, name, verify=True):
+        """Construct an instance
+
+        :param verify: check that the repository exists. Repositories found
+                       through the index are known to exist"""
         super(GitRepository, self).__init__(component_manager)
 
         self.project = project
@@ -146,47 +178,118 @@ class GitRepository(Repository):
         self.type = 'git'
 
         self.path = self.path = os.path.abspath(os.path.join(self.base, project.name, name + '.git'))
+        self.sync_manifest_path = os.path.join(self.path, 'cydra-sync.json')
 
         # ensure this repository actually exists
-        if not os.path.exists(self.path):
+        if verify and not os.path.exists(self.path):
             raise UnknownRepository(repository_name=name, project_name=project.name, repository_type='git')
 
     def get_param(self, param):
         if param == 'description':
-            descrfile = os.path.join(self.path, 'description')
-
-            if os.path.exists(descrfile):
-                with open(descrfile, 'r') as f:
-                    return f.read()
+            return self.repository_provider.param_cache.get(os.path.join(self.path, 'description'))
 
     def set_params(self, **params):
         if 'description' in params:
             descrfile = os.path.join(self.path, 'description')
 
-            with open(descrfile, 'w') as f:
-                f.write(params['description'])
+            atomic_write(descrfile, params['description'])
+            self.repository_provider.param_cache.invalidate(descrfile)
+            self.repository_provider.index.update(self.project, self.name, description=params['description'])
 
     def sync(self):
-        """Installs necessary hooks"""
-        from jinja2 import Template
-
-        tpl = self.compmgr.config.get_component_config('cydra.repository.git.GitRepositories', {}).get('post_receive_script')
-        if tpl:
-            with open(tpl, 'r') as f:
-                template = Template(f.read())
-        else:
-            from pkg_resources import resource_string
-            template = Template(resource_string('cydra.repository', 'scripts/git_post-receive.sh'))
+        """Installs necessary hooks. Files that are up to date are not touched"""
+        template = self.repository_provider.get_hook_template(
+                self.compmgr.config.get_component_config('cydra.repository.git.GitRepositories', {}).get('post_receive_script'),
+                'scripts/git_post-receive.sh')
 
-        hook = template.render(project=self.project, repository=self)
-        with open(os.path.join(self.path, 'hooks', 'post-receive'), 'w') as f:
-            f.write(hook)
-            mode = os.fstat(f.fileno()).st_mode
-            mode |= stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
-            os.fchmod(f.fileno(), mode)
+        manifest = self.load_sync_manifest()
+        hook = template.render(project=self.project, repository=self).encode('utf-8')
+        if self.sync_file(manifest, os.path.join(self.path, 'hooks', 'post-receive'), hook, executable=True):
+            self.save_sync_manifest(manifest)
 
         super(GitRepository, self).sync()
 
+    def get_pushed_revisions(self, ref_updates):
+        """Revisions a push brought into the repository
+
+        Runs a single git rev-list for all updated refs. Commits that were
+        already reachable from the old ref values or from refs not touched by
+        the push are left out, so every revision is listed once.
+
+        :param ref_updates: list of (old, new, ref) tuples as passed to post-receive
+        :returns: :class:`cydra.repository.RevisionList`, oldest first"""
+        null = '0' * 40
+        provider = self.repository_provider
+
+        tips = [new for old, new, ref in ref_updates if new != null]
+        tips.extend('^' + old for old, new, ref in ref_updates if old != null)
+
+        revisions = []
+        if any(new != null for old, new, ref in ref_updates):
+            argv = [provider.gitcommand, '--git-dir', self.path, 'rev-list', '--topo-order', '--reverse', '--stdin', '--not']
+            argv.extend('--exclude=' + ref for old, new, ref in ref_updates)
+            # not --all, HEAD might point to one of the updated refs
+            argv.append('--glob=refs/*')
+
+            returncode, stdout, errors = provider.launcher.run(argv, input='\n'.join(tips) + '\n')
+            if returncode != 0:
+                raise CydraError('Error encountered while calling git', stderr=errors, code=returncode)
+            revisions = stdout.splitlines()
+
+        return RevisionList(revisions, [(ref, old, new) for old, new, ref in ref_updates])
+
+    def update_server_info(self):
+        """Update the auxiliary files for dumb HTTP clients
+
+        Concurrent calls are coalesced: if an update is already running for
+        this repository, it will run once more after it is done."""
+        provider = self.repository_provider
+        gitcommand = provider.gitcommand
+        pending = os.path.join(self.path, 'cydra-update-server-info.pending')
+
+        open(pending, 'w').close()
+
+        while os.path.exists(pending):
+            with open(os.path.join(self.path, 'cydra-update-server-info.lock'), 'w') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    # the running update will pick up our request
+                    return
+
+                while os.path.exists(pending):
+                    os.unlink(pending)
+
+                    _, enabled, _ = provider.launcher.run([gitcommand, '--git-dir', self.path, 'config', '--bool', 'cydra.updateserverinfo'])
+                    if enabled.strip() == 'false':
+                        return
+
+                    returncode, _, errors = provider.launcher.run([gitcommand, '--git-dir', self.path, 'update-server-info'])
+                    if returncode != 0:
+                        logger.error("update-server-info failed for %s: %s", self.path, errors)
+
+    def update_server_info_in_background(self):
+        """Run update_server_info in a detached process
+
+        The process does not hold on to any of our file descriptors, so git
+        does not wait for it before reporting the push as done."""
+        pid = os.fork()
+        if pid != 0:
+            os.waitpid(pid, 0)
+            return
+
+        try:
+            os.setsid()
+            if os.fork() == 0:
+                devnull = os.open(os.devnull, os.O_RDWR)
+                for fd in (0, 1, 2):
+                    os.dup2(devnull, fd)
+                self.update_server_info()
+        except:
+            logger.exception("Running update-server-info failed")
+        finally:
+            os._exit(0)
+
     def has_read_access(self, user):
         return self.project.get_permission(user, 'repository.git.' + self.name, 'read')
 
@@ -215,7 +318,6 @@ def post_receive_hook():
 
     cyd = cydra.Cydra()
     gitconf = cyd.config.get_component_config('cydra.repository.git.GitRepositories', {})
-    gitcommand = gitconf.get('gitcommand', 'git')
 
     project = cyd.get_project(args[0])
 
@@ -227,13 +329,12 @@ def post_receive_hook():
     if not repository:
         sys.exit("Unknown repository")
 
-    for line in sys.stdin.readlines():
-        old, new, ref = line.split()
-
-        args = [new] if old == '0' * 40 else [new, '^' + old]
-
-        commits = subprocess.Popen([gitcommand, '--git-dir', repository.path, 'rev-list'] + args, stdout=subprocess.PIPE).communicate()[0]
+    ref_updates = [tuple(line.split()) for line in sys.stdin if line.strip()]
+    if ref_updates:
+        # one notification for the whole push
+        repository.notify_post_commit(repository.get_pushed_revisions(ref_updates))
 
-        repository.notify_post_commit(commits.splitlines()[::-1])
+    if gitconf.get('update_server_info', True):
+        repository.update_server_info_in_background()
 
     sys.exit(0)
@@ -17,16 +17,19 @@
 # You should have received a copy of the GNU General Public License
 # along with Cydra.  If not, see http://www.gnu.org/licenses
 import os.path
-import stat
 import subprocess
 import re
+import hashlib
 import ConfigParser
+from StringIO import StringIO
 
 import cydra
 from cydra.component import ExtensionPoint
 from cydra.repository import RepositoryProviderComponent, RepositoryParameter, Repository
+from cydra.repository.index import RepositoryInfo
 from cydra.error import CydraError, InsufficientConfiguration, UnknownRepository
 from cydra.permission import IPermissionProvider
+from cydra.util import FileParseCache, atomic_write
 
 import logging
 logger = logging.getLogger(__name__)
@@ -42,6 +45,25 @@ param_contact = RepositoryParameter(
         description='Contact for the repository')
 
 
+def parse_hgrc(path):
+    """Parse an hgrc file into a RawConfigParser"""
+    cp = ConfigParser.RawConfigParser()
+    try:
+        cp.read(path)
+    except:
+        logger.exception("Unable to parse hgrc file %s", path)
+        raise CydraError('Cannot parse existing hgrc file')
+    return cp
+
+
+def read_web_params(path):
+    """The [web] section of an hgrc file as a dict"""
+    cp = parse_hgrc(path)
+    if not cp.has_section('web'):
+        return {}
+    return dict(cp.items('web'))
+
+
 def is_valid_repository_name(name):
     if re.match(r'^[a-z][a-z0-9\-_]{0,31}$', name) is None:
         return False
@@ -62,12 +84,23 @@ class HgRepositories(RepositoryProviderComponent):
 
         self._base = config['base']
         self.hgcommand = config.get('hgcommand', 'hg')
+        # [web] sections of hgrc files
+        self.param_cache = FileParseCache(read_web_params, default={})
 
     def get_repositories(self, project):
-        if not os.path.exists(os.path.join(self._base, project.name)):
-            return []
-
-        return [HgRepository(self.compmgr, self._base, project, x) for x in os.listdir(os.path.join(self._base, project.name))]
+        return [HgRepository(self.compmgr, self._base, project, info.name, verify=False)
+                for info in self.index.get(project)]
+
+    def scan_repositories(self, project):
+        path = self.get_project_path(project)
+        result = []
+        for x in os.listdir(path):
+            repo_path = os.path.abspath(os.path.join(path, x))
+            if os.path.isdir(os.path.join(repo_path, '.hg')):
+                web = self.param_cache.get(os.path.join(repo_path, '.hg', 'hgrc'))
+                result.append(RepositoryInfo(x, 'hg', repo_path,
+                        dict((param, web.get(param)) for param in ['contact', 'description'])))
+        return result
 
     def get_repository(self, project, repository_name):
         return HgRepository(self.compmgr, self._base, project, repository_name)
@@ -100,6 +133,8 @@ class HgRepositories(RepositoryProviderComponent):
             else:
                 raise CydraError('Error encountered while calling hg', stderr=errors, code=hg_cmd.returncode)
 
+        self.index.invalidate(project)
+
         repository = HgRepository(self.compmgr, self._base, project, repository_name)
         repository.set_params(**params)
         repository.sync()  # synchronize repository
@@ -120,8 +155,10 @@ class HgRepository(Repository):
 
     permission = ExtensionPoint(IPermissionProvider)
 
-    def __init__(self, component_manager, base, project, name):
-        """Construct an instance"""
+    def __init__(self, component_manager, base, project, name, verify=True):
+        """Construct an instance
+
+        :param verify: check that the repository exists"""
         super(HgRepository, self).__init__(component_manager)
 
         self.project = project
@@ -131,9 +168,10 @@ class HgRepository(Repository):
 
         self.path = os.path.abspath(os.path.join(self.base, project.name, name))
         self.hgrc_path = os.path.join(self.path, '.hg', 'hgrc')
+        self.sync_manifest_path = os.path.join(self.path, '.hg', 'cydra-sync.json')
 
         # ensure this repository actually exists
-        if not os.path.exists(self.path):
+        if verify and not os.path.exists(self.path):
             raise UnknownRepository(repository_name=name, project_name=project.name, repository_type='hg')
 
     def has_read_access(self, user):
@@ -143,33 +181,25 @@ class HgRepository(Repository):
         return self.project.get_permission(user, 'repository.hg.' + self.name, 'write')
 
     def _get_config(self):
-        cp = ConfigParser.RawConfigParser()
-
         if os.path.exists(self.hgrc_path):
-            try:
-                cp.read(self.hgrc_path)
-            except:
-                logger.exception("Unable to parse hgrc file %s", self.hgrc_path)
-                raise CydraError('Cannot parse existing hgrc file')
-        else:
-            logger.info("No hgrc file found at %s", self.hgrc_path)
+            return parse_hgrc(self.hgrc_path)
 
-        return cp
+        logger.info("No hgrc file found at %s", self.hgrc_path)
+        return ConfigParser.RawConfigParser()
 
     def _set_config(self, config):
+        data = StringIO()
+        config.write(data)
         try:
-            with open(self.hgrc_path, 'wb') as f:
-                config.write(f)
+            atomic_write(self.hgrc_path, data.getvalue())
         except Exception:
             logger.exception("Unable to write hgrc file %s", self.hgrc_path)
             raise CydraError('Unable to write hgrc file')
+        self.repository_provider.param_cache.invalidate(self.hgrc_path)
 
     def get_param(self, param):
-        cp = self._get_config()
-
         if param in ['contact', 'description']:
-            if cp.has_option('web', param):
-                return cp.get('web', param)
+            return self.repository_provider.param_cache.get(self.hgrc_path).get(param)
 
     def set_params(self, **params):
         if not params:
@@ -188,34 +218,44 @@ class HgRepository(Repository):
                     cp.set('web', param, params[param])
 
         self._set_config(cp)
+        self.repository_provider.index.update(self.project, self.name,
+                **dict((param, params[param]) for param in ['contact', 'description'] if param in params))
 
     def sync(self):
-        """Installs necessary hooks"""
-        from jinja2 import Template
-
-        tpl = self.compmgr.config.get_component_config('cydra.repository.git.HgRepositories', {}).get('commit_script')
-        if tpl:
-            with open(tpl, 'r') as f:
-                template = Template(f.read())
-        else:
-            from pkg_resources import resource_string
-            template = Template(resource_string('cydra.repository', 'scripts/hg_commit.sh'))
+        """Installs necessary hooks. Files that are up to date are not touched"""
+        template = self.repository_provider.get_hook_template(
+                self.compmgr.config.get_component_config('cydra.repository.git.HgRepositories', {}).get('commit_script'),
+                'scripts/hg_commit.sh')
 
-        hook = template.render(project=self.project, repository=self)
+        manifest = self.load_sync_manifest()
+        hook = template.render(project=self.project, repository=self).encode('utf-8')
         hookpath = os.path.join(self.path, '.hg', 'cydra_commit_hook.sh')
-        with open(hookpath, 'w') as f:
-            f.write(hook)
-            mode = os.fstat(f.fileno()).st_mode
-            mode |= stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
-            os.fchmod(f.fileno(), mode)
+        changed = self.sync_file(manifest, hookpath, hook, executable=True)
 
-        # register hook
-        cp = self._get_config()
-        if not cp.has_section('hooks'):
-            cp.add_section('hooks')
-        cp.set('hooks', 'commit.cydra', hookpath)
-        cp.set('hooks', 'changegroup.cydra', hookpath)
-        self._set_config(cp)
+        # register hook, unless hgrc is unchanged since we last did
+        hooks = {'commit.cydra': hookpath, 'changegroup.cydra': hookpath}
+        digest = hashlib.sha1(repr(sorted(hooks.items()))).hexdigest()
+        try:
+            st = os.stat(self.hgrc_path)
+            hgrc_state = [digest, st.st_mtime, st.st_size]
+        except OSError:
+            hgrc_state = None
+
+        if hgrc_state is None or manifest.get('hgrc') != hgrc_state:
+            cp = self._get_config()
+            if not cp.has_section('hooks'):
+                cp.add_section('hooks')
+            if any(not cp.has_option('hooks', name) or cp.get('hooks', name) != value for name, value in hooks.items()):
+                for name, value in hooks.items():
+                    cp.set('hooks', name, value)
+                self._set_config(cp)
+
+            st = os.stat(self.hgrc_path)
+            manifest['hgrc'] = [digest, st.st_mtime, st.st_size]
+            changed = True
+
+        if changed:
+            self.save_sync_manifest(manifest)
 
         super(HgRepository, self).sync()
 
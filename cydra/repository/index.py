@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of Cydra.
+#
+# Cydra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cydra is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cydra.  If not, see http://www.gnu.org/licenses
+import os
+import time
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class RepositoryInfo(object):
+    """Metadata of a repository kept in the index
+
+    params holds the values of the parameters of the repository (see
+    get_params of the provider) as found by the scan."""
+
+    def __init__(self, name, type, path, params=None):
+        self.name = name
+        self.type = type
+        self.path = path
+        self.params = params or {}
+
+    @property
+    def description(self):
+        return self.params.get('description')
+
+
+class RepositoryIndex(object):
+    """In-memory index of the repositories of a repository provider
+
+    The repositories of a project are scanned once and kept until the project
+    directory changes (creating, renaming or deleting a repository changes its
+    mtime) or the scan is older than max_age. A listing then costs a single
+    stat of the project directory.
+
+    :param provider: :class:`RepositoryProviderComponent` doing the actual scans.
+                     Its scan_repositories(project) returns a list of :class:`RepositoryInfo`
+    :param max_age: seconds after which a project is rescanned anyway, 0 for never
+    """
+
+    def __init__(self, provider, max_age=300):
+        self.provider = provider
+        self.max_age = max_age
+
+        self._lock = threading.Lock()
+        # project name -> (project dir mtime, scan time, name -> RepositoryInfo)
+        self.projects = {}
+
+    def _project_mtime(self, project):
+        try:
+            return os.stat(self.provider.get_project_path(project)).st_mtime
+        except OSError:
+            return None
+
+    def _scan(self, project, mtime):
+        repositories = {}
+        if mtime is not None:
+            for info in self.provider.scan_repositories(project):
+                repositories[info.name] = info
+
+        with self._lock:
+            self.projects[project.name] = (mtime, time.time(), repositories)
+        return repositories
+
+    def _repositories(self, project):
+        mtime = self._project_mtime(project)
+        with self._lock:
+            entry = self.projects.get(project.name)
+
+        if entry is not None and entry[0] == mtime and \
+                (not self.max_age or time.time() - entry[1] < self.max_age):
+            return entry[2]
+        return self._scan(project, mtime)
+
+    def get(self, project):
+        """List of :class:`RepositoryInfo` of the project, sorted by name"""
+        repositories = self._repositories(project)
+        return [repositories[name] for name in sorted(repositories)]
+
+    def lookup(self, project, name):
+        """:class:`RepositoryInfo` of a single repository or None"""
+        return self._repositories(project).get(name)
+
+    def update(self, project, name, **params):
+        """Update parameters of an indexed repository"""
+        with self._lock:
+            entry = self.projects.get(project.name)
+            info = entry[2].get(name) if entry is not None else None
+            if info is not None:
+                info.params.update(params)
+
+    def invalidate(self, project):
+        """Forget the project, the next access rescans it"""
+        with self._lock:
+            self.projects.pop(project.name, None)
+
+    def reconcile(self, project):
+        """Rescan the project, even if its directory did not change"""
+        repositories = self._scan(project, self._project_mtime(project))
+        return [repositories[name] for name in sorted(repositories)]
@@ -70,7 +70,9 @@ class IRepositoryObserver(Interface):
         """One or more commits have occured
 
         :param repository: The repository object
-        :param revisions: A list of revision strings"""
+        :param revisions: A list of revision strings, oldest first. Might be a
+                          :class:`cydra.repository.RevisionList` with details
+                          on the updated refs"""
         pass
 
     def pre_delete_repository(self, repository, project_deletion):
@@ -17,12 +17,12 @@
 # You should have received a copy of the GNU General Public License
 # along with Cydra.  If not, see http://www.gnu.org/licenses
 import os.path
-import stat
 import subprocess
 
 import cydra
 from cydra.component import Component, implements, ExtensionPoint
 from cydra.repository import RepositoryProviderComponent, Repository
+from cydra.repository.index import RepositoryInfo
 from cydra.error import CydraError, InsufficientConfiguration, UnknownRepository
 from cydra.permission import IPermissionProvider
 from cydra.web.frontend.hooks import IRepositoryViewerProvider, IProjectFeaturelistItemProvider
@@ -74,10 +74,13 @@ class SVNRepositories(RepositoryProviderComponent):
         self.svncommand = config.get('svncommand', 'svnadmin')
 
     def get_repositories(self, project):
-        if not os.path.exists(os.path.join(self._base, project.name)):
-            return []
-        else:
-            return [SVNRepository(self.compmgr, self._base, project)]
+        return [SVNRepository(self.compmgr, self._base, project, verify=False)
+                for info in self.index.get(project)]
+
+    def scan_repositories(self, project):
+        # the project directory is the repository
+        path = os.path.abspath(self.get_project_path(project))
+        return [RepositoryInfo(project.name, 'svn', path)]
 
     def get_repository(self, project, repository_name):
         return SVNRepository(self.compmgr, self._base, project)
@@ -107,6 +110,8 @@ class SVNRepositories(RepositoryProviderComponent):
             else:
                 raise CydraError('Error encountered while calling svn', stderr=errors, code=svn_cmd.returncode)
 
+        self.index.invalidate(project)
+
         # Customize config
 
         repository = SVNRepository(self.compmgr, self._base, project)
@@ -121,8 +126,10 @@ class SVNRepository(Repository):
 
     permission = ExtensionPoint(IPermissionProvider)
 
-    def __init__(self, component_manager, base, project):
-        """Construct repository instance"""
+    def __init__(self, component_manager, base, project, verify=True):
+        """Construct repository instance
+
+        :param verify: check that the repository exists"""
         super(SVNRepository, self).__init__(component_manager)
 
         self.project = project
@@ -131,9 +138,10 @@ class SVNRepository(Repository):
         self.type = 'svn'
 
         self.path = self.path = os.path.abspath(os.path.join(self.base, self.name))
+        self.sync_manifest_path = os.path.join(self.path, 'cydra-sync.json')
 
         # ensure this repository actually exists
-        if not os.path.exists(self.path):
+        if verify and not os.path.exists(self.path):
             raise UnknownRepository(repository_name=self.name, project_name=project.name, repository_type='svn')
 
     def has_read_access(self, user):
@@ -143,23 +151,15 @@ class SVNRepository(Repository):
         return self.project.get_permission(user, 'repository.svn.' + self.name, 'write')
 
     def sync(self):
-        """Installs necessary hooks"""
-        from jinja2 import Template
-
-        tpl = self.compmgr.config.get_component_config('cydra.repository.svn.SVNRepositories', {}).get('commit_script')
-        if tpl:
-            with open(tpl, 'r') as f:
-                template = Template(f.read())
-        else:
-            from pkg_resources import resource_string
-            template = Template(resource_string('cydra.repository', 'scripts/svn_commit.sh'))
-
-        hook = template.render(project=self.project, repository=self)
-        with open(os.path.join(self.path, 'hooks', 'post-commit'), 'w') as f:
-            f.write(hook)
-            mode = os.fstat(f.fileno()).st_mode
-            mode |= stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
-            os.fchmod(f.fileno(), mode)
+        """Installs necessary hooks. Files that are up to date are not touched"""
+        template = self.repository_provider.get_hook_template(
+                self.compmgr.config.get_component_config('cydra.repository.svn.SVNRepositories', {}).get('commit_script'),
+                'scripts/svn_commit.sh')
+
+        manifest = self.load_sync_manifest()
+        hook = template.render(project=self.project, repository=self).encode('utf-8')
+        if self.sync_file(manifest, os.path.join(self.path, 'hooks', 'post-commit'), hook, executable=True):
+            self.save_sync_manifest(manifest)
 
         super(SVNRepository, self).sync()
 
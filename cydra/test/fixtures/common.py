@@ -74,3 +74,14 @@ class HtpasswdUsers(FixtureWithTempPath):
 
         configDict.setdefault('components', {}).setdefault('cydra.permission.htpasswd.HtpasswdUsers', {})['file'] = path
         configDict.setdefault('components', {}).setdefault('cydra.permission.InternalPermissionProvider', True)
+
+
+class TieredSubjectCache(FixtureWithTempPath):
+    """Configure Cydra to use an in-memory and a SQLite based subject cache"""
+
+    def setUp(self, configDict):
+        super(TieredSubjectCache, self).setUp(configDict)
+
+        configDict.setdefault('components', {}).setdefault('cydra.caching.subject.MemorySubjectCache', True)
+        configDict.setdefault('components', {}).setdefault('cydra.caching.subject.SQLiteSubjectCache', {})['path'] = os.path.join(self.path, 'subjects.sqlite')
+        configDict.setdefault('extensionpointorder', {})['ISubjectCache'] = ['MemorySubjectCache', 'SQLiteSubjectCache']
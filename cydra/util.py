@@ -16,9 +16,13 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with Cydra.  If not, see http://www.gnu.org/licenses
+import os
 import time
+import stat
 import tarfile
 import os.path
+import tempfile
+import threading
 
 
 class NoopArchiver(object):
@@ -117,12 +121,24 @@ class SimpleCacheItem(object):
 class SimpleCache(object):
     """A simple in-memory cache
 
-    This class does not do any locking. This means that keys should map to
-    relatively stable, immutable values"""
-    def __init__(self, lifetime=30, killtime=None, maxsize=100):
+    The cache can be shared between threads. It does not lock the values
+    though, keys should map to relatively stable, immutable values
+
+    If on_remove is given, it is called with key and value of every item
+    that expires or gets evicted. It is called without the cache lock held
+
+    All items are checked for expiry on every lookup. With a sweep_interval,
+    lookups only check the item looked up and all items are checked at most
+    every sweep_interval seconds"""
+
+    def __init__(self, lifetime=30, killtime=None, maxsize=100, on_remove=None, sweep_interval=0):
         self.data = {}
         self.lifetime = lifetime
         self.maxsize = maxsize
+        self.on_remove = on_remove
+        self.sweep_interval = sweep_interval
+        self._last_sweep = 0
+        self._lock = threading.Lock()
 
         if killtime is None:
             self.killtime = lifetime * 10
@@ -130,40 +146,75 @@ class SimpleCache(object):
             self.killtime = killtime
 
     def set(self, key, value):
-        self.data[key] = SimpleCacheItem(value)
+        removed = []
+        with self._lock:
+            self.data[key] = SimpleCacheItem(value)
 
-        if len(self.data) > self.maxsize:
-            self._remove_oldest()
+            if len(self.data) > self.maxsize:
+                self._remove_oldest(removed)
+        self._notify(removed)
 
     def cached(self, key, func):
-        self._remove_old()
-        if key in self.data:
-            return self.data[key].value
+        item = self._lookup(key)
+        if item is not None:
+            return item.value
         else:
+            # func runs without the lock, concurrent misses may call it more than once
             res = func()
             self.set(key, res)
             return res
 
     def get(self, key, default=None):
-        self._remove_old()
-        item = self.data.get(key)
+        item = self._lookup(key)
         if item is not None:
             return item.value
         else:
             return default
 
     def __contains__(self, key):
-        self._remove_old()
-        return key in self.data
+        return self._lookup(key) is not None
 
-    def _remove_old(self):
-        t = time.time()
+    def age(self, key):
+        """Seconds since the item has been set or None if it is not cached"""
+        item = self.data.get(key)
+        if item is not None:
+            return time.time() - item.creation
+
+    def remove(self, key):
+        """Remove an item from the cache if present"""
+        with self._lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        """Remove all items from the cache"""
+        with self._lock:
+            self.data.clear()
+
+    def _expired(self, item, t):
+        return t - item.creation > self.killtime or t - item.last_access > self.lifetime
+
+    def _lookup(self, key):
+        removed = []
+        with self._lock:
+            t = time.time()
+            if t - self._last_sweep >= self.sweep_interval:
+                self._remove_old(removed)
+
+            item = self.data.get(key)
+            if item is not None and self._expired(item, t):
+                self._evict(key, removed)
+                item = None
+        self._notify(removed)
+        return item
+
+    def _remove_old(self, removed):
+        t = self._last_sweep = time.time()
 
         for key, item in self.data.items():
-            if t - item.creation > self.killtime or t - item.last_access > self.lifetime:
-                del(self.data[key])
+            if self._expired(item, t):
+                self._evict(key, removed)
 
-    def _remove_oldest(self):
+    def _remove_oldest(self, removed):
         mintime = time.time()
         minkey = None
 
@@ -173,4 +224,88 @@ class SimpleCache(object):
                 minkey = key
 
         if minkey is not None:
-            del(self.data[minkey])
+            self._evict(minkey, removed)
+
+    def _evict(self, key, removed):
+        item = self.data.pop(key, None)
+        if item is not None:
+            removed.append((key, item._value))
+
+    def _notify(self, removed):
+        if self.on_remove is not None:
+            for key, value in removed:
+                self.on_remove(key, value)
+
+
+# the umask can only be read by setting it, which affects all threads.
+# Read it once on import instead of on every write
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def atomic_write(path, data):
+    """Replace the contents of a file without readers ever seeing a partial file
+
+    The data is written to a temporary file next to path, which is then
+    renamed over it. The mode of an existing file is kept."""
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        mode = 0666 & ~_umask
+
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            os.fchmod(f.fileno(), mode)
+        os.rename(tmpname, path)
+    except:
+        os.remove(tmpname)
+        raise
+
+
+class FileParseCache(object):
+    """Caches the result of parsing files until they change
+
+    A file counts as changed if its inode, mtime or size differ. Files
+    written with :func:`atomic_write` get a new inode on every write, so
+    changes within the mtime resolution are noticed as well.
+
+    :param parse: callable taking a path and returning the parsed contents
+    :param default: returned for files that do not exist
+    :param maxsize: max number of files kept
+    """
+
+    def __init__(self, parse, default=None, maxsize=1000):
+        self.parse = parse
+        self.default = default
+        self.maxsize = maxsize
+
+        self._lock = threading.Lock()
+        self.data = {}
+
+    def get(self, path):
+        """Parsed contents of the file at path"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.invalidate(path)
+            return self.default
+
+        key = (st.st_ino, st.st_mtime, st.st_size)
+        with self._lock:
+            entry = self.data.get(path)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+
+        value = self.parse(path)
+        with self._lock:
+            if len(self.data) >= self.maxsize:
+                self.data.clear()
+            self.data[path] = (key, value)
+        return value
+
+    def invalidate(self, path):
+        """Forget the file at path"""
+        with self._lock:
+            self.data.pop(path, None)
@@ -67,8 +67,9 @@ def create_app(cyd=None):
     # patch static file resolver
     patch_static(app)
 
-    # secret key for cookies
-    app.secret_key = os.urandom(24)
+    # secret key for cookies. Has to be configured to share sessions
+    # between processes and to keep them across restarts
+    app.secret_key = cyd.config.get('web').get('secret_key') or os.urandom(24)
 
     # consider the cydra instance to be a form of configuration
     # and therefore store it in the config dict.
@@ -17,6 +17,10 @@
 # You should have received a copy of the GNU General Public License
 # along with Cydra.  If not, see http://www.gnu.org/licenses
 import urllib
+import time
+import hmac
+import hashlib
+import base64
 
 import cydra
 from cydra.util import SimpleCache
@@ -53,6 +57,76 @@ class InsufficientPermissions(Exception):
     pass
 
 
+class AuthTokenSigner(object):
+    """Creates and verifies signed authentication tokens
+
+    A token carries a userid and an expiry timestamp signed with HMAC-SHA256.
+    Verifying a token therefore requires no password check. All processes
+    sharing the secret accept each other's tokens. If a salt is given, it is
+    part of the signature. Using a value that changes along with the password
+    of the user invalidates all tokens of the user on a password change."""
+
+    def __init__(self, secret, lifetime=8 * 60 * 60):
+        if isinstance(secret, unicode):
+            secret = secret.encode('utf-8')
+        self.secret = secret
+        self.lifetime = lifetime
+
+    def _sign(self, payload, salt):
+        if salt:
+            if isinstance(salt, unicode):
+                salt = salt.encode('utf-8')
+            payload = payload + '\0' + salt
+        return hmac.new(self.secret, payload, hashlib.sha256).hexdigest()
+
+    def create(self, userid, salt=None):
+        """Create a token for the given userid"""
+        if isinstance(userid, unicode):
+            userid = userid.encode('utf-8')
+        payload = base64.urlsafe_b64encode(userid) + '.' + str(int(time.time() + self.lifetime))
+        return payload + '.' + self._sign(payload, salt)
+
+    def userid(self, token):
+        """The userid the token claims to be for, without verifying it"""
+        try:
+            return base64.urlsafe_b64decode(token.split('.', 1)[0]).decode('utf-8')
+        except (ValueError, TypeError, UnicodeError):
+            return None
+
+    def _decode(self, token, salt):
+        try:
+            payload, signature = token.rsplit('.', 1)
+            if not hmac.compare_digest(self._sign(payload, salt), signature):
+                return None
+
+            userid, expires = payload.split('.', 1)
+            expires = int(expires)
+            if expires < time.time():
+                return None
+
+            return base64.urlsafe_b64decode(userid).decode('utf-8'), expires
+        except (ValueError, TypeError, UnicodeError):
+            return None
+
+    def verify(self, token, salt=None):
+        """Verify the token
+
+        :returns: the userid or None if the token is invalid or expired"""
+        decoded = self._decode(token, salt)
+        if decoded is not None:
+            return decoded[0]
+
+    def needs_renewal(self, token, userid, salt=None):
+        """Check if a new token should be issued to a client presenting token
+
+        This is the case if the token is missing, invalid, for another user
+        or has less than half of its lifetime left"""
+        decoded = self._decode(token, salt) if token else None
+        if decoded is None or decoded[0] != userid:
+            return True
+        return decoded[1] - time.time() < self.lifetime / 2
+
+
 class AuthenticationMiddleware(object):
 
     def __init__(self, cyd, next_app):
@@ -67,6 +141,7 @@ class AuthenticationMiddleware(object):
         """WSGI Middleware"""
 
         user = self.authenticator(environ)
+        start_response = self.authenticator.wrap_start_response(environ, start_response)
 
         try:
             return self.next_app(environ, start_response)
@@ -80,6 +155,22 @@ class AuthenticationMiddleware(object):
 
 
 class HTTPBasicAuthenticator(object):
+    """Authenticates requests using HTTP Basic auth
+
+    If auth_token_secret is set in the web configuration, a signed token is
+    issued after a successful login. Clients presenting this token as cookie or
+    as bearer token are authenticated without checking their password again.
+    Tokens are only accepted for users that can still authenticate and are
+    bound to the auth_token_salt of the user, if it has one.
+    An explicit Basic Authorization header always takes precedence over a token.
+    A new token is only issued if the client did not present a valid one or
+    it is about to expire. Use :meth:`wrap_start_response` to send the token
+    to the client.
+
+    Configuration (web section):
+    - auth_token_secret: Secret used to sign tokens. Has to be the same for all processes
+    - auth_token_lifetime: Validity of a token in seconds. Defaults to 8 hours
+    - auth_token_cookie: Name of the cookie. Defaults to cydra_auth"""
 
     def __init__(self, cyd=None):
         if cyd is None:
@@ -88,6 +179,80 @@ class HTTPBasicAuthenticator(object):
         self.cydra = self.compmgr = cyd
         self.cache = SimpleCache()
 
+        webconfig = self.cydra.config.get('web', {})
+        self.token_signer = None
+        self.token_cookie = webconfig.get('auth_token_cookie', 'cydra_auth')
+        if webconfig.get('auth_token_secret'):
+            self.token_signer = AuthTokenSigner(webconfig['auth_token_secret'],
+                                                webconfig.get('auth_token_lifetime', 8 * 60 * 60))
+
+    def _get_cookie(self, environ):
+        for cookie in environ.get('HTTP_COOKIE', '').split(';'):
+            name, _, value = cookie.strip().partition('=')
+            if name == self.token_cookie:
+                return value
+
+    def _get_token(self, environ):
+        author = environ.get('HTTP_AUTHORIZATION', '').strip()
+        if author[:7].lower() == 'bearer ':
+            return author[7:].strip()
+        elif author:
+            # explicit credentials win over a cookie
+            return None
+        return self._get_cookie(environ)
+
+    def _authenticate_token(self, environ):
+        token = self._get_token(environ)
+        if not token:
+            return None
+
+        userid = self.token_signer.userid(token)
+        if not userid:
+            logger.debug("Invalid auth token supplied")
+            return None
+
+        user = self.cache.get(('token', userid))
+        if user is None:
+            user = self.cydra.get_user(userid=userid)
+            # get_user returns a dummy for users that no longer exist
+            if user.is_guest or not user.valid_for_authentication:
+                logger.debug("Auth token for unknown user %s supplied", userid)
+                return None
+            self.cache.set(('token', userid), user)
+
+        if self.token_signer.verify(token, user.auth_token_salt) != userid:
+            logger.debug("Invalid or expired auth token supplied")
+            return None
+
+        logger.debug('Valid auth token for %s (%s)', user.full_name, user.userid)
+        return user
+
+    def _issue_token(self, environ, user):
+        if self.token_signer is None:
+            return
+
+        salt = user.auth_token_salt
+        if self.token_signer.needs_renewal(self._get_cookie(environ), user.userid, salt):
+            environ['cydra.auth_token'] = self.token_signer.create(user.userid, salt)
+
+    def wrap_start_response(self, environ, start_response):
+        """Wrap start_response to set the cookie for an issued auth token"""
+        if self.token_signer is None:
+            return start_response
+
+        def token_start_response(status, headers, exc_info=None):
+            token = environ.get('cydra.auth_token')
+            if token is not None:
+                cookie = '%s=%s; Path=/; Max-Age=%d; HttpOnly' % (self.token_cookie, token, self.token_signer.lifetime)
+                if environ.get('wsgi.url_scheme') == 'https':
+                    cookie += '; Secure'
+                headers = list(headers) + [('Set-Cookie', cookie)]
+            if exc_info is None:
+                return start_response(status, headers)
+            return start_response(status, headers, exc_info)
+
+        return token_start_response
+
     def __call__(self, environ):
         # default to guest
         environ['cydra_user'] = self.cydra.get_user(userid='*')
@@ -97,6 +262,13 @@ class HTTPBasicAuthenticator(object):
         userid = environ.get('REMOTE_USER', None)
         logger.debug('Remote user: "%s"', str(userid))
 
+        if userid is None and self.token_signer is not None:
+            user = self._authenticate_token(environ)
+            if user is not None:
+                environ['REMOTE_USER'] = user.userid
+                environ['cydra_user'] = user
+                return user
+
         if userid is None:
             # Nothing already set. Perform HTTP auth ourselves
             author = environ.get('HTTP_AUTHORIZATION', None)
@@ -118,6 +290,7 @@ class HTTPBasicAuthenticator(object):
                 logger.debug('Author header found in cache, user: %s (%s)', user.full_name, user.userid)
                 environ['REMOTE_USER'] = user.userid
                 environ['cydra_user'] = user
+                self._issue_token(environ, user)
                 return user
 
             userid, pw = userpw_base64.decode('base64').split(':', 1)
@@ -151,6 +324,7 @@ class HTTPBasicAuthenticator(object):
                 # and cache
                 logger.debug('Caching login data for %s (%s)', user.full_name, user.userid)
                 self.cache.set(userpw_base64, user)
+                self._issue_token(environ, user)
 
                 return user
             else:
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of Cydra.
+#
+# Cydra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cydra is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cydra.  If not, see http://www.gnu.org/licenses
+"""Clone a repository with many concurrent clients over smart HTTP
+
+Serves the directory containing the repository with the git HTTP backend
+in a threaded WSGI server and clones it concurrently. Reports wall time,
+clone latencies and the peak number of threads in the server process.
+
+Usage: concurrent_clone.py [-c CLIENTS] [-e poll|threaded] path/to/repo.git
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+from optparse import OptionParser
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+
+from cydraplugins.githttp import subprocessio
+from cydraplugins.githttp.git_http_backend import assemble_WSGI_git_app
+
+engines = {'poll': subprocessio.PollingSubprocessIO, 'threaded': subprocessio.SubprocessIOChunker}
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] path/to/repo.git")
+    parser.add_option('-c', '--clients', type='int', default=50, help="Number of concurrent clones")
+    parser.add_option('-e', '--engine', choices=engines.keys(), default='poll', help="poll or threaded")
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error("repository path required")
+
+    repo = os.path.abspath(args[0])
+    app = assemble_WSGI_git_app(content_path=os.path.dirname(repo),
+                                subprocess_chunker=engines[options.engine])
+
+    server = make_server('127.0.0.1', 0, app, server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    url = 'http://127.0.0.1:%d/%s' % (server.server_port, os.path.basename(repo))
+
+    peak_threads = [threading.active_count()]
+    done = threading.Event()
+
+    def sample_threads():
+        while not done.is_set():
+            peak_threads[0] = max(peak_threads[0], threading.active_count())
+            time.sleep(0.01)
+
+    sampler = threading.Thread(target=sample_threads)
+    sampler.daemon = True
+    sampler.start()
+
+    target = tempfile.mkdtemp(prefix='cydrabench_')
+    latencies = []
+    failures = []
+
+    def clone(i):
+        start = time.time()
+        with open(os.devnull, 'w') as devnull:
+            ret = subprocess.call(['git', 'clone', '--quiet', '--bare', url, os.path.join(target, str(i))],
+                                  stdout=devnull, stderr=devnull)
+        if ret:
+            failures.append(i)
+        else:
+            latencies.append(time.time() - start)
+
+    try:
+        start = time.time()
+        clients = [threading.Thread(target=clone, args=(i,)) for i in range(options.clients)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        wall = time.time() - start
+    finally:
+        done.set()
+        server.shutdown()
+        shutil.rmtree(target, ignore_errors=True)
+
+    latencies.sort()
+    print "engine:        %s" % options.engine
+    print "clients:       %d (%d failed)" % (options.clients, len(failures))
+    print "wall time:     %.2fs" % wall
+    if latencies:
+        print "latency p50:   %.2fs" % latencies[len(latencies) // 2]
+        print "latency max:   %.2fs" % latencies[-1]
+    # the sampler and the clone threads themselves are included
+    print "peak threads:  %d (%d clone threads)" % (peak_threads[0], options.clients)
+
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
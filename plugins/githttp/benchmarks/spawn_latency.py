@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of Cydra.
+#
+# Cydra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cydra is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cydra.  If not, see http://www.gnu.org/licenses
+"""Measure the latency of spawning and running git
+
+Compares a shell command line with an argv list and the ProcessLauncher.
+
+Usage: spawn_latency.py [-n ITERATIONS] [git]
+"""
+import sys
+import time
+import subprocess
+from optparse import OptionParser
+
+from cydra.process import ProcessLauncher
+
+
+def measure(iterations, spawn):
+    spawn()  # warm up
+    start = time.time()
+    for i in xrange(iterations):
+        spawn()
+    return (time.time() - start) / iterations
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] [git]")
+    parser.add_option('-n', '--iterations', type='int', default=200)
+    (options, args) = parser.parse_args()
+
+    git = args[0] if args else 'git'
+    launcher = ProcessLauncher()
+    limited = ProcessLauncher(rlimits={'nofile': 1024})
+
+    def run(popen, cmd, **kwargs):
+        popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs).communicate()
+
+    variants = [
+        ('shell', lambda: run(subprocess.Popen, '"%s" --version' % git, shell=True)),
+        ('argv', lambda: run(subprocess.Popen, [git, '--version'])),
+        ('argv, close_fds', lambda: run(subprocess.Popen, [git, '--version'], close_fds=True)),
+        ('launcher', lambda: run(launcher.popen, [git, '--version'])),
+        ('launcher, rlimits', lambda: run(limited.popen, [git, '--version'])),
+    ]
+
+    for name, spawn in variants:
+        print "%-20s %.3f ms" % (name, measure(options.iterations, spawn) * 1000)
+
+    stats = launcher.stats
+    print "launcher stats: %d spawned, avg spawn %.3f ms, max %.3f ms" % (
+        stats['spawned'], stats['spawn_time_avg'] * 1000, stats['spawn_time_max'] * 1000)
+
+if __name__ == '__main__':
+    sys.exit(main())
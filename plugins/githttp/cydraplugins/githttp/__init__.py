@@ -16,13 +16,20 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with Cydra.  If not, see http://www.gnu.org/licenses
+import re
 import urlparse
 import os.path
 
 from git_http_backend import GitHTTPBackendInfoRefs, GitHTTPBackendSmartHTTP, StaticWSGIServer
+import subprocessio
+from advertisement import AdvertisementCache
+from admission import AdmissionController, AdmittedResponse
+from packcache import PackCache
 
 import cydra
 from cydra.component import Component, implements
+from cydra.repository.git import GitRepositories
+from cydra.util import SimpleCache
 from cydra.web.wsgihelper import HTTPBasicAuthenticator, move_projectname_into_scriptname
 from cydra.web.frontend.hooks import IRepositoryViewerProvider, IProjectFeaturelistItemProvider
 
@@ -30,7 +37,34 @@ import logging
 logger = logging.getLogger(__name__)
 
 class GitIntegration(Component):
-    """Cydra component for integration between Git and Cydra"""
+    """Cydra component for integration between Git and Cydra
+
+    Configuration:
+    - url_base: Base URL of the git HTTP server
+    - io_engine: How git subprocesses are driven by GitHTTP. 'poll' (default) multiplexes
+      the pipes in the request thread, 'threaded' uses three helper threads per request
+    - chunk_size: Size of the chunks read from git and from request bodies. Defaults to 64KB
+    - buffer_size: Max amount of git output read ahead of the client. Defaults to 1MB
+    - gzip_response: gzip ref advertisements and static files if the client accepts it. Defaults to False
+    - gzip_min_size: Responses smaller than this are not compressed. Defaults to 1024
+    - gzip_level: zlib compression level. Defaults to 6
+    - advertisement_cache_size: Number of ref advertisements kept in memory. Defaults to 1000, 0 disables
+    - advertisement_cache_max_entry: Larger advertisements are not cached. Defaults to 4MB
+    - static_stat_cache_size: Number of files dumb HTTP keeps metadata of in memory. Defaults to 1024
+    - static_max_age: Seconds clients may cache objects and packs fetched over dumb HTTP. Defaults to one year
+    - pack_cache_dir: Directory upload-pack responses are cached in. Caching is off if not set
+    - pack_cache_size: Size budget of the pack cache. Defaults to 1GB
+    - pack_cache_max_entry: Larger responses are not cached. Defaults to 256MB
+    - resolve_cache_ttl: Seconds projects, repositories and access decisions of GitHTTP are cached. Defaults to 10.
+      Revoked permissions therefore keep granting access for up to this long
+    - resolve_cache_size: Max number of cached lookups. Defaults to 1000
+    - lookup_threads: Threads the tornado server looks up repositories and users on. Defaults to 8
+    - max_upload_packs: Max number of concurrent git upload-pack requests. Defaults to 0 (no limit)
+    - max_upload_packs_per_repository: Same limit per repository. Defaults to 0 (no limit)
+    - upload_pack_queue_size: Number of upload-pack requests waiting for a slot. Defaults to 100
+    - upload_pack_queue_timeout: Seconds a request waits for a slot before 503 is returned. Defaults to 30
+    - upload_pack_retry_after: Retry-After sent along with 503. Defaults to 10
+    """
 
     implements(IRepositoryViewerProvider)
     implements(IProjectFeaturelistItemProvider)
@@ -69,55 +103,103 @@ class GitHTTP(object):
         if 'base' not in config:
             raise Exception("git base path not configured")
 
-        self.git_inforefs_handler = GitHTTPBackendInfoRefs(content_path=config['base'], uri_marker='')
-        self.git_rpc_handler = GitHTTPBackendSmartHTTP(content_path=config['base'], uri_marker='')
-        self.static_handler = StaticWSGIServer(content_path=config['base'], uri_marker='')
+        self.http_config = http_config = cyd.config.get_component_config('cydraplugins.githttp.GitIntegration', {})
+        io_engines = {'poll': subprocessio.PollingSubprocessIO, 'threaded': subprocessio.SubprocessIOChunker}
+        io_engine = http_config.get('io_engine', 'poll')
+        if io_engine not in io_engines:
+            raise Exception("Unknown io_engine: %s" % io_engine)
+
+        # git is spawned through the launcher of the git repository provider
+        launcher = self.cydra[GitRepositories].launcher
+        handler_options = dict(content_path=config['base'], uri_marker='',
+                               git_path=config.get('gitcommand', 'git'), popen=launcher.popen,
+                               bufsize=http_config.get('chunk_size', 65536),
+                               buffer_size=http_config.get('buffer_size', 1048576),
+                               gzip_response=http_config.get('gzip_response', False),
+                               gzip_min_size=http_config.get('gzip_min_size', 1024),
+                               gzip_level=http_config.get('gzip_level', 6))
+
+        advertisement_cache = None
+        if http_config.get('advertisement_cache_size', 1000):
+            advertisement_cache = AdvertisementCache(size=http_config.get('advertisement_cache_size', 1000),
+                    max_entry_size=http_config.get('advertisement_cache_max_entry', 4 * 1024 * 1024))
+
+        pack_cache = None
+        if http_config.get('pack_cache_dir'):
+            pack_cache = PackCache(http_config['pack_cache_dir'],
+                                   max_size=http_config.get('pack_cache_size', 1024 * 1024 * 1024),
+                                   max_entry_size=http_config.get('pack_cache_max_entry', 256 * 1024 * 1024))
+
+        self.git_inforefs_handler = GitHTTPBackendInfoRefs(subprocess_chunker=io_engines[io_engine],
+                                                           advertisement_cache=advertisement_cache, **handler_options)
+        # update-server-info is run by cydra's post-receive hook
+        self.git_rpc_handler = GitHTTPBackendSmartHTTP(subprocess_chunker=io_engines[io_engine],
+                                                       update_server_info=False, pack_cache=pack_cache,
+                                                       **handler_options)
+        self.static_handler = StaticWSGIServer(stat_cache_size=http_config.get('static_stat_cache_size', 1024),
+                                               immutable_max_age=http_config.get('static_max_age', 31536000),
+                                               **handler_options)
+
+        ttl = http_config.get('resolve_cache_ttl', 10)
+        size = http_config.get('resolve_cache_size', 1000)
+        # dumb HTTP clients hit these for every object, so only sweep once a second
+        self.resolve_cache = SimpleCache(lifetime=ttl, killtime=ttl, maxsize=size, sweep_interval=1.0)
+        self.access_cache = SimpleCache(lifetime=ttl, killtime=ttl, maxsize=size, sweep_interval=1.0)
+
+        # limits concurrent upload-packs, None if unlimited
+        self.admission = AdmissionController.from_config(http_config)
 
         self.git_inforefs_handler.repo_auto_create = False
         self.git_rpc_handler.repo_auto_create = False
         self.static_handler.repo_auto_create = False
 
+    # /project[/repository[/path]]. For repositories, the paths handled
+    # by the git handlers are picked out right away. Files served statically
+    # must not contain empty, . or .. segments
+    route = re.compile(r'''^/*(?P<project>[^/]*)
+                           (?:/(?P<repository>[^/]*)
+                              (?:/(?:(?P<info_refs>info/refs)
+                                    |(?P<static>HEAD|(?:refs|objects|info)(?:/(?!\.\.?(?:/|$))[^/]+)+)
+                                    |(?P<rpc>git-[\w-]+))$
+                               |(?P<rest>/.*))?
+                           )?/*$''', re.X)
+
     def __call__(self, environ, start_response):
         """Process git request
         
         URLs are in the form of /project/repo.git
         """
 
-        url = path = environ.get('PATH_INFO', '')
-        query_string = environ.get('QUERY_STRING', '')
-        if query_string:
-            url += '?' + query_string
-
-        project = None
-        repository = None
+        path = environ.get('PATH_INFO', '')
+        match = self.route.match(path)
+        if match is None:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return 'Unknown Project'
 
-        # Project discovery
-        pathlets = path.strip('/').split('/')
-        if len(pathlets) > 0:
-            project = pathlets[0]
+        project_name, repository_name = match.group('project', 'repository')
+        if repository_name is not None and repository_name[-4:] == '.git':
+            project, repository = self.resolve(project_name, repository_name[:-4])
         else:
-            start_response('404 Not Found', [('Content-Type', 'text/plain')])
-            return 'No project specified'
+            project, repository = self.resolve(project_name)
 
-        project = self.cydra.get_project(project)
         if project is None:
             start_response('404 Not Found', [('Content-Type', 'text/plain')])
             return 'Unknown Project'
 
+        routing_args = environ.setdefault('wsgiorg.routing_args', ([], {}))[1]
         # add repo base for project to routing args
-        environ.setdefault('wsgiorg.routing_args', ([], {}))[1]['repository_base'] = os.path.join(self.config['base'], project.name)
+        routing_args['repository_base'] = os.path.join(self.config['base'], project.name)
         # add site_name to routing args
-        environ.setdefault('wsgiorg.routing_args', ([], {}))[1]['site_name'] = project.name
+        routing_args['site_name'] = project.name
 
         # Authentication
         user = self.authenticator(environ)
+        start_response = self.authenticator.wrap_start_response(environ, start_response)
         logger.debug('User "%s" is attempting to access project "%s"', str(user), project.name)
 
         # Repository discovery
-        if len(pathlets) > 1:
-            repository = pathlets[1]
-
-            if repository[-4:] != '.git':
+        if repository_name:
+            if repository_name[-4:] != '.git':
                 # assume its for static media of the viewer
                 if self.gitviewer is not None:
                     move_projectname_into_scriptname(environ, project.name)
@@ -126,7 +208,6 @@ class GitHTTP(object):
                     start_response('404 Not Found', [('Content-Type', 'text/plain')])
                     return 'No gitviewer configured'
 
-            repository = project.get_repository('git', repository[:-4])
             if repository is None:
                 start_response('404 Not Found', [('Content-Type', 'text/plain')])
                 return 'Unknown repository'
@@ -146,55 +227,59 @@ class GitHTTP(object):
         # old or smart HTTP backends, otherwise forward to gitviewer
         #
         git_command = None
-        working_path = project.name + '/' + repository.name + '.git' if repository else project.name  # this is a URL. Dont use os.path.join
+        working_path = project.name + '/' + repository.name + '.git'  # this is a URL. Dont use os.path.join
         handler = None
 
-        # add working path to routing args
-        environ.setdefault('wsgiorg.routing_args', ([], {}))[1]['working_path'] = working_path
-
-        if pathlets[2:4] == ['info', 'refs']:
+        if match.group('info_refs'):
             # old style http. /project/repo/info/refs?service=git-command
-            git_command = urlparse.parse_qs(query_string).get('service', [''])[0]
+            git_command = urlparse.parse_qs(environ.get('QUERY_STRING', '')).get('service', [''])[0]
             if not git_command:
                 git_command = "DUMMY-static-read"
-                working_path = path
+                working_path = 'info/refs'
                 handler = self.static_handler
             else:
                 logger.debug("repo path = %s" % working_path)
                 handler = self.git_inforefs_handler
 
-        elif len(pathlets) > 2 and pathlets[2] == 'refs':
-            # old style http /project/repo/refs/*
+        elif match.group('static'):
+            # old style http /project/repo/{HEAD,refs/*,objects/*,info/*}
             git_command = "DUMMY-static-read"
-            working_path = path
+            working_path = match.group('static')
             handler = self.static_handler
 
-        elif len(pathlets) > 2 and pathlets[2][:4] == 'git-':
+        elif match.group('rpc'):
             # smart HTTP. /project/repo/git-command
-            git_command = pathlets[2]
+            git_command = match.group('rpc')
             handler = self.git_rpc_handler
 
-        # add git command to routing args
-        environ.setdefault('wsgiorg.routing_args', ([], {}))[1]['git_command'] = git_command
+        # add working path and git command to routing args. For static files,
+        # the working path is relative to the repository
+        routing_args['working_path'] = working_path
+        routing_args['git_command'] = git_command
+        # the repository exists, the git handlers do not need to look for it.
+        # Static files are only served from within this repository
+        routing_args['repository_path'] = repository.path
 
         # authorization
         logger.debug('User "%s" is attempting to execute git command "%s"', str(user), str(git_command))
 
         if git_command in ['git-upload-pack', 'DUMMY-static-read']:
             # read
-            if repository.has_read_access(user):
+            if self.has_access(repository, user, 'read'):
+                if handler is self.git_rpc_handler and self.admission is not None:
+                    return self.admit(environ, start_response, handler, repository, user)
                 return handler(environ, start_response)
             else:
                 return self.require_authorization(environ, start_response)
         elif git_command in ['git-receive-pack']:
             # write
-            if repository.has_write_access(user):
+            if self.has_access(repository, user, 'write'):
                 return handler(environ, start_response)
             else:
                 return self.require_authorization(environ, start_response)
         else:
             if self.gitviewer is not None:
-                if repository and repository.has_read_access(user):
+                if self.has_access(repository, user, 'read'):
                     # For the viewer, we transform the URL a bit. 
                     # /some/path/project/repository/more
                     #  SCRIPT   | PATH INFO        
@@ -215,6 +300,55 @@ class GitHTTP(object):
                 start_response('400 Bad Request', [('Content-Type', 'text/plain')])
                 return 'Unknown git command: ' + str(git_command)
 
+    def resolve(self, project_name, repository_name=None):
+        """Look up the project and its git repository
+
+        Found ones are cached for a few seconds, dumb HTTP clients fetch
+        every object with a separate request"""
+        key = (project_name, repository_name)
+        result = self.resolve_cache.get(key)
+        if result is not None:
+            return result
+
+        project = self.cydra.get_project(project_name)
+        repository = None
+        if project is not None and repository_name is not None:
+            repository = project.get_repository('git', repository_name)
+            if repository is None:
+                return project, None
+
+        if project is not None:
+            self.resolve_cache.set(key, (project, repository))
+        return project, repository
+
+    def has_access(self, repository, user, mode):
+        """Whether the user has read or write access to the repository. Cached like :meth:`resolve`"""
+        key = (repository.project.name, repository.name, user.id if user is not None else None, mode)
+        allowed = self.access_cache.get(key)
+        if allowed is None:
+            if mode == 'write':
+                allowed = repository.has_write_access(user)
+            else:
+                allowed = repository.has_read_access(user)
+            self.access_cache.set(key, allowed)
+        return allowed
+
+    def admit(self, environ, start_response, handler, repository, user):
+        """Run the handler once the admission controller lets the request through"""
+        # guests are told apart by address so they queue fairly as well
+        owner = environ.get('REMOTE_ADDR') if user is None or user.is_guest else user.id
+        slot = self.admission.acquire(repository.path, owner)
+        if slot is None:
+            start_response('503 Service Unavailable', [('Content-Type', 'text/plain'),
+                                                       ('Retry-After', str(self.admission.retry_after))])
+            return 'Too many concurrent requests, try again later'
+
+        try:
+            return AdmittedResponse(handler(environ, start_response), slot)
+        except:
+            slot.release()
+            raise
+
     def require_authorization(self, environ, start_response):
         start_response('401 Unauthorized', [('Content-Type', 'text/plain'), ('WWW-Authenticate', 'Basic realm="' + self.compmgr.config.get('web').get('auth_realm').encode('utf-8') + '"')])
         return 'Authorization needed to access this repository'
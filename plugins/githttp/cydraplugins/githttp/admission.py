@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of Cydra.
+#
+# Cydra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cydra is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cydra.  If not, see http://www.gnu.org/licenses
+import time
+import threading
+from collections import deque, OrderedDict
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Slot(object):
+    """An admitted request. Has to be released once the work is done"""
+
+    def __init__(self, controller, repository):
+        self.controller = controller
+        self.repository = repository
+        self.released = False
+
+    def release(self):
+        """Give the slot back. Calling this more than once has no effect"""
+        self.controller._release(self)
+
+
+class Waiter(object):
+    """A queued request"""
+
+    def __init__(self, controller, repository, owner, on_admit):
+        self.controller = controller
+        self.repository = repository
+        self.owner = owner
+        self.on_admit = on_admit
+        self.enqueued = time.time()
+
+    def cancel(self):
+        """Remove the waiter from the queue
+
+        :returns: False if the request has already been admitted"""
+        return self.controller._cancel(self)
+
+
+class AdmittedResponse(object):
+    """Response iterable releasing the slot when the response is closed"""
+
+    def __init__(self, iterable, slot):
+        self.iterable = iterable
+        self.slot = slot
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            self.slot.release()
+
+
+class AdmissionController(object):
+    """Limits the number of concurrently running requests
+
+    Requests exceeding the global or per repository limit are queued. Queued
+    requests are admitted round-robin across owners (usually users), so a
+    single user cloning a lot can not starve everybody else.
+
+    :param max_active: Max number of concurrent requests, 0 for no limit
+    :param max_active_per_repository: Max number of concurrent requests per repository, 0 for no limit
+    :param max_queue: Max number of waiting requests. Further requests are rejected
+    :param max_wait: Seconds a request waits for admission before it is rejected
+    :param retry_after: Seconds clients are told to wait when rejected
+    """
+
+    def __init__(self, max_active=0, max_active_per_repository=0, max_queue=100, max_wait=30, retry_after=10):
+        self.max_active = max_active
+        self.max_active_per_repository = max_active_per_repository
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+
+        self._lock = threading.Lock()
+        self.active = 0
+        self.active_per_repository = {}
+        self.queues = OrderedDict()
+        self.queued = 0
+
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    @classmethod
+    def from_config(cls, config):
+        """Create a controller from the GitIntegration config. Returns None if no limit is configured"""
+        max_active = config.get('max_upload_packs', 0)
+        max_active_per_repository = config.get('max_upload_packs_per_repository', 0)
+        if not max_active and not max_active_per_repository:
+            return None
+
+        return cls(max_active=max_active, max_active_per_repository=max_active_per_repository,
+                   max_queue=config.get('upload_pack_queue_size', 100),
+                   max_wait=config.get('upload_pack_queue_timeout', 30),
+                   retry_after=config.get('upload_pack_retry_after', 10))
+
+    def _has_capacity(self, repository):
+        if self.max_active and self.active >= self.max_active:
+            return False
+        if self.max_active_per_repository and self.active_per_repository.get(repository, 0) >= self.max_active_per_repository:
+            return False
+        return True
+
+    def _take(self, repository):
+        self.active += 1
+        self.active_per_repository[repository] = self.active_per_repository.get(repository, 0) + 1
+        self.admitted += 1
+        return Slot(self, repository)
+
+    def try_acquire(self, repository, owner, on_admit):
+        """Ask for admission without blocking
+
+        :param repository: key the per repository limit applies to
+        :param owner: key requests are queued fairly by, eg. the user id
+        :param on_admit: called with the slot once a queued request is admitted.
+                         This happens in the thread releasing the previous slot
+        :returns: a :class:`Slot` if admitted immediately, a :class:`Waiter` if queued
+                  or None if the queue is full"""
+        with self._lock:
+            # waiters are dispatched as soon as a slot frees up, so if there is
+            # capacity, nobody queued could have used it
+            if self._has_capacity(repository):
+                return self._take(repository)
+
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                logger.info("Admission queue full, rejecting request for %s by %s", repository, owner)
+                return None
+
+            waiter = Waiter(self, repository, owner, on_admit)
+            self.queues.setdefault(owner, deque()).append(waiter)
+            self.queued += 1
+            logger.debug("Queued request for %s by %s (%d waiting)", repository, owner, self.queued)
+            return waiter
+
+    def acquire(self, repository, owner, timeout=None):
+        """Wait for admission
+
+        :param timeout: seconds to wait, defaults to max_wait
+        :returns: a :class:`Slot` or None if the request has been rejected"""
+        admitted = []
+        event = threading.Event()
+
+        def on_admit(slot):
+            admitted.append(slot)
+            event.set()
+
+        result = self.try_acquire(repository, owner, on_admit)
+        if not isinstance(result, Waiter):
+            return result
+
+        event.wait(self.max_wait if timeout is None else timeout)
+        if result.cancel():
+            return None
+        # admitted just now, on_admit might still be running
+        event.wait()
+        return admitted[0]
+
+    def _cancel(self, waiter):
+        with self._lock:
+            queue = self.queues.get(waiter.owner)
+            if queue is None or waiter not in queue:
+                return False
+
+            queue.remove(waiter)
+            if not queue:
+                del self.queues[waiter.owner]
+            self.queued -= 1
+            self.timed_out += 1
+            self._account_wait(waiter)
+            return True
+
+    def _account_wait(self, waiter):
+        waited = time.time() - waiter.enqueued
+        self.waits += 1
+        self.wait_time += waited
+        self.max_wait_time = max(self.max_wait_time, waited)
+
+    def _release(self, slot):
+        admitted = []
+        with self._lock:
+            if slot.released:
+                return
+            slot.released = True
+
+            self.active -= 1
+            self.active_per_repository[slot.repository] -= 1
+            if not self.active_per_repository[slot.repository]:
+                del self.active_per_repository[slot.repository]
+
+            # go through the owners in round-robin order and admit the first
+            # waiter whose repository is below its limit. The owner moves to
+            # the end of the line.
+            while self.queued:
+                for owner, queue in self.queues.items():
+                    waiter = next((w for w in queue if self._has_capacity(w.repository)), None)
+                    if waiter is not None:
+                        break
+                else:
+                    break
+
+                queue.remove(waiter)
+                del self.queues[owner]
+                if queue:
+                    self.queues[owner] = queue
+                self.queued -= 1
+                self._account_wait(waiter)
+                admitted.append((waiter, self._take(waiter.repository)))
+
+        for waiter, new_slot in admitted:
+            try:
+                waiter.on_admit(new_slot)
+            except Exception:
+                logger.exception("Admission callback failed")
+                new_slot.release()
+
+    @property
+    def stats(self):
+        """Active, queued and rejected requests and time spent waiting in seconds"""
+        with self._lock:
+            return {'active': self.active,
+                    'queued': self.queued,
+                    'admitted': self.admitted,
+                    'rejected': self.rejected,
+                    'timed_out': self.timed_out,
+                    'wait_time_total': self.wait_time,
+                    'wait_time_max': self.max_wait_time,
+                    'wait_time_avg': self.wait_time / self.waits if self.waits else 0.0}
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of Cydra.
+#
+# Cydra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cydra is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cydra.  If not, see http://www.gnu.org/licenses
+import os
+import os.path
+
+from cydra.util import SimpleCache
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def _stat_key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_ino, st.st_size)
+
+
+def ref_state_fingerprint(repo_path):
+    """Cheap fingerprint of the refs of a bare repository
+
+    Consists of the stats of HEAD, packed-refs, config and every directory
+    below refs. Git updates loose refs by renaming a lock file into place,
+    which always changes the mtime of the containing directory.
+    """
+    fingerprint = [_stat_key(os.path.join(repo_path, name)) for name in ('HEAD', 'packed-refs', 'config')]
+
+    for dirpath, dirnames, filenames in os.walk(os.path.join(repo_path, 'refs')):
+        dirnames.sort()
+        fingerprint.append((dirpath, _stat_key(dirpath)))
+
+    return tuple(fingerprint)
+
+
+class TeeResponse(object):
+    """Response iterable passing chunks through while collecting them
+
+    Once the iterable is exhausted, on_complete is called with the complete
+    response unless it grew larger than max_size
+    """
+
+    def __init__(self, iterable, on_complete, max_size):
+        self.iterable = iterable
+        self.on_complete = on_complete
+        self.max_size = max_size
+
+    def __iter__(self):
+        chunks = []
+        size = 0
+        for chunk in self.iterable:
+            if chunks is not None:
+                size += len(chunk)
+                if size > self.max_size:
+                    chunks = None
+                else:
+                    chunks.append(chunk)
+            yield chunk
+
+        if chunks is not None:
+            self.on_complete(''.join(chunks))
+
+    def close(self):
+        if hasattr(self.iterable, 'close'):
+            self.iterable.close()
+
+
+class AdvertisementCache(object):
+    """In-memory cache for ref advertisements of git repositories
+
+    Advertisements are stored together with the fingerprint of the ref state
+    they were generated from and only served while the fingerprint matches.
+    """
+
+    def __init__(self, size=1000, lifetime=3600, max_entry_size=4 * 1024 * 1024):
+        self.cache = SimpleCache(lifetime=lifetime, killtime=lifetime, maxsize=size)
+        self.max_entry_size = max_entry_size
+
+    fingerprint = staticmethod(ref_state_fingerprint)
+
+    def get(self, repo_path, git_command, fingerprint):
+        """Returns the cached advertisement or None
+
+        git_command can be any hashable identifying the kind of advertisement"""
+        entry = self.cache.get((repo_path, git_command))
+        if entry is not None and entry[0] == fingerprint:
+            logger.debug("Serving cached %r advertisement for %s", git_command, repo_path)
+            return entry[1]
+
+    def tee(self, response, repo_path, git_command, fingerprint):
+        """Wrap the response iterable to store the advertisement once it is complete"""
+        def store(data):
+            # refs might have changed while the advertisement was generated
+            if self.fingerprint(repo_path) == fingerprint:
+                self.cache.set((repo_path, git_command), (fingerprint, data))
+
+        return TeeResponse(response, store, self.max_entry_size)
@@ -31,17 +31,18 @@ import sys
 
 import subprocess
 import subprocessio
+import zlib
 
-import tempfile
 from wsgiref.headers import Headers
 
 # needed for WSGI Selector
 import re
 import urlparse
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 # needed for static content server
 import time
+import threading
 import email.utils
 import mimetypes
 mimetypes.add_type('application/x-git-packed-objects-toc','.idx')
@@ -50,9 +51,107 @@ mimetypes.add_type('application/x-git-packed-objects','.pack')
 __version__=(1,7,0,4) # the number has no significance for this code's functionality.
 # The number means "I was looking at sources of that version of Git while coding"
 
+class BoundedInput(object):
+    '''
+    File-like exposing exactly `length` bytes of a WSGI input stream.
+
+    WSGI 1.0 servers do not guarantee an EOF at the end of the request body,
+    reads are therefore never allowed to go past Content-Length.
+    readinto() is offered if the underlying stream supports it.
+    '''
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+        if hasattr(stream, 'readinto'):
+            self.readinto = self._readinto
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if not size:
+            return b''
+        data = self.stream.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def _readinto(self, b):
+        if len(b) > self.remaining:
+            b = memoryview(b)[:self.remaining]
+        if not len(b):
+            return 0
+        n = self.stream.readinto(b) or 0
+        self.remaining -= n
+        return n
+
+class GzipResponse(object):
+    '''
+    WSGI response iterable compressing the chunks of another iterable with gzip.
+
+    head contains chunks already taken from the iterable. The iterable is
+    closed together with the response.
+    '''
+    def __init__(self, head, iterable, level=6):
+        self.head = head
+        self.iterable = iterable
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def __iter__(self):
+        compress = self.compressor.compress
+        for chunks in (self.head, self.iterable):
+            for chunk in chunks:
+                data = compress(chunk)
+                if data:
+                    yield data
+        yield self.compressor.flush()
+
+    def close(self):
+        if hasattr(self.iterable, 'close'):
+            self.iterable.close()
+
+class DeferredCommandResponse(object):
+    '''
+    WSGI response iterable running a command once another iterable has been
+    sent completely.
+
+    The command runs on a separate thread after the response is closed, so
+    neither the client nor the thread serving it wait for it.
+    '''
+    def __init__(self, iterable, command, popen=None):
+        self.iterable = iterable
+        self.command = command
+        self.popen = popen or subprocess.Popen
+        self.complete = False
+
+    def __iter__(self):
+        for chunk in self.iterable:
+            yield chunk
+        self.complete = True
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            if self.complete:
+                thread = threading.Thread(target=self.run)
+                thread.daemon = True
+                thread.start()
+
+    def run(self):
+        try:
+            with open(os.devnull, 'r+b') as devnull:
+                self.popen(self.command, stdin=devnull, stdout=devnull, stderr=devnull).wait()
+        except EnvironmentError:
+            pass
+
 class BaseWSGIClass(object):
     bufsize = 65536
+    # amount of git output read ahead of the client
+    buffer_size = 1048576
     gzip_response = False
+    # responses smaller than this are not worth compressing
+    gzip_min_size = 1024
+    gzip_level = 6
     canned_collection = {
         '304': '304 Not Modified',
         'not_modified': '304 Not Modified',
@@ -70,6 +169,8 @@ class BaseWSGIClass(object):
         '405': "405 Method Not Allowed",
         'method_not_allowed': "405 Method Not Allowed",
         '417':'417 Execution failed',
+        '416': '416 Requested Range Not Satisfiable',
+        'range_not_satisfiable': '416 Requested Range Not Satisfiable',
         'execution_failed':'417 Execution failed',
         '200': "200 OK",
         '501': "501 Not Implemented",
@@ -89,7 +190,76 @@ class BaseWSGIClass(object):
         start_response(self.canned_collection[code], headerbase)
         return ['']
 
-    def package_response(self, outIO, environ, start_response, headers = []):
+    def accepts_gzip(self, environ):
+        '''
+        Checks if the client accepts gzip content coding as per Accept-Encoding.
+        '''
+        for coding in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+            params = coding.strip().split(';')
+            if params[0].strip().lower() not in ('gzip', 'x-gzip', '*'):
+                continue
+            q = 1.0
+            for param in params[1:]:
+                name, _, value = param.strip().partition('=')
+                if name.strip() == 'q':
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+            if q > 0:
+                return True
+        return False
+
+    def compress_response(self, outIO, environ, headersIface):
+        '''
+        Returns a gzip'ed response iterable or None if outIO is better sent as is.
+        Compression needs to be enabled by gzip_response and accepted by the client.
+        '''
+        if not self.gzip_response:
+            return None
+
+        headersIface['Vary'] = 'Accept-Encoding'
+        if not self.accepts_gzip(environ):
+            return None
+
+        if hasattr(outIO, 'fileno'):
+            if os.fstat(outIO.fileno()).st_size < self.gzip_min_size:
+                return None
+            outIO.seek(0)
+            head, body = [], iter(lambda: outIO.read(self.bufsize), '')
+            close = outIO.close
+        elif hasattr(outIO, 'read'):
+            outIO.seek(0)
+            head, body = [], iter(lambda: outIO.read(self.bufsize), '')
+            close = getattr(outIO, 'close', None)
+        else:
+            # look at the beginning of the stream to decide
+            head, size, body = [], 0, iter(outIO)
+            for chunk in body:
+                head.append(chunk)
+                size += len(chunk)
+                if size >= self.gzip_min_size:
+                    break
+            else:
+                # everything read and too small. Send it as is
+                if hasattr(outIO, 'close'):
+                    outIO.close()
+                return head
+            close = getattr(outIO, 'close', None)
+
+        response = GzipResponse(head, body, self.gzip_level)
+        if close is not None:
+            response.close = close
+
+        del headersIface['Content-Length']
+        headersIface['Content-Encoding'] = 'gzip'
+        return response
+
+    def package_response(self, outIO, environ, start_response, headers = [], compressible = False):
+        '''
+        Sends outIO (a file-like or an iterable) as the response body.
+        If compressible is set, the response body may be gzip'ed.
+        '''
 
         newheaders = headers
         headers = [('Content-type', 'application/octet-stream')] # my understanding of spec. If unknown = binary
@@ -98,7 +268,13 @@ class BaseWSGIClass(object):
         for header in newheaders:
             headersIface[header[0]] = '; '.join(header[1:])
 
-        if hasattr(outIO,'fileno') and 'wsgi.file_wrapper' in environ:
+        compressed = None
+        if compressible:
+            compressed = self.compress_response(outIO, environ, headersIface)
+
+        if compressed is not None:
+            retobj = compressed
+        elif hasattr(outIO,'fileno') and 'wsgi.file_wrapper' in environ:
             outIO.seek(0)
             retobj = environ['wsgi.file_wrapper']( outIO, self.bufsize )
         elif hasattr(outIO,'read'):
@@ -275,6 +451,61 @@ class WSGIHandlerSelector(BaseWSGIClass):
         else:
             return self.canned_handlers(environ, start_response, 'not_found')
 
+class FileRange(object):
+    '''
+    WSGI response iterable sending length bytes of a file starting at offset.
+    '''
+    def __init__(self, file_like, offset, length, bufsize):
+        self.file_like = file_like
+        self.remaining = length
+        self.bufsize = bufsize
+        file_like.seek(offset)
+
+    def __iter__(self):
+        while self.remaining > 0:
+            data = self.file_like.read(min(self.bufsize, self.remaining))
+            if not data:
+                break
+            self.remaining -= len(data)
+            yield data
+
+    def close(self):
+        self.file_like.close()
+
+def parse_byte_range(value, size):
+    '''
+    Parses a Range header for a file of the given size.
+
+    Returns the (first, last) byte positions of a single range or None if
+    the header is to be ignored. Multiple ranges are not supported and
+    ignored as well. first is size or beyond if the range can not be satisfied.
+    '''
+    unit, _, ranges = value.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+
+    first, sep, last = ranges.strip().partition('-')
+    try:
+        if not sep:
+            return None
+        if not first:
+            # suffix range, the last n bytes
+            suffix = int(last)
+            if suffix <= 0:
+                return (size, size)
+            return (max(size - suffix, 0), size - 1)
+
+        first = int(first)
+        last = int(last) if last else size - 1
+    except ValueError:
+        return None
+
+    if first >= size:
+        return (first, first)
+    if first < 0 or last < first:
+        return None
+    return (first, min(last, size - 1))
+
 class StaticWSGIServer(BaseWSGIClass):
     """
     Copyright (c) 2010  Daniel Dotsenko <dotsa@hotmail.com>
@@ -284,8 +515,16 @@ class StaticWSGIServer(BaseWSGIClass):
 
     Relies on WSGIHandlerSelector for prepopulating some needed environ
     variables, cleaning up the URI, setting up default error handlers.
+
+    Loose objects and packs never change once written. They are served with
+    strong ETags and long cache lifetimes. Everything else (HEAD, refs,
+    info/*) has to be revalidated by clients. Single byte ranges are
+    supported, so interrupted pack downloads can be resumed.
     """
 
+    stat_cache_size = 1024
+    immutable_max_age = 31536000
+
     def __init__(self, **kw):
         '''
         Inputs:
@@ -298,8 +537,94 @@ class StaticWSGIServer(BaseWSGIClass):
             gzip_response (optional) (must be named arg)
                 Specify if we are to detect if gzip compression is supported
                 by client and gzip the output. False by default.
+                Packs and objects are never compressed.
+
+            gzip_min_size (optional)
+                Files smaller than this are sent uncompressed. Defaults to 1024.
+
+            gzip_level (optional)
+                zlib compression level. Defaults to 6.
+
+            stat_cache_size (optional)
+                Number of files whose metadata is kept in memory. Defaults to 1024.
+
+            immutable_max_age (optional)
+                Seconds clients may cache objects and packs. Defaults to one year.
         '''
         self.__dict__.update(kw)
+        self.content_root = os.path.abspath(self.content_path)
+        self.stat_cache = OrderedDict()
+        self.stat_cache_lock = threading.Lock()
+
+    # packs, their indexes and loose objects do not compress any further
+    precompressed_paths = re.compile(r'(\.pack|\.idx|objects/[0-9a-f]{2}/[0-9a-f]{38})$')
+    # named after their content, so they never change
+    immutable_paths = re.compile(r'objects/(?:(?P<fanout>[0-9a-f]{2})/(?P<object>[0-9a-f]{38})'
+                                 r'|pack/pack-(?P<pack>[0-9a-f]{40})\.(?P<ext>pack|idx))$')
+
+    def file_info(self, full_path, st):
+        '''
+        Metadata of a file needed for the response headers.
+        Returns a tuple of size, mtime, etag, Last-Modified, content type and immutability.
+        '''
+        match = self.immutable_paths.search(full_path)
+        if match:
+            if match.group('pack'):
+                name = match.group('pack') + '.' + match.group('ext')
+            else:
+                name = match.group('fanout') + match.group('object')
+            etag = '"%s-%x"' % (name.encode('ascii'), st.st_size)
+        else:
+            etag = 'W/"%x-%x"' % (int(st.st_mtime * 1000), st.st_size)
+
+        return (st.st_size, st.st_mtime, etag, email.utils.formatdate(st.st_mtime, usegmt=True),
+                mimetypes.guess_type(full_path)[0] or 'application/octet-stream', match is not None)
+
+    def cached_file_info(self, full_path):
+        with self.stat_cache_lock:
+            info = self.stat_cache.pop(full_path, None)
+            if info is not None:
+                self.stat_cache[full_path] = info
+            return info
+
+    def cache_file_info(self, full_path, info):
+        with self.stat_cache_lock:
+            self.stat_cache.pop(full_path, None)
+            self.stat_cache[full_path] = info
+            while len(self.stat_cache) > self.stat_cache_size:
+                self.stat_cache.popitem(last=False)
+
+    def uncache_file_info(self, full_path):
+        with self.stat_cache_lock:
+            self.stat_cache.pop(full_path, None)
+
+    def not_modified(self, environ, etag, mtime):
+        if_none = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none:
+            # weak comparison
+            tags = [tag.strip() for tag in if_none.split(',')]
+            return '*' in tags or etag.replace('W/', '') in [tag.replace('W/', '') for tag in tags]
+
+        if_modified = environ.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified:
+            since = email.utils.parsedate_tz(if_modified)
+            return since is not None and int(mtime) <= email.utils.mktime_tz(since)
+        return False
+
+    def requested_range(self, environ, size, etag, last_modified):
+        '''
+        The byte range requested by the client or None for the whole file.
+        '''
+        range_header = environ.get('HTTP_RANGE')
+        if not range_header or environ.get('REQUEST_METHOD') not in ('GET', 'HEAD'):
+            return None
+
+        # If-Range needs a strong validator to match
+        if_range = environ.get('HTTP_IF_RANGE')
+        if if_range and if_range.strip() not in (etag if not etag.startswith('W/') else None, last_modified):
+            return None
+
+        return parse_byte_range(range_header, size)
 
     def __call__(self, environ, start_response):
         selector_matches = (environ.get('wsgiorg.routing_args') or ([],{}))[1]
@@ -311,39 +636,117 @@ class StaticWSGIServer(BaseWSGIClass):
         else:
             path_info = environ.get('PATH_INFO', '').decode('utf8')
 
-        # this, i hope, safely turns the relative path into OS-specific, absolute.
-        full_path = os.path.abspath(os.path.join(self.content_path, path_info.strip('/')))
-        _pp = os.path.abspath(self.content_path)
+        # if routed to a repository, only its files are served and the
+        # working path is relative to it
+        trusted_path = selector_matches.get('repository_path')
+        if trusted_path:
+            root = os.path.abspath(trusted_path if isinstance(trusted_path, unicode) else trusted_path.decode('utf8'))
+        else:
+            root = self.content_root
+
+        # turns the relative path into an absolute one below the served root
+        full_path = os.path.normpath(os.path.join(root, path_info.strip('/')))
 
-        if not full_path.startswith(_pp):
+        if not full_path.startswith(root + os.sep):
             return self.canned_handlers(environ, start_response, 'forbidden')
-        if not os.path.isfile(full_path):
+
+        # objects and packs are answered from the cache as long as the
+        # client does not need the content. Everything else is checked on
+        # the opened file
+        file_like = None
+        info = self.cached_file_info(full_path)
+        if info is not None and info[5] and not os.path.exists(full_path):
+            # removed by gc or repack since it was cached
+            self.uncache_file_info(full_path)
             return self.canned_handlers(environ, start_response, 'not_found')
 
-        mtime = os.stat(full_path).st_mtime
-        etag, last_modified =  str(mtime), email.utils.formatdate(mtime)
+        if info is None or not info[5]:
+            try:
+                file_like = open(full_path, 'rb')
+                st = os.fstat(file_like.fileno())
+            except (IOError, OSError):
+                if file_like is not None:
+                    file_like.close()
+                self.uncache_file_info(full_path)
+                return self.canned_handlers(environ, start_response, 'not_found')
+
+            if info is None or info[:2] != (st.st_size, st.st_mtime):
+                info = self.file_info(full_path, st)
+                self.cache_file_info(full_path, info)
+
+        size, mtime, etag, last_modified, content_type, immutable = info
         headers = [
-            ('Content-type', 'text/plain'),
-            ('Date', email.utils.formatdate(time.time())),
+            ('Content-Type', content_type),
+            ('Date', email.utils.formatdate(time.time(), usegmt=True)),
             ('Last-Modified', last_modified),
-            ('ETag', etag)
+            ('ETag', etag),
+            ('Accept-Ranges', 'bytes'),
         ]
-        headersIface = Headers(headers)
-        headersIface['Content-Type'] = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+        if immutable:
+            headers.append(('Expires', email.utils.formatdate(time.time() + self.immutable_max_age, usegmt=True)))
+            headers.append(('Cache-Control', 'public, max-age=%d, immutable' % self.immutable_max_age))
+        else:
+            headers.append(('Expires', 'Fri, 01 Jan 1980 00:00:00 GMT'))
+            headers.append(('Pragma', 'no-cache'))
+            headers.append(('Cache-Control', 'no-cache, max-age=0, must-revalidate'))
 
-        if_modified = environ.get('HTTP_IF_MODIFIED_SINCE')
-        if if_modified and (email.utils.parsedate(if_modified) >= email.utils.parsedate(last_modified)):
-            return self.canned_handlers(environ, start_response, 'not_modified', headers)
-        if_none = environ.get('HTTP_IF_NONE_MATCH')
-        if if_none and (if_none == '*' or etag in if_none):
+        if self.not_modified(environ, etag, mtime):
+            if file_like is not None:
+                file_like.close()
             return self.canned_handlers(environ, start_response, 'not_modified', headers)
 
-        file_like = open(full_path, 'rb')
-        return self.package_response(file_like, environ, start_response, headers)
+        if file_like is None:
+            try:
+                file_like = open(full_path, 'rb')
+            except IOError:
+                # removed by gc or repack
+                self.uncache_file_info(full_path)
+                return self.canned_handlers(environ, start_response, 'not_found')
+
+        compressible = not self.precompressed_paths.search(full_path)
+        if compressible and self.gzip_response and self.accepts_gzip(environ):
+            # ranges of the compressed stream are not supported
+            headers.append(('Content-Length', str(size)))
+            return self.package_response(file_like, environ, start_response, headers, compressible = True)
+
+        byte_range = self.requested_range(environ, size, etag, last_modified)
+        if byte_range is None:
+            headers.append(('Content-Length', str(size)))
+            return self.package_response(file_like, environ, start_response, headers)
+
+        first, last = byte_range
+        if first >= size:
+            file_like.close()
+            headers.append(('Content-Range', 'bytes */%d' % size))
+            return self.canned_handlers(environ, start_response, 'range_not_satisfiable', headers)
+
+        headers.append(('Content-Length', str(last - first + 1)))
+        headers.append(('Content-Range', 'bytes %d-%d/%d' % (first, last, size)))
+        start_response('206 Partial Content', headers)
+        return FileRange(file_like, first, last - first + 1, self.bufsize)
 
 class GitHTTPBackendBase(BaseWSGIClass):
     git_folder_signature = set(['config', 'head', 'info', 'objects', 'refs'])
     repo_auto_create = True
+    # class used to run git and stream its output.
+    # subprocessio.PollingSubprocessIO does so without helper threads
+    subprocess_chunker = subprocessio.SubprocessIOChunker
+    # git executable and the callable used to spawn it (subprocess.Popen signature).
+    # git is always started from an argv list, without a shell
+    git_path = 'git'
+    popen = None
+
+    def git_env(self, environ):
+        '''
+        Environment for git. Passes on the protocol version requested by the client.
+        Returns None if git can inherit our environment.
+        '''
+        protocol = environ.get('HTTP_GIT_PROTOCOL')
+        if not protocol:
+            return None
+        env = dict(os.environ)
+        env['GIT_PROTOCOL'] = protocol
+        return env
 
     def has_access(self, **kw):
         '''
@@ -354,6 +757,42 @@ class GitHTTPBackendBase(BaseWSGIClass):
         '''
         return True
 
+    def is_repository(self, repo_path):
+        '''
+        Checks if repo_path looks like a git repository.
+        '''
+        try:
+            files = os.listdir(repo_path)
+        except:
+            files = []
+        return self.git_folder_signature.issubset([i.lower() for i in files])
+
+    def create_repository(self, repo_path):
+        '''
+        Creates a bare repository at repo_path for repo_auto_create.
+        Returns the name of the canned error response if that is not possible.
+        '''
+        # 1. traverse entire post-prefix path and check that each segment
+        #    If it is ( a git folder OR a non-dir object ) forbid autocreate
+        # 2. Create folderS
+        # 3. Activate a bare git repo
+        _pp = os.path.abspath(self.content_path)
+        _pf = _pp
+        _dirs = repo_path[len(_pp):].strip(os.sep).split(os.sep) or ['']
+        for _dir in _dirs:
+            _pf = os.path.join(_pf,_dir)
+            if not os.path.exists(_pf):
+                try:
+                    os.makedirs(repo_path)
+                except:
+                    return 'not_found'
+                break
+            elif not os.path.isdir(_pf) or self.is_repository(_pf):
+                return 'forbidden'
+        if subprocess.call([self.git_path, 'init', '--quiet', '--bare', repo_path.encode('utf8')]):
+            return 'execution_failed'
+        return None
+
     def basic_checks(self, dataObj, environ, start_response):
         '''
         This function is shared by GitInfoRefs and SmartHTTPRPCHandler WSGI classes.
@@ -364,6 +803,9 @@ class GitHTTPBackendBase(BaseWSGIClass):
         this object, as created by calling class, will have the free-form updated data.
 
         Returns non-None object if an error was triggered (and already prepared in start_response).
+
+        If the routing args contain repository_path, it is used as is. The path is
+        neither checked to be below content_path nor to be a git repository.
         '''
         selector_matches = (environ.get('wsgiorg.routing_args') or ([],{}))[1]
 
@@ -374,20 +816,21 @@ class GitHTTPBackendBase(BaseWSGIClass):
 
         # TODO: Add "public" to "dynamic local" path conversion hook ups here.
 
-        #############################################################
-        # making sure local path is a valid git repo folder
-        #
-        repo_path = os.path.abspath(
-            os.path.join(
-                self.content_path,
-                (selector_matches.get('working_path') or '').decode('utf8').strip('/').strip('\\')
+        trusted_path = selector_matches.get('repository_path')
+        if trusted_path:
+            # resolved and validated by whoever routed the request to us
+            repo_path = trusted_path if isinstance(trusted_path, unicode) else trusted_path.decode('utf8')
+        else:
+            repo_path = os.path.abspath(
+                os.path.join(
+                    self.content_path,
+                    (selector_matches.get('working_path') or '').decode('utf8').strip('/').strip('\\')
+                    )
                 )
-            )
-        _pp = os.path.abspath(self.content_path)
 
-        # this saves us from "hackers" putting relative paths after repo marker.
-        if not repo_path.startswith(_pp):
-            return self.canned_handlers(environ, start_response, 'forbidden')
+            # this saves us from "hackers" putting relative paths after repo marker.
+            if not repo_path.startswith(os.path.abspath(self.content_path)):
+                return self.canned_handlers(environ, start_response, 'forbidden')
 
         if not self.has_access(
             environ = environ,
@@ -396,34 +839,12 @@ class GitHTTPBackendBase(BaseWSGIClass):
             ):
             return self.canned_handlers(environ, start_response, 'forbidden')
 
-        try:
-            files = os.listdir(repo_path)
-        except:
-            files = []
-        if not self.git_folder_signature.issubset([i.lower() for i in files]):
+        if not trusted_path and not self.is_repository(repo_path):
             if not ( self.repo_auto_create and git_command == 'git-receive-pack' ):
                 return self.canned_handlers(environ, start_response, 'not_found')
-            else:
-                # 1. traverse entire post-prefix path and check that each segment
-                #    If it is ( a git folder OR a non-dir object ) forbid autocreate
-                # 2. Create folderS
-                # 3. Activate a bare git repo
-                _pf = _pp
-                _dirs = repo_path[len(_pp):].strip(os.sep).split(os.sep) or ['']
-                for _dir in _dirs:
-                    _pf = os.path.join(_pf,_dir)
-                    if not os.path.exists(_pf):
-                        try:
-                            os.makedirs(repo_path)
-                        except:
-                            return self.canned_handlers(environ, start_response, 'not_found')
-                        break
-                    elif not os.path.isdir(_pf) or self.git_folder_signature.issubset([i.lower() for i in os.listdir(_pf)]):
-                        return self.canned_handlers(environ, start_response, 'forbidden')
-                if subprocess.call('git init --quiet --bare "%s"' % repo_path, shell=True):
-                    return self.canned_handlers(environ, start_response, 'execution_failed')
-        #
-        #############################################################
+            error = self.create_repository(repo_path)
+            if error:
+                return self.canned_handlers(environ, start_response, error)
 
         dataObj['git_command'] = git_command
         dataObj['repo_path'] = repo_path
@@ -443,11 +864,21 @@ class GitHTTPBackendInfoRefs(GitHTTPBackendBase):
         '''
         inputs:
             content_path (Mandatory) - Local file system path = root of served files.
-            bufsize (Default = 65536) Chunk size for WSGI file feeding
+            bufsize (Default = 65536) Chunk size for WSGI file feeding and git I/O
+            buffer_size (Default = 1048576) Max amount of git output read ahead of the client
             gzip_response (Default = False) Compress response body
+            gzip_min_size (Default = 1024) Advertisements smaller than this are sent uncompressed
+            gzip_level (Default = 6) zlib compression level
+            advertisement_cache (Default = None) Object caching advertisements by ref state.
+                See cydraplugins.githttp.advertisement.AdvertisementCache
+            subprocess_chunker (Default = subprocessio.SubprocessIOChunker) Class running git
+            git_path (Default = 'git') git executable
+            popen (Default = subprocess.Popen) Callable spawning git, e.g. cydra.process.ProcessLauncher.popen
         '''
         self.__dict__.update(kw)
 
+    advertisement_cache = None
+
     def __call__(self, environ, start_response):
         """WSGI Response producer for HTTP GET Git Smart HTTP /info/refs request."""
 
@@ -466,11 +897,31 @@ class GitHTTPBackendInfoRefs(GitHTTPBackendBase):
         # It reads binary, per number of bytes specified.
         # if you do add '\n' as part of data, count it.
         smart_server_advert = '# service=%s' % git_command
+        headers = [('Content-type','application/x-%s-advertisement' % str(git_command))]
+
+        env = self.git_env(environ)
+        protocol = env and env['GIT_PROTOCOL']
+        if protocol and 'version=2' in protocol:
+            # protocol v2 responses start with the capability advertisement
+            starting_values = []
+        else:
+            starting_values = [ str(hex(len(smart_server_advert)+4)[2:].rjust(4,'0') + smart_server_advert + '0000') ]
+
+        cache = self.advertisement_cache
+        if cache is not None:
+            fingerprint = cache.fingerprint(repo_path)
+            cached = cache.get(repo_path, (git_command, protocol), fingerprint)
+            if cached is not None:
+                return self.package_response([cached], environ, start_response, headers, compressible = True)
 
         try:
-            out = subprocessio.SubprocessIOChunker(
-                r'git %s --stateless-rpc --advertise-refs "%s"' % (git_command[4:], repo_path),
-                starting_values = [ str(hex(len(smart_server_advert)+4)[2:].rjust(4,'0') + smart_server_advert + '0000') ]
+            out = self.subprocess_chunker(
+                [self.git_path, git_command[4:], '--stateless-rpc', '--advertise-refs', repo_path.encode('utf8')],
+                starting_values = starting_values,
+                buffer_size = self.buffer_size,
+                chunk_size = self.bufsize,
+                env = env,
+                popen = self.popen
                 )
         except (EnvironmentError) as e:
             environ['wsgi.errors'].write(str(e))
@@ -479,12 +930,15 @@ class GitHTTPBackendInfoRefs(GitHTTPBackendBase):
 #            environ['wsgi.errors'].write(str(e))
 #            return self.canned_handlers(environ, start_response, 'internal_server_error')
 
-        headers = [('Content-type','application/x-%s-advertisement' % str(git_command))]
+        if cache is not None:
+            out = cache.tee(out, repo_path, (git_command, protocol), fingerprint)
+
         return self.package_response(
             out,
             environ,
             start_response,
-            headers)
+            headers,
+            compressible = True)
 
 class GitHTTPBackendSmartHTTP(GitHTTPBackendBase):
     '''
@@ -504,11 +958,22 @@ class GitHTTPBackendSmartHTTP(GitHTTPBackendBase):
             Local file system path = root of served files.
         optional parameters may be passed as named arguments
             These include
-                bufsize (Default = 65536) Chunk size for WSGI file feeding
-                gzip_response (Default = False) Compress response body
+                bufsize (Default = 65536) Chunk size for WSGI file feeding and git I/O
+                buffer_size (Default = 1048576) Max amount of git output read ahead of the client
+                gzip_response (Default = False) Ignored, pack data is not compressed further
+                update_server_info (Default = True) Run git update-server-info after pushes,
+                    once the response is sent. Disable if a post-receive hook takes care of it
+                pack_cache (Default = None) Object caching upload-pack responses.
+                    See cydraplugins.githttp.packcache.PackCache
+                subprocess_chunker (Default = subprocessio.SubprocessIOChunker) Class running git
+                git_path (Default = 'git') git executable
+                popen (Default = subprocess.Popen) Callable spawning git, e.g. cydra.process.ProcessLauncher.popen
         '''
         self.__dict__.update(kw)
 
+    update_server_info = True
+    pack_cache = None
+
     def __call__(self, environ, start_response):
         """
         WSGI Response producer for HTTP POST Git Smart HTTP requests.
@@ -587,37 +1052,55 @@ class GitHTTPBackendSmartHTTP(GitHTTPBackendBase):
                 #  safely supported for Content-Length-less request reading.
                 return self.canned_handlers(environ, start_response, 'not_implemented')
 
+        cache = self.pack_cache if git_command == u'git-upload-pack' else None
+
         _i = environ.get('wsgi.input')
-        if wsgi_input_has_EOF: # this is approximately equal "if server is WSGI 1.1 and above"
+        if wsgi_input_has_EOF and (cache is None or _l is None or _l < 0 or _l > self.bufsize):
+            # this is approximately equal "if server is WSGI 1.1 and above"
             stdin = _i
         else:
             if _l > self.bufsize: # too large to be a string in memory
-                bs = self.bufsize
-                btr = _l
-                stdin = tempfile.TemporaryFile()
-                while btr >= bs:
-                    stdin.write(_i.read(bs))
-                    btr -= bs
-                stdin.write(_i.read(btr))
-                stdin.flush()
-                stdin.seek(0)
+                # streamed into git's stdin as it arrives
+                stdin = BoundedInput(_i, _l)
             else: # between zero and max memory buffer size = string or bytes
                 stdin = _i.read(_l)
 
+        headers = [('Content-type', 'application/x-%s-result' % git_command.encode('utf8'))]
+        env = self.git_env(environ)
+
+        # only requests small enough to be in memory are looked up. Those are
+        # the ones of clones and fetches with a short negotiation
+        cache_key = None
+        if cache is not None and isinstance(stdin, str):
+            fingerprint = cache.fingerprint(repo_path)
+            cache_key = cache.key(repo_path, stdin, env and env['GIT_PROTOCOL'], fingerprint)
+            if cache_key is not None:
+                cached = cache.open(cache_key)
+                if cached is not None:
+                    return self.package_response(cached, environ, start_response, headers)
+
         try:
-            out = subprocessio.SubprocessIOChunker(
-                r'git %s --stateless-rpc "%s"' % (git_command[4:], repo_path),
-                inputstream = stdin
+            out = self.subprocess_chunker(
+                [self.git_path, git_command[4:], '--stateless-rpc', repo_path.encode('utf8')],
+                inputstream = stdin,
+                buffer_size = self.buffer_size,
+                chunk_size = self.bufsize,
+                env = env,
+                popen = self.popen
                 )
         except (EnvironmentError) as e:
             environ['wsgi.errors'].write(str(e))
             return self.canned_handlers(environ, start_response, 'execution_failed')
 
-        if git_command == u'git-receive-pack':
+        if cache_key is not None:
+            out = cache.tee(out, cache_key, repo_path, fingerprint)
+
+        if git_command == u'git-receive-pack' and self.update_server_info:
             # updating refs manually after each push. Needed for pre-1.7.0.4 git clients using regular HTTP mode.
-            subprocess.call(u'git --git-dir "%s" update-server-info' % repo_path, shell=True)
+            # Runs once the push has been reported back to the client
+            out = DeferredCommandResponse(out, [self.git_path, '--git-dir', repo_path.encode('utf8'), 'update-server-info'],
+                                          self.popen)
 
-        headers = [('Content-type', 'application/x-%s-result' % git_command.encode('utf8'))]
         return self.package_response(
             out,
             environ,
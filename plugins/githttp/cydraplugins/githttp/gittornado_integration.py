@@ -17,48 +17,130 @@
 # You should have received a copy of the GNU General Public License
 # along with Cydra.  If not, see http://www.gnu.org/licenses
 import os
+import time
+import subprocess
+from multiprocessing.pool import ThreadPool
 
 import tornado.ioloop
 import tornado.httpserver
 import tornado.netutil
 import tornado.web
-import tornado.wsgi
 
 import cydra
 import cydraplugins.githttp
+from cydra.repository.git import GitRepositories
 from cydra.web.wsgihelper import HTTPBasicAuthenticator
 
+from cydraplugins.githttp.admission import AdmissionController, Waiter
+from cydraplugins.githttp.prefork import Supervisor
+from cydraplugins.githttp.threadedwsgi import ThreadedWSGIContainer
+
 from gittornado import RPCHandler, InfoRefsHandler, FileHandler
+import gittornado.iowrapper
+from gittornado.iowrapper import ProcessWrapper
 
 import logging
 logger = logging.getLogger(__name__)
 
+class LauncherSubprocess(object):
+    """Stands in for the subprocess module used by gittornado's ProcessWrapper
+
+    ProcessWrapper spawns git with subprocess.Popen and offers no way to
+    change that. Replacing the module it uses routes these spawns through
+    a :class:`cydra.process.ProcessLauncher` as well, see :func:`use_launcher`"""
+
+    PIPE = subprocess.PIPE
+    STDOUT = subprocess.STDOUT
+
+    def __init__(self, launcher):
+        self.Popen = launcher.popen
+
+def use_launcher(launcher):
+    """Make gittornado spawn processes through launcher"""
+    gittornado.iowrapper.subprocess = LauncherSubprocess(launcher)
+
 class CydraHelper(object):
+    """Glue between the gittornado handlers and cydra
+
+    Looking up the repository and authenticating the user may block (project
+    store, LDAP, ...). :meth:`lookup_async` does both on a thread pool, once per
+    request. auth and gitlookup then just read the result.
+    """
+
     def __init__(self, cyd):
         self.compmgr = self.cydra = cyd
         self.authenticator = HTTPBasicAuthenticator(self.compmgr)
 
+        http_config = cyd.config.get_component_config('cydraplugins.githttp.GitIntegration', {})
+        self.admission = AdmissionController.from_config(http_config)
+        self.lookup_threads = http_config.get('lookup_threads', 8)
+        self._pool = None
+
         self.config_dict = {
                             'auth': self.auth,
                             'gitlookup': self.gitlookup,
-                            'auth_failed': self.auth_failed
+                            'auth_failed': self.auth_failed,
+                            'helper': self
                             }
+        self.rpc_config_dict = dict(self.config_dict, admission=self.admission)
 
-    def auth(self, request):
+    @property
+    def pool(self):
+        # started on first use, threads do not survive daemonizing
+        if self._pool is None:
+            self._pool = ThreadPool(self.lookup_threads)
+        return self._pool
+
+    def lookup(self, request):
+        """Find the repository and authenticate the user
+
+        :returns: tuple of repository, user, read and write access"""
         pathlets = request.path.strip('/').split('/')
         if len(pathlets) < 2:
-            return False, False
+            return None, None, False, False
 
         # get repo
         repository = self.get_repository(request)
         if repository is None:
-            return False, False
+            return None, None, False, False
 
         # construct fake WSGI environ
         environ = dict([('HTTP_' + key.upper(), val) for key, val in request.headers.items()])
         user = self.authenticator(environ)
 
-        return repository.has_read_access(user), repository.has_write_access(user)
+        return repository, user, repository.has_read_access(user), repository.has_write_access(user)
+
+    def lookup_async(self, request, callback):
+        """Run :meth:`lookup` on the thread pool and call callback on the IOLoop once it is done
+
+        The callback gets the exception if the lookup failed"""
+        ioloop = tornado.ioloop.IOLoop.instance()
+
+        def run():
+            try:
+                return self.lookup(request)
+            except Exception as e:
+                logger.exception("Lookup for %s failed", request.path)
+                return e
+
+        def done(result):
+            if not isinstance(result, Exception):
+                request.cydra_lookup = result
+            callback(result)
+
+        # add_callback is the only IOLoop method safe to call from other threads
+        self.pool.apply_async(run, callback=lambda result: ioloop.add_callback(lambda: done(result)))
+
+    def resolve(self, request):
+        """Lookup result of the request. Looks it up synchronously if that has not been done yet"""
+        result = getattr(request, 'cydra_lookup', None)
+        if result is None:
+            result = request.cydra_lookup = self.lookup(request)
+        return result
+
+    def auth(self, request):
+        repository, user, read, write = self.resolve(request)
+        return read, write
 
     def auth_failed(self, request):
         msg = 'Authorization needed to access this repository'
@@ -66,11 +148,7 @@ class CydraHelper(object):
                         len(msg), self.compmgr.config.get('web').get('auth_realm').encode('utf-8'), msg))
 
     def gitlookup(self, request):
-        pathlets = request.path.strip('/').split('/')
-        if len(pathlets) < 2:
-            return None
-
-        repo = self.get_repository(request)
+        repo = self.resolve(request)[0]
 
         if repo is None:
             return None
@@ -107,6 +185,137 @@ class CydraHelper(object):
         else:
             return None
 
+class AdmittedRPCHandler(RPCHandler):
+    """RPC handler running upload-packs only once the admission controller lets them through"""
+
+    admission = None
+
+    waiter = None
+    timeout = None
+
+    @tornado.web.asynchronous
+    def post(self):
+        gitdir = self.get_gitdir()
+
+        rpc = self.request.path.strip('/').split('/')[-1]
+        if not self.enforce_perms(rpc):
+            return
+
+        if self.admission is None or rpc != 'git-upload-pack':
+            return self.run_rpc(gitdir, rpc, None)
+
+        user = getattr(self.request, 'cydra_lookup', (None, None))[1]
+        owner = self.request.remote_ip if user is None or user.is_guest else user.id
+        ioloop = tornado.ioloop.IOLoop.instance()
+
+        # on_admit is called by whoever releases a slot. Get back into the IOLoop
+        result = self.admission.try_acquire(gitdir, owner,
+                lambda slot: ioloop.add_callback(lambda: self.run_rpc(gitdir, rpc, slot)))
+
+        if result is None:
+            self.reject()
+        elif isinstance(result, Waiter):
+            self.waiter = result
+            self.timeout = ioloop.add_timeout(time.time() + self.admission.max_wait, self.on_queue_timeout)
+        else:
+            self.run_rpc(gitdir, rpc, result)
+
+    def run_rpc(self, gitdir, rpc, slot):
+        if self.timeout is not None:
+            tornado.ioloop.IOLoop.instance().remove_timeout(self.timeout)
+        self.waiter = self.timeout = None
+
+        finish = self.request.finish
+        if slot is not None:
+            # ProcessWrapper finishes the request directly, without going through the handler
+            def release_and_finish():
+                slot.release()
+                finish()
+            self.request.finish = release_and_finish
+
+        rpc = rpc[4:]
+        try:
+            ProcessWrapper(self.request, [self.gitcommand, rpc, '--stateless-rpc', gitdir],
+                           {'Content-Type': 'application/x-git-%s-result' % rpc})
+        except Exception:
+            # queued requests run without the stack context of the handler,
+            # nobody else would finish the request or free the slot
+            logger.exception("Unable to run %s for %s", rpc, gitdir)
+            self.request.finish = finish
+            if slot is not None:
+                slot.release()
+            self.send_error(500)
+
+    def on_queue_timeout(self):
+        self.timeout = None
+        if self.waiter is not None and self.waiter.cancel():
+            self.waiter = None
+            self.reject()
+
+    def on_connection_close(self):
+        # client gave up while waiting
+        if self.waiter is not None and self.waiter.cancel():
+            self.waiter = None
+            if self.timeout is not None:
+                tornado.ioloop.IOLoop.instance().remove_timeout(self.timeout)
+
+    def reject(self):
+        msg = 'Too many concurrent requests, try again later'
+        self.request.write('HTTP/1.1 503 Service Unavailable\r\nContent-Type: text/plain\r\nContent-Length: %d\r\nRetry-After: %d\r\n\r\n%s' % (
+                        len(msg), self.admission.retry_after, msg))
+        self.request.finish()
+
+class LookupMixin(object):
+    """Resolves repository and user on the thread pool of the helper before handling the request"""
+
+    helper = None
+
+    def lookup_then(self, method):
+        if self.helper is None:
+            return method()
+
+        def done(result):
+            if isinstance(result, Exception):
+                self.send_error(500)
+            else:
+                method()
+
+        self.helper.lookup_async(self.request, done)
+
+class CydraRPCHandler(LookupMixin, AdmittedRPCHandler):
+    @tornado.web.asynchronous
+    def post(self):
+        self.lookup_then(lambda: AdmittedRPCHandler.post(self))
+
+class CydraInfoRefsHandler(LookupMixin, InfoRefsHandler):
+    @tornado.web.asynchronous
+    def get(self):
+        self.lookup_then(lambda: InfoRefsHandler.get(self))
+
+class CydraFileHandler(LookupMixin, FileHandler):
+    @tornado.web.asynchronous
+    def get(self):
+        self.lookup_then(lambda: FileHandler.get(self))
+
+class CountingApplication(tornado.web.Application):
+    """Application keeping track of the number of requests"""
+
+    active_requests = 0
+    requests = 0
+
+    def __call__(self, request):
+        self.active_requests += 1
+        self.requests += 1
+
+        # handlers like the git ones finish the request directly
+        finish = request.finish
+        def counting_finish():
+            self.active_requests -= 1
+            finish()
+        request.finish = counting_finish
+
+        return super(CountingApplication, self).__call__(request)
+
 class ProxyHelper(object):
     def __init__(self, app, script_name=None, force_https=False):
         self.app = app
@@ -140,6 +349,14 @@ def run_server():
     parser.add_option('-l', '--logfile', action='store', dest='logfile', default=None)
     parser.add_option('-u', '--user', action='store', dest='user', default=None)
     parser.add_option('-g', '--group', action='store', dest='group', default=None)
+    parser.add_option('-w', '--workers', action='store', dest='workers', type='int', default=1,
+                      help='number of worker processes, 0 for one per CPU')
+    parser.add_option('--graceful-timeout', action='store', dest='graceful_timeout', type='int', default=60,
+                      help='seconds a stopping worker waits for running requests')
+    parser.add_option('--wsgi-threads', action='store', dest='wsgi_threads', type='int', default=10,
+                      help='threads running the WSGI application (viewer, static files) per process')
+    parser.add_option('--stats-file', action='store', dest='stats_file', default=None,
+                      help='file the aggregated worker stats are written to')
     (options, args) = parser.parse_args()
 
     # configure logging
@@ -164,27 +381,6 @@ def run_server():
     if len(args) > 0:
         port = int(args[0])
 
-    cyd = cydra.Cydra()
-    helper = CydraHelper(cyd)
-    wsgiapp = cydraplugins.githttp.create_application(cyd=cyd)
-    if options.proxy:
-        wsgiapp = ProxyHelper(wsgiapp)
-
-        if options.script_name:
-            wsgiapp.script_name = options.script_name
-
-        if options.force_https:
-            wsgiapp.force_https = True
-
-    fallbackapp = tornado.wsgi.WSGIContainer(wsgiapp)
-    app = tornado.web.Application([
-                           ('/.*/.*/git-.*', RPCHandler, helper.config_dict),
-                           ('/.*/.*/info/refs', InfoRefsHandler, helper.config_dict),
-                           ('/.*/.*/HEAD', FileHandler, helper.config_dict),
-                           ('/.*/.*/objects/.*', FileHandler, helper.config_dict),
-                           ('.*', tornado.web.FallbackHandler, {'fallback': fallbackapp})
-                           ])
-
     sockets = tornado.netutil.bind_sockets(port)
 
     # daemonize if requested
@@ -231,13 +427,73 @@ def run_server():
             pidf.write(str(os.getpid()))
             pidf.close()
 
-    #tornado.process.fork_processes(0)
+    if options.workers == 1:
+        serve(sockets, options)
+    else:
+        # workers share the listening sockets and get their own cydra each
+        Supervisor(options.workers, lambda report: serve(sockets, options, report),
+                   stats_file=options.stats_file).run()
 
+def serve(sockets, options, report=None):
+    """Serve requests on the sockets until SIGTERM
+
+    :param report: called with the stats of this process every few seconds"""
     import traceback, signal
+
+    cyd = cydra.Cydra()
+    use_launcher(cyd[GitRepositories].launcher)
+    helper = CydraHelper(cyd)
+    wsgiapp = cydraplugins.githttp.create_application(cyd=cyd)
+    if options.proxy:
+        wsgiapp = ProxyHelper(wsgiapp)
+
+        if options.script_name:
+            wsgiapp.script_name = options.script_name
+
+        if options.force_https:
+            wsgiapp.force_https = True
+
+    # the viewer runs on a thread pool to keep it from blocking git requests
+    fallbackapp = ThreadedWSGIContainer(wsgiapp, threads=options.wsgi_threads)
+    app = CountingApplication([
+                           ('/.*/.*/git-.*', CydraRPCHandler, helper.rpc_config_dict),
+                           ('/.*/.*/info/refs', CydraInfoRefsHandler, helper.config_dict),
+                           ('/.*/.*/HEAD', CydraFileHandler, helper.config_dict),
+                           ('/.*/.*/objects/.*', CydraFileHandler, helper.config_dict),
+                           ('.*', tornado.web.FallbackHandler, {'fallback': fallbackapp})
+                           ])
+
+    def get_stats():
+        stats = {'requests': app.requests,
+                 'active_requests': app.active_requests,
+                 'processes': cyd[GitRepositories].launcher.stats}
+        if helper.admission is not None:
+            stats['admission'] = helper.admission.stats
+        return stats
+
     def dump_stack(sig, frame):
         logger.debug("Dumping Stack: \n" + ''.join(traceback.format_stack(frame)))
+        logger.info("Stats: %r", get_stats())
     signal.signal(signal.SIGUSR1, dump_stack)
 
     server = tornado.httpserver.HTTPServer(app)
     server.add_sockets(sockets)
-    tornado.ioloop.IOLoop.instance().start()
+    ioloop = tornado.ioloop.IOLoop.instance()
+
+    def stop():
+        # stop accepting connections and wait for running requests
+        server.stop()
+        deadline = time.time() + options.graceful_timeout
+
+        def check():
+            if app.active_requests <= 0 or time.time() > deadline:
+                ioloop.stop()
+            else:
+                ioloop.add_timeout(time.time() + 0.5, check)
+        check()
+    signal.signal(signal.SIGTERM, lambda sig, frame: ioloop.add_callback_from_signal(stop))
+
+    if report is not None:
+        tornado.ioloop.PeriodicCallback(lambda: report(get_stats()), 5000).start()
+
+    ioloop.start()
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of Cydra.
+#
+# Cydra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cydra is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cydra.  If not, see http://www.gnu.org/licenses
+import os
+import os.path
+import time
+import zlib
+import fcntl
+import hashlib
+import tempfile
+import threading
+
+from advertisement import ref_state_fingerprint
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def parse_pkt_lines(data):
+    """Split pkt-line encoded data into a list of payloads
+
+    Flush, delimiter and response end packets are returned as None.
+    Raises ValueError on malformed input"""
+    lines = []
+    pos = 0
+    while pos < len(data):
+        length = int(data[pos:pos + 4], 16)
+        if length < 4:
+            lines.append(None)
+            pos += 4
+        else:
+            if pos + length > len(data):
+                raise ValueError("Truncated pkt-line")
+            lines.append(data[pos + 4:pos + length].rstrip('\n'))
+            pos += length
+    return lines
+
+
+# capabilities identifying the client rather than affecting the response
+_ignored_capabilities = ('agent=', 'session-id=')
+
+
+def normalize_upload_pack_request(body, protocol=None, max_size=4 * 1024 * 1024):
+    """Canonical form of an upload-pack request or None if it is not worth caching
+
+    Only requests concluding the negotiation with "done" are considered,
+    since only those are answered with a pack. Wants, haves and capabilities
+    are sorted and capabilities only describing the client are dropped.
+    Requests larger than max_size bytes once inflated are not cached.
+    """
+    if body[:2] == '\x1f\x8b':
+        # never inflate more than max_size, the body comes straight from the client
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            body = decompressor.decompress(body, max_size + 1)
+        except zlib.error:
+            return None
+        if decompressor.unconsumed_tail:
+            return None
+
+    if len(body) > max_size:
+        return None
+
+    try:
+        lines = [line for line in parse_pkt_lines(body) if line is not None]
+    except ValueError:
+        return None
+
+    if protocol and 'version=2' in protocol:
+        if 'command=fetch' not in lines:
+            return None
+        args = lines
+    else:
+        args = []
+        for line in lines:
+            if line.startswith('want '):
+                # the first want carries the capabilities
+                parts = line.split(' ')
+                line = ' '.join(parts[:2])
+                args.extend('capability ' + cap for cap in parts[2:] if cap)
+            args.append(line)
+
+    args = [arg for arg in args if not arg.split(' ')[-1].startswith(_ignored_capabilities)]
+
+    if 'done' not in args or not any(arg.startswith('want ') for arg in args):
+        return None
+
+    return '\n'.join(sorted(set(args)))
+
+
+class PackCacheWriter(object):
+    """Response iterable passing chunks through while spooling them to a file
+
+    The file is moved into the cache once the iterable is exhausted.
+    It is discarded if the response is incomplete, grows larger than the
+    max_entry_size of the cache or if on_complete returns False.
+    """
+
+    def __init__(self, iterable, cache, key, on_complete):
+        self.iterable = iterable
+        self.cache = cache
+        self.key = key
+        self.on_complete = on_complete
+        self.chunks = self._spool()
+
+    def __iter__(self):
+        return self.chunks
+
+    def _spool(self):
+        fd, tmpname = tempfile.mkstemp(dir=self.cache.path, prefix='tmp-')
+        tmp = os.fdopen(fd, 'wb')
+        size = 0
+        try:
+            for chunk in self.iterable:
+                if tmp is not None:
+                    size += len(chunk)
+                    if size > self.cache.max_entry_size:
+                        tmp.close()
+                        tmp = None
+                    else:
+                        tmp.write(chunk)
+                yield chunk
+
+            if tmp is not None:
+                tmp.close()
+                if self.on_complete():
+                    self.cache.store(self.key, tmpname, size)
+                    tmpname = None
+        finally:
+            if tmp is not None and not tmp.closed:
+                tmp.close()
+            if tmpname is not None:
+                os.remove(tmpname)
+
+    def close(self):
+        # removes the temporary file of an incomplete response
+        self.chunks.close()
+        if hasattr(self.iterable, 'close'):
+            self.iterable.close()
+
+
+class PackCache(object):
+    """On-disk cache for upload-pack responses
+
+    Responses are keyed by the normalized request and the fingerprint of
+    the ref state of the repository. Entries are evicted least recently
+    used first once the cache grows beyond max_size bytes.
+
+    The directory may be shared by several processes, like the workers of
+    the prefork server. Sizes and order of use are therefore taken from
+    the files themselves, and stores are serialized with a lock file.
+
+    :param path: directory the responses are stored in
+    :param max_size: size budget of the cache in bytes
+    :param max_entry_size: larger responses are not cached
+    """
+
+    # temporary files not written to for this long are leftovers of interrupted writes
+    stale_tmp_age = 3600
+
+    def __init__(self, path, max_size=1024 * 1024 * 1024, max_entry_size=256 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        # an entry larger than the whole budget would be evicted right away
+        self.max_entry_size = min(max_entry_size, max_size)
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.lock_path = os.path.join(path, 'lock')
+
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        # other processes might still be writing to recent temporary files
+        for name in os.listdir(path):
+            if name.startswith('tmp-'):
+                try:
+                    if time.time() - os.stat(os.path.join(path, name)).st_mtime > self.stale_tmp_age:
+                        os.remove(os.path.join(path, name))
+                except OSError:
+                    pass
+
+    fingerprint = staticmethod(ref_state_fingerprint)
+
+    def key(self, repo_path, body, protocol, fingerprint):
+        """Cache key for an upload-pack request or None if the request is not cacheable"""
+        request = normalize_upload_pack_request(body, protocol)
+        if request is None:
+            return None
+
+        return hashlib.sha1('\0'.join([repo_path, repr(fingerprint), protocol or '', request])).hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + '.pack')
+
+    def _scan(self):
+        """(mtime, size, key) of all entries in the cache directory"""
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.pack'):
+                try:
+                    st = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    # evicted by another process
+                    continue
+                entries.append((st.st_mtime, st.st_size, name[:-5]))
+        return entries
+
+    def open(self, key):
+        """Returns an open file with the cached response or None"""
+        try:
+            f = open(self._filename(key), 'rb')
+        except IOError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        # the mtime is the time of last use
+        try:
+            os.utime(self._filename(key), None)
+        except OSError:
+            pass
+        return f
+
+    def tee(self, response, key, repo_path, fingerprint):
+        """Wrap the response iterable to store it once it is complete"""
+        # refs might have changed while the pack was generated
+        return PackCacheWriter(response, self, key, lambda: self.fingerprint(repo_path) == fingerprint)
+
+    def store(self, key, tmpname, size):
+        # the lock is released when the file is closed. Every store opens it
+        # anew, since forked processes would share an inherited one
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+
+            os.rename(tmpname, self._filename(key))
+            logger.debug("Cached upload-pack response %s (%d bytes)", key, size)
+
+            entries = sorted(self._scan())
+            total = sum(entry_size for mtime, entry_size, entry_key in entries)
+            for mtime, entry_size, evict_key in entries:
+                if total <= self.max_size:
+                    break
+                # clients still reading an evicted file keep their handle
+                try:
+                    os.remove(self._filename(evict_key))
+                except OSError:
+                    pass
+                total -= entry_size
+
+    @property
+    def stats(self):
+        """Hits and misses of this process, number of entries and size in bytes
+
+        Entries and size are those of the whole directory, which the workers
+        of the prefork server share. They are reported with _max so they are
+        not summed up."""
+        entries = self._scan()
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'entries_max': len(entries),
+                    'size_max': sum(entry_size for mtime, entry_size, entry_key in entries)}
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of Cydra.
+#
+# Cydra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cydra is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cydra.  If not, see http://www.gnu.org/licenses
+import os
+import time
+import json
+import errno
+import fcntl
+import random
+import select
+import signal
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def aggregate_stats(stats):
+    """Merge the stats dicts of several workers
+
+    Values are summed up, except for keys ending in _max (maximum) and
+    _avg (mean over the workers reporting it). Nested dicts are merged
+    recursively, each across all workers having them."""
+    result = {}
+    nested = {}
+    averaged = {}
+    for worker_stats in stats:
+        for key, value in worker_stats.items():
+            if isinstance(value, dict):
+                nested.setdefault(key, []).append(value)
+            elif key.endswith('_max'):
+                result[key] = max(result.get(key, value), value)
+            elif key.endswith('_avg'):
+                averaged.setdefault(key, []).append(value)
+            else:
+                result[key] = result.get(key, 0) + value
+
+    for key, values in nested.items():
+        result[key] = aggregate_stats(values)
+    for key, values in averaged.items():
+        result[key] = sum(values) / float(len(values))
+    return result
+
+
+class Worker(object):
+    """A forked worker process as seen by the supervisor"""
+
+    def __init__(self, pid, slot, generation, stats_fd):
+        self.pid = pid
+        self.slot = slot
+        self.generation = generation
+        self.stats_fd = stats_fd
+        self.stats_buffer = ''
+        self.stats = {}
+        self.started = time.time()
+
+
+class Supervisor(object):
+    """Pre-forking process supervisor
+
+    Forks num_workers processes, each running worker_main(report). Workers
+    that die are replaced. SIGHUP starts a new set of workers and asks the
+    old ones to finish gracefully with SIGTERM. SIGTERM and SIGINT shut
+    everything down.
+
+    Workers pass their stats to report, which sends them to the supervisor.
+    The aggregated stats of all workers are logged on SIGUSR1 and written to
+    stats_file if given.
+
+    :param num_workers: number of workers, 0 for one per CPU
+    :param worker_main: callable run in every worker. The worker exits once it returns
+    :param stats_file: file the aggregated stats are written to as JSON
+    """
+
+    restart_delay = 1.0
+    max_restart_delay = 30.0
+
+    def __init__(self, num_workers, worker_main, stats_file=None):
+        if not num_workers:
+            import multiprocessing
+            num_workers = multiprocessing.cpu_count()
+
+        self.num_workers = num_workers
+        self.worker_main = worker_main
+        self.stats_file = stats_file
+
+        self.workers = {}
+        self.generation = 0
+        self.restart_delays = {}
+        self.pending = []
+
+        self.reload_requested = False
+        self.stats_requested = False
+        self.stopping = False
+
+    def run(self):
+        """Run the supervisor until it is told to stop. Returns in the parent only"""
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGUSR1, self._on_stats)
+
+        for slot in range(self.num_workers):
+            self.spawn(slot)
+
+        while self.workers or self.pending:
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+
+            if self.stats_requested:
+                self.stats_requested = False
+                logger.info("Aggregated worker stats: %r", self.stats)
+
+            self.reap()
+            self.spawn_pending()
+            self.read_stats(1.0)
+
+        logger.info("All workers stopped")
+
+    def spawn(self, slot):
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(rfd)
+            self._run_worker(wfd)
+
+        os.close(wfd)
+        fcntl.fcntl(rfd, fcntl.F_SETFL, fcntl.fcntl(rfd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.workers[pid] = Worker(pid, slot, self.generation, rfd)
+        logger.info("Started worker %d (pid %d)", slot, pid)
+
+    def _run_worker(self, wfd):
+        # the supervisor's handlers are not ours. Ctrl-C reaches the whole
+        # process group, the supervisor takes care of stopping us
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for worker in self.workers.values():
+            os.close(worker.stats_fd)
+        random.seed()
+
+        def report(stats):
+            try:
+                os.write(wfd, json.dumps(stats) + '\n')
+            except OSError:
+                pass
+
+        code = 0
+        try:
+            self.worker_main(report)
+        except:
+            logger.exception("Worker failed")
+            code = 1
+        finally:
+            os._exit(code)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            os.close(worker.stats_fd)
+
+            if self.stopping or worker.generation != self.generation:
+                logger.info("Worker %d (pid %d) exited", worker.slot, pid)
+                continue
+
+            logger.error("Worker %d (pid %d) died with status %d, restarting", worker.slot, pid, status)
+
+            # back off if the worker keeps crashing right away
+            delay = self.restart_delays.get(worker.slot, 0)
+            if time.time() - worker.started < self.max_restart_delay:
+                delay = min(max(delay * 2, self.restart_delay), self.max_restart_delay)
+            else:
+                delay = 0
+            self.restart_delays[worker.slot] = delay
+            self.pending.append((time.time() + delay, worker.slot))
+
+    def spawn_pending(self):
+        now = time.time()
+        for due, slot in list(self.pending):
+            if due <= now and not self.stopping:
+                self.pending.remove((due, slot))
+                self.spawn(slot)
+
+    def reload(self):
+        """Replace all workers by new ones"""
+        logger.info("Reloading workers")
+        old = [pid for pid, worker in self.workers.items() if worker.generation == self.generation]
+        self.generation += 1
+        self.pending = []
+        for slot in range(self.num_workers):
+            self.spawn(slot)
+        self.signal_workers(signal.SIGTERM, old)
+
+    def signal_workers(self, sig, pids=None):
+        for pid in (self.workers.keys() if pids is None else pids):
+            try:
+                os.kill(pid, sig)
+            except OSError:
+                pass
+
+    def read_stats(self, timeout):
+        fds = dict((worker.stats_fd, worker) for worker in self.workers.values())
+        try:
+            readable = select.select(fds.keys(), [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        for fd in readable:
+            worker = fds[fd]
+            try:
+                data = os.read(fd, 65536)
+            except OSError:
+                continue
+            lines = (worker.stats_buffer + data).split('\n')
+            worker.stats_buffer = lines.pop()
+            if lines:
+                try:
+                    worker.stats = json.loads(lines[-1])
+                except ValueError:
+                    logger.warning("Invalid stats from worker %d", worker.slot)
+
+        if readable and self.stats_file:
+            self.write_stats()
+
+    @property
+    def stats(self):
+        """Aggregated stats of all running workers"""
+        result = aggregate_stats([worker.stats for worker in self.workers.values()])
+        result['workers'] = len(self.workers)
+        return result
+
+    def write_stats(self):
+        tmpname = self.stats_file + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(self.stats, f)
+        os.rename(tmpname, self.stats_file)
+
+    def _on_reload(self, sig, frame):
+        self.reload_requested = True
+
+    def _on_stats(self, sig, frame):
+        self.stats_requested = True
+
+    def _on_stop(self, sig, frame):
+        if not self.stopping:
+            logger.info("Stopping workers")
+            self.stopping = True
+            self.pending = []
+            self.signal_workers(signal.SIGTERM)
@@ -28,6 +28,110 @@ import threading
 import subprocess
 import os
 import zlib
+import errno
+import fcntl
+import select
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+class InputDecoder(object):
+    """
+    Iterates over the contents of a string-like, file-like or file descriptor
+    in chunks, transparently inflating gzip'ed input.
+
+    Inflating is streamed: every chunk is at most chunk_size bytes and more
+    compressed input is only read once the previous input is used up. Memory
+    use therefore does not depend on the size or compression ratio of the body.
+
+    File-likes supporting readinto() are read into a single reusable buffer
+    without allocating a string per chunk. A chunk is therefore only valid
+    until the next one is requested.
+
+    bytes_read, bytes_decoded and elapsed keep track of the throughput.
+    """
+    def __init__(self, source, chunk_size=65536):
+        self.chunk_size = chunk_size
+        if type(source) in (type(''), bytes, bytearray):
+            self._read = iter([bytes(source), b'']).next
+        elif type(source) in (int, long):
+            self._read = lambda: os.read(source, chunk_size)
+        elif hasattr(source, 'readinto'):
+            buf = bytearray(chunk_size)
+            def read():
+                n = source.readinto(buf)
+                return buffer(buf, 0, n) if n else b''
+            self._read = read
+        elif hasattr(source, 'read'):
+            self._read = lambda: source.read(chunk_size)
+        else:
+            raise TypeError("Input source must be a readable file-like, a file descriptor, or a string-like.")
+
+        self.bytes_read = 0
+        self.bytes_decoded = 0
+        self.started = None
+        self.finished = None
+        self._chunks = self._decode()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self._chunks.next()
+
+    def _read_counted(self):
+        b = self._read()
+        self.bytes_read += len(b)
+        return b
+
+    def _decode(self):
+        self.started = time.time()
+        cs = self.chunk_size
+
+        b = self._read_counted()
+        if b[0:2] == '\x1f\x8b':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            while b:
+                data = decompressor.decompress(b, cs)
+                while data:
+                    self.bytes_decoded += len(data)
+                    yield data
+                    data = decompressor.decompress(decompressor.unconsumed_tail, cs)
+                b = self._read_counted()
+
+            data = decompressor.flush()
+            if data:
+                self.bytes_decoded += len(data)
+                yield data
+        else:
+            while b:
+                self.bytes_decoded += len(b)
+                yield b
+                b = self._read_counted()
+
+        self.finished = time.time()
+        logger.debug("Read %d bytes of input (%d bytes raw) in %.3fs, %.1f KB/s",
+                     self.bytes_decoded, self.bytes_read, self.elapsed, self.throughput / 1024)
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def throughput(self):
+        """Decoded bytes per second"""
+        elapsed = self.elapsed
+        return self.bytes_decoded / elapsed if elapsed else 0.0
+
+def write_all(fd, data):
+    """os.write() all of data, continuing partial writes without copying"""
+    offset = 0
+    length = len(data)
+    while offset < length:
+        offset += os.write(fd, buffer(data, offset))
 
 class StreamFeeder(threading.Thread):
     """
@@ -36,54 +140,26 @@ class StreamFeeder(threading.Thread):
     without blocking the main thread.
     We close inpipe once the end of the source stream is reached.
     """
-    def __init__(self, source):
+    def __init__(self, source, chunk_size=65536):
         super(StreamFeeder, self).__init__()
         self.daemon = True
-        filelike = False
-        self.bytes = b''
-        if type(source) in (type(''), bytes, bytearray): # string-like
-            self.bytes = bytes(source)
-        else: # can be either file pointer or file-like
-            if type(source) in (int, long): # file pointer it is
-                ## converting file descriptor (int) stdin into file-like
-                try:
-                    source = os.fdopen(source, 'rb', 16384)
-                except:
-                    pass
-            # let's see if source is file-like by now
-            try:
-                filelike = source.read
-            except:
-                pass
-        if not filelike and not self.bytes:
+        try:
+            self.source = InputDecoder(source, chunk_size)
+        except TypeError:
             raise TypeError("StreamFeeder's source object must be a readable file-like, a file descriptor, or a string-like.")
-        self.source = source
         self.readiface, self.writeiface = os.pipe()
 
     def run(self):
         t = self.writeiface
-        if self.bytes:
-            # transparently decompress
-            if self.bytes[0:2] == '\x1f\x8b':
-                self.bytes = zlib.decompress(self.bytes, 16 + zlib.MAX_WBITS)
-
-            os.write(t, self.bytes)
-        else:
-            s = self.source
-            b = s.read(4096)
-
-            decompressor = None
-            if b[0:2] == '\x1f\x8b':
-                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
-                b = decompressor.decompress(b)
-
-            while b:
-                os.write(t, b)
-                b = s.read(4096)
-
-                if decompressor:
-                    b = decompressor.decompress(b)
-        os.close(t)
+        try:
+            for chunk in self.source:
+                write_all(t, chunk)
+        except OSError as e:
+            # EPIPE: the subprocess is not interested in more input
+            if e.errno != errno.EPIPE:
+                raise
+        finally:
+            os.close(t)
 
     @property
     def output(self):
@@ -188,7 +264,7 @@ class BufferedGenerator():
             self.worker.data_added.wait(0.2)
         if len(self.data):
             self.worker.keep_reading.set()
-            return bytes(self.data.popleft())
+            return self.data.popleft()
         elif self.worker.EOF.is_set():
             raise StopIteration
 
@@ -327,7 +403,7 @@ class SubprocessIOChunker():
 
 
     '''
-    def __init__(self, cmd, inputstream=None, buffer_size=65536, chunk_size=4096, starting_values=[]):
+    def __init__(self, cmd, inputstream=None, buffer_size=65536, chunk_size=4096, starting_values=[], env=None, popen=None):
         '''
         Initializes SubprocessIOChunker
 
@@ -336,21 +412,32 @@ class SubprocessIOChunker():
         @param buffer_size (Default: 65536) A size of total buffer per stream in bytes.
         @param chunk_size (Default: 4096) A max size of a chunk. Actual chunk may be smaller.
         @param starting_values (Default: []) An array of strings to put in front of output que.
+        @param env (Default: None) Environment of the subprocess. None inherits ours.
+        @param popen (Default: subprocess.Popen) Callable with the signature of subprocess.Popen
         '''
 
+        input_streamer = None
         if inputstream:
-            input_streamer = StreamFeeder(inputstream)
+            input_streamer = StreamFeeder(inputstream, chunk_size)
             input_streamer.start()
             inputstream = input_streamer.output
 
-        _p = subprocess.Popen(cmd,
+        # close_fds keeps the child from inheriting the feeder's write end,
+        # which would prevent it from ever seeing EOF on stdin
+        _p = (popen or subprocess.Popen)(cmd,
             bufsize= -1,
-            shell=True,
+            shell=isinstance(cmd, basestring),
+            env=env,
             stdin=inputstream,
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
+            stderr=subprocess.PIPE,
+            close_fds=True
             )
 
+        if input_streamer is not None:
+            # the child has its own copy now
+            os.close(inputstream)
+
         bg_out = BufferedGenerator(_p.stdout, buffer_size, chunk_size, starting_values)
         bg_err = BufferedGenerator(_p.stderr, 16000, 1, bottomless=True)
 
@@ -406,3 +493,214 @@ class SubprocessIOChunker():
     def __del__(self):
         self.close()
 
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+class PollingSubprocessIO(object):
+    '''
+    Single threaded drop-in replacement for SubprocessIOChunker.
+
+    All three pipes of the subprocess are non-blocking and multiplexed with
+    poll() from within the thread iterating over the response. No helper
+    threads are started.
+
+    Output is only read from the subprocess when the consumer asks for the next
+    chunk and less than buffer_size bytes are buffered. A slow client therefore
+    stalls the subprocess through its stdout pipe instead of growing a buffer.
+    Input is only read from the source when the subprocess is ready to
+    accept it.
+
+    Errors are detected the same way as with SubprocessIOChunker: the
+    initializer runs the subprocess until its output fills the buffer, ends, or
+    something shows up on stderr and raises EnvironmentError on failure.
+    '''
+    stderr_size = 16000
+    kill_grace = 1.0
+
+    def __init__(self, cmd, inputstream=None, buffer_size=65536, chunk_size=65536, starting_values=[], env=None, popen=None):
+        '''
+        Initializes PollingSubprocessIO
+
+        @param cmd A Subprocess.Popen style "cmd". Can be string or array of strings
+        @param inputstream (Default: None) A file-like, string, or file pointer.
+        @param buffer_size (Default: 65536) Max amount of output read ahead of the consumer.
+        @param chunk_size (Default: 65536) A max size of a chunk. Actual chunk may be smaller.
+        @param starting_values (Default: []) An array of strings to put in front of output que.
+        @param env (Default: None) Environment of the subprocess. None inherits ours.
+        @param popen (Default: subprocess.Popen) Callable with the signature of subprocess.Popen
+        '''
+        self.chunk_size = chunk_size
+        self.buffer_size = buffer_size
+        self.output = deque(starting_values)
+        self.buffered = 0
+        self.error = deque(maxlen=self.stderr_size)
+
+        self.process = (popen or subprocess.Popen)(cmd,
+            shell=isinstance(cmd, basestring),
+            env=env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            close_fds=True
+            )
+
+        self.stdin = self.process.stdin.fileno()
+        self.stdout = self.process.stdout.fileno()
+        self.stderr = self.process.stderr.fileno()
+        for fd in (self.stdin, self.stdout, self.stderr):
+            _set_nonblocking(fd)
+
+        self.poller = select.poll()
+        self.poller.register(self.stdout, select.POLLIN)
+        self.poller.register(self.stderr, select.POLLIN)
+
+        self.pending_input = b''
+        self.pending_offset = 0
+        self.input = None
+        if inputstream:
+            self.input = InputDecoder(inputstream, chunk_size)
+            self.poller.register(self.stdin, select.POLLOUT)
+        else:
+            self._close_stdin()
+
+        try:
+            while self.stdout is not None and self.buffered < buffer_size and not self.error:
+                self._pump()
+        except:
+            self.close()
+            raise
+
+        returncode = self.process.poll()
+        if returncode or (returncode is None and self.error):
+            self.close()
+            raise EnvironmentError("Subprocess exited due to an error.\n" + "".join(self.error))
+
+    def _close_stdin(self):
+        if self.stdin is not None:
+            try:
+                self.poller.unregister(self.stdin)
+            except KeyError:
+                pass
+            self.process.stdin.close()
+            self.stdin = None
+            self.input = None
+
+    def _feed_stdin(self):
+        if self.pending_offset >= len(self.pending_input):
+            try:
+                self.pending_input = self.input.next()
+                self.pending_offset = 0
+            except StopIteration:
+                self._close_stdin()
+                return
+
+        try:
+            # partial writes are continued from an offset without copying the rest
+            written = os.write(self.stdin, buffer(self.pending_input, self.pending_offset))
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return
+            elif e.errno == errno.EPIPE:
+                # the subprocess is not interested in more input
+                self._close_stdin()
+                return
+            raise
+        self.pending_offset += written
+
+    def _read_stdout(self):
+        data = os.read(self.stdout, self.chunk_size)
+        if data:
+            self.output.append(data)
+            self.buffered += len(data)
+        else:
+            self.poller.unregister(self.stdout)
+            self.stdout = None
+
+    def _read_stderr(self):
+        data = os.read(self.stderr, self.stderr_size)
+        if data:
+            self.error.extend(data)
+        else:
+            self.poller.unregister(self.stderr)
+            self.stderr = None
+
+    def _pump(self):
+        """Wait for the next event on any of the pipes and process it"""
+        if self.stdout is not None:
+            # only read output if the consumer keeps up
+            if self.buffered < self.buffer_size:
+                self.poller.modify(self.stdout, select.POLLIN)
+            else:
+                self.poller.modify(self.stdout, 0)
+
+        try:
+            events = self.poller.poll()
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        for fd, event in events:
+            if fd == self.stdin:
+                if event & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
+                    self._close_stdin()
+                else:
+                    self._feed_stdin()
+            elif fd == self.stdout:
+                self._read_stdout()
+            elif fd == self.stderr:
+                self._read_stderr()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while not self.output:
+            if self.stdout is None:
+                self._close_stdin()
+                # a subprocess blocked on a full stderr pipe would never exit
+                while self.stderr is not None:
+                    self._pump()
+                if self.process.wait():
+                    raise EnvironmentError("Subprocess exited due to an error:\n" + ''.join(self.error))
+                raise StopIteration
+            self._pump()
+
+        data = self.output.popleft()
+        self.buffered -= len(data)
+        return data
+
+    def throw(self, type, value=None, traceback=None):
+        if self.output or self.stdout is not None:
+            raise type(value)
+
+    def close(self):
+        for f in (self.process.stdin, self.process.stdout, self.process.stderr):
+            try:
+                f.close()
+            except (IOError, OSError):
+                pass
+        self.stdin = self.stdout = self.stderr = None
+        if self.process.poll() is None:
+            self._reap()
+
+    def _reap(self):
+        """Terminate the subprocess and wait for it, killing it if it does not exit in time"""
+        try:
+            self.process.terminate()
+        except OSError:
+            pass
+        deadline = time.time() + self.kill_grace
+        while self.process.poll() is None:
+            if time.time() >= deadline:
+                try:
+                    self.process.kill()
+                except OSError:
+                    pass
+                self.process.wait()
+                break
+            time.sleep(0.01)
+
+    def __del__(self):
+        self.close()
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of Cydra.
+#
+# Cydra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cydra is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cydra.  If not, see http://www.gnu.org/licenses
+import threading
+from multiprocessing.pool import ThreadPool
+
+import tornado
+import tornado.ioloop
+import tornado.wsgi
+from tornado.escape import utf8
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class StreamedResponse(object):
+    """Response of a WSGI application running in a pool thread
+
+    Chunks are handed to the IOLoop as the application produces them.
+    The application thread blocks while more than buffer_size bytes have
+    not been written to the client yet.
+
+    Responses without Content-Length are sent with chunked transfer
+    encoding, or buffered completely for HTTP/1.0 clients.
+    """
+
+    def __init__(self, request, ioloop, buffer_size, log):
+        self.request = request
+        self.ioloop = ioloop
+        self.buffer_size = buffer_size
+        self.log = log
+
+        self.status = None
+        self.headers = None
+        self.headers_sent = False
+        self.chunked = False
+        self.buffered = None
+        self.send_body = request.method != 'HEAD'
+
+        self.cond = threading.Condition()
+        self.pending = 0
+        self.closed = False
+
+        # only touched on the IOLoop
+        self.unflushed = 0
+
+    def start_response(self, status, headers, exc_info=None):
+        if exc_info is not None and self.headers_sent:
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        self.status = status
+        self.headers = list(headers)
+        return self.write
+
+    def run(self, application, environ):
+        """Run the application. Called in a pool thread"""
+        try:
+            app_response = application(environ, self.start_response)
+            try:
+                for chunk in app_response:
+                    if self.closed:
+                        break
+                    self.write(chunk)
+            finally:
+                if hasattr(app_response, 'close'):
+                    app_response.close()
+
+            if self.status is None:
+                raise Exception("WSGI app did not call start_response")
+            if not self.headers_sent:
+                self.write('')
+        except Exception:
+            logger.exception("Error running WSGI application for %s", self.request.uri)
+            if self.headers_sent:
+                # nothing sensible to tell the client, cut it off
+                self.ioloop.add_callback(self.request.connection.stream.close)
+            else:
+                self.status, self.headers, self.buffered = '500 Internal Server Error', [], []
+                self.write('')
+
+        self.ioloop.add_callback(self._finish)
+
+    def write(self, data):
+        """Queue data for the client, sending the headers first"""
+        data = utf8(data)
+        if not self.headers_sent:
+            self.headers_sent = True
+            self._prepare_headers()
+            if self.buffered is None:
+                self._send(self._format_headers())
+
+        if not data or not self.send_body:
+            return
+
+        if self.buffered is not None:
+            self.buffered.append(data)
+        elif self.chunked:
+            self._send('%x\r\n%s\r\n' % (len(data), data))
+        else:
+            self._send(data)
+
+    def _prepare_headers(self):
+        status_code = int(self.status.split()[0])
+        header_set = set(k.lower() for (k, v) in self.headers)
+
+        if status_code != 304 and 'content-type' not in header_set:
+            self.headers.append(('Content-Type', 'text/html; charset=UTF-8'))
+        if 'server' not in header_set:
+            self.headers.append(('Server', 'TornadoServer/%s' % tornado.version))
+
+        if self.buffered is None and status_code != 304 and 'content-length' not in header_set:
+            if self.request.supports_http_1_1():
+                self.chunked = True
+                self.headers.append(('Transfer-Encoding', 'chunked'))
+            else:
+                # HTTP/1.0 clients need the length up front
+                self.buffered = []
+
+    def _format_headers(self):
+        parts = [utf8('HTTP/1.1 ' + self.status + '\r\n')]
+        for key, value in self.headers:
+            parts.append(utf8(key) + ': ' + utf8(value) + '\r\n')
+        parts.append('\r\n')
+        return ''.join(parts)
+
+    def _send(self, data):
+        with self.cond:
+            while self.pending > self.buffer_size and not self.closed:
+                self.cond.wait()
+            if self.closed:
+                return
+            self.pending += len(data)
+        self.ioloop.add_callback(lambda: self._write(data))
+
+    def _write(self, data):
+        if self.closed or self.request.connection.stream.closed():
+            self.on_close()
+            return
+        self.unflushed += len(data)
+        self.request.write(data, self._flushed)
+
+    def _flushed(self):
+        # the stream only keeps the last callback, so everything
+        # written up to now has been sent
+        flushed, self.unflushed = self.unflushed, 0
+        with self.cond:
+            self.pending -= flushed
+            self.cond.notify()
+
+    def on_close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    def _finish(self):
+        if not self.closed and not self.request.connection.stream.closed():
+            if self.buffered is not None:
+                body = ''.join(self.buffered)
+                self.headers.append(('Content-Length', str(len(body))))
+                self.request.write(self._format_headers() + (body if self.send_body else ''))
+            elif self.chunked and self.send_body:
+                self.request.write('0\r\n\r\n')
+
+        # also if the client is gone, finishing keeps track of active requests
+        self.request.finish()
+        self.log(int(self.status.split()[0]), self.request)
+
+
+class ThreadedWSGIContainer(tornado.wsgi.WSGIContainer):
+    """Runs a WSGI application on a thread pool
+
+    Unlike :class:`tornado.wsgi.WSGIContainer`, a slow application does not
+    block the IOLoop and responses are streamed instead of collected.
+
+    :param threads: number of threads running the application
+    :param buffer_size: max number of bytes produced ahead of the client
+    """
+
+    def __init__(self, wsgi_application, threads=10, buffer_size=1048576):
+        super(ThreadedWSGIContainer, self).__init__(wsgi_application)
+        self.threads = threads
+        self.buffer_size = buffer_size
+        self._pool = None
+
+    @property
+    def pool(self):
+        # started on first use, threads do not survive forking
+        if self._pool is None:
+            self._pool = ThreadPool(self.threads)
+        return self._pool
+
+    def __call__(self, request):
+        ioloop = tornado.ioloop.IOLoop.instance()
+        response = StreamedResponse(request, ioloop, self.buffer_size, self._log)
+        request.connection.set_close_callback(response.on_close)
+        self.pool.apply_async(response.run, (self.wsgi_application, self.environ(request)))
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of Cydra.
+#
+# Cydra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cydra is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cydra.  If not, see http://www.gnu.org/licenses
+import base64
+import unittest
+
+from cydra.test.fixtures import FullWithFileDS
+from cydra.test import getConfiguredTestCase
+from cydra.web.wsgihelper import AuthTokenSigner, HTTPBasicAuthenticator
+
+
+class TestAuthTokenSigner(unittest.TestCase):
+
+    def test_roundtrip(self):
+        signer = AuthTokenSigner('secret')
+        self.assertEqual(signer.verify(signer.create('test.user')), 'test.user')
+
+    def test_rejects_tampered_and_foreign(self):
+        signer = AuthTokenSigner('secret')
+        token = signer.create('test')
+        self.assertIsNone(signer.verify(token[:-1] + ('0' if token[-1] != '0' else '1')))
+        self.assertIsNone(AuthTokenSigner('other').verify(token))
+        self.assertIsNone(signer.verify('garbage'))
+
+    def test_salt(self):
+        signer = AuthTokenSigner('secret')
+        token = signer.create('test', 'salt')
+        self.assertEqual(signer.userid(token), 'test')
+        self.assertEqual(signer.verify(token, 'salt'), 'test')
+        self.assertIsNone(signer.verify(token, 'other'))
+        self.assertIsNone(signer.verify(token))
+
+    def test_rejects_expired(self):
+        signer = AuthTokenSigner('secret', lifetime=-1)
+        self.assertIsNone(signer.verify(signer.create('test')))
+
+
+def parameterized(name, fixture):
+    class TestTokenAuthentication(getConfiguredTestCase(fixture,
+            config={'web': {'auth_token_secret': 'secret'}},
+            create_users=[{'username': 'test', 'full_name': 'Tester Testesterus'}])):
+        """Tests for token based authentication"""
+
+        def setUp(self):
+            super(TestTokenAuthentication, self).setUp()
+            self.user_test.set_password('secret')
+            self.authenticator = HTTPBasicAuthenticator(self.cydra)
+
+        def login(self):
+            environ = {'HTTP_AUTHORIZATION': 'Basic ' + base64.b64encode('test:secret')}
+            self.assertEqual(self.authenticator(environ).userid, self.user_test.userid)
+            return environ
+
+        def test_token_issued_as_cookie(self):
+            environ = self.login()
+            self.assertIn('cydra.auth_token', environ)
+
+            headers = []
+            start_response = self.authenticator.wrap_start_response(environ, lambda s, h: headers.extend(h))
+            start_response('200 OK', [])
+            self.assertTrue(headers[0][1].startswith('cydra_auth=' + environ['cydra.auth_token']))
+
+        def test_cookie_and_bearer_accepted(self):
+            token = self.login()['cydra.auth_token']
+
+            user = self.authenticator({'HTTP_COOKIE': 'foo=bar; cydra_auth=' + token})
+            self.assertEqual(user.userid, self.user_test.userid)
+
+            user = self.authenticator({'HTTP_AUTHORIZATION': 'Bearer ' + token})
+            self.assertEqual(user.userid, self.user_test.userid)
+
+        def test_token_only_issued_when_needed(self):
+            token = self.login()['cydra.auth_token']
+
+            # cached login with a fresh cookie does not get a new one
+            environ = {'HTTP_AUTHORIZATION': 'Basic ' + base64.b64encode('test:secret'),
+                       'HTTP_COOKIE': 'cydra_auth=' + token}
+            self.authenticator(environ)
+            self.assertNotIn('cydra.auth_token', environ)
+
+            # but one about to expire is renewed
+            short = AuthTokenSigner('secret', lifetime=60).create(self.user_test.userid, self.user_test.auth_token_salt)
+            environ = {'HTTP_AUTHORIZATION': 'Basic ' + base64.b64encode('test:secret'),
+                       'HTTP_COOKIE': 'cydra_auth=' + short}
+            self.authenticator(environ)
+            self.assertIn('cydra.auth_token', environ)
+
+        def test_basic_auth_wins_over_token(self):
+            token = self.login()['cydra.auth_token']
+
+            environ = {'HTTP_AUTHORIZATION': 'Basic ' + base64.b64encode('test:wrong'),
+                       'HTTP_COOKIE': 'cydra_auth=' + token}
+            self.assertTrue(self.authenticator(environ).is_guest)
+
+        def test_token_of_unknown_user_rejected(self):
+            token = AuthTokenSigner('secret').create('deleted')
+            self.assertTrue(self.authenticator({'HTTP_COOKIE': 'cydra_auth=' + token}).is_guest)
+
+        def test_password_change_revokes_tokens(self):
+            token = self.login()['cydra.auth_token']
+            self.user_test.set_password('changed')
+
+            self.assertTrue(self.authenticator({'HTTP_COOKIE': 'cydra_auth=' + token}).is_guest)
+
+        def test_invalid_token_is_guest(self):
+            user = self.authenticator({'HTTP_COOKIE': 'cydra_auth=invalid'})
+            self.assertTrue(user.is_guest)
+
+    TestTokenAuthentication.__name__ = name
+    return TestTokenAuthentication
+
+TestTokenAuthentication_File = parameterized("TestTokenAuthentication_File", FullWithFileDS)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of Cydra.
+#
+# Cydra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cydra is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cydra.  If not, see http://www.gnu.org/licenses
+import os
+import time
+import signal
+import tempfile
+
+from cydra.cli import sync
+from cydra.cli.sync import sync_projects, sync_project, sync_repositories, read_checkpoint
+from cydra.test.fixtures import FullWithFileDS
+from cydra.test import getConfiguredTestCase
+
+
+def parameterized(name, fixture):
+    class TestSync(getConfiguredTestCase(fixture,
+            create_users=[{'username': 'owner', 'full_name': 'Project Owner'}],
+            create_projects={'project1': 'owner', 'project2': 'owner', 'project3': 'owner'})):
+        """Tests for syncing all projects"""
+
+        def setUp(self):
+            super(TestSync, self).setUp()
+            fd, self.checkpoint = tempfile.mkstemp()
+            os.close(fd)
+            os.remove(self.checkpoint)
+
+        def tearDown(self):
+            if os.path.exists(self.checkpoint):
+                os.remove(self.checkpoint)
+            super(TestSync, self).tearDown()
+
+        def test_parallel(self):
+            seen = []
+            summary = sync_projects(self.cydra, ['project1', 'project2', 'project3'], jobs=2,
+                                    progress=lambda count, total, result: seen.append(result['project']))
+            self.assertEqual(summary['synced'], 3)
+            self.assertEqual(summary['failed'], [])
+            self.assertEqual(sorted(seen), ['project1', 'project2', 'project3'])
+
+        def test_worker_has_own_instance(self):
+            handler = signal.getsignal(signal.SIGINT)
+            try:
+                sync._init_worker(self.cydra.initial_config)
+                self.assertIsNot(sync._worker_cydra, self.cydra)
+                self.assertEqual(sync._sync_in_worker((sync_project, ('project1', 0)))['status'], 'ok')
+            finally:
+                sync._worker_cydra = None
+                signal.signal(signal.SIGINT, handler)
+
+        def test_failures_are_reported(self):
+            summary = sync_projects(self.cydra, ['project1', 'nonexistent'], jobs=2)
+            self.assertEqual(summary['synced'], 1)
+            self.assertEqual([(r['project'], r['status']) for r in summary['failed']], [('nonexistent', 'unknown')])
+
+        def test_timeout_not_swallowed(self):
+            class Project(object):
+                def sync(self):
+                    # like sync participants logging and ignoring errors
+                    try:
+                        time.sleep(5)
+                    except Exception:
+                        pass
+                    return True
+
+            class Instance(object):
+                def get_project(self, name):
+                    return Project()
+
+            self.assertEqual(sync_project(Instance(), 'project1', timeout=1)['status'], 'timeout')
+
+        def test_repositories_in_parallel(self):
+            provider = self.project_project1.get_repository_type('git')
+            for name in ['repo1', 'repo2', 'repo3']:
+                provider.create_repository(self.project_project1, name)
+
+            summary = sync_repositories(self.cydra, self.project_project1, jobs=2)
+            self.assertEqual((summary['total'], summary['synced'], summary['failed']), (3, 3, []))
+
+        def test_resume_from_checkpoint(self):
+            summary = sync_projects(self.cydra, ['project1', 'nonexistent'], checkpoint=self.checkpoint)
+            self.assertEqual(read_checkpoint(self.checkpoint), set(['project1']))
+
+            summary = sync_projects(self.cydra, ['project1', 'project2'], checkpoint=self.checkpoint)
+            self.assertEqual(summary['skipped'], 1)
+            self.assertEqual(summary['synced'], 1)
+            # everything done, the next sync starts from scratch
+            self.assertFalse(os.path.exists(self.checkpoint))
+
+    TestSync.__name__ = name
+    return TestSync
+
+TestSync_File = parameterized("TestSync_File", FullWithFileDS)
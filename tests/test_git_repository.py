@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of Cydra.
+#
+# Cydra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cydra is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cydra.  If not, see http://www.gnu.org/licenses
+import os.path
+import fcntl
+
+from cydra.test.fixtures import FullWithFileDS
+from cydra.test import getConfiguredTestCase
+
+
+def parameterized(name, fixture):
+    class TestGitRepository(getConfiguredTestCase(fixture,
+            create_users=[{'username': 'owner', 'full_name': 'Project Owner'}],
+            create_projects={'project': 'owner'})):
+        """Tests for git repositories"""
+
+        def setUp(self):
+            super(TestGitRepository, self).setUp()
+            self.repo = self.project_project.get_repository_type('git').create_repository(self.project_project, 'repo')
+
+        def create_ref(self, ref):
+            retcode, commit, _ = self.runShellCmd(
+                'GIT_AUTHOR_NAME=a GIT_AUTHOR_EMAIL=a@b GIT_COMMITTER_NAME=a GIT_COMMITTER_EMAIL=a@b '
+                'git --git-dir "%s" commit-tree -m test 4b825dc642cb6eb9a060e54bf8d69288fbee4904' % self.repo.path)
+            self.assertEqual(retcode, 0)
+            self.assertShellCmdReturnCode('git --git-dir "%s" update-ref %s %s' % (self.repo.path, ref, commit.strip()), 0)
+
+        def server_info_refs(self):
+            infofile = os.path.join(self.repo.path, 'info', 'refs')
+            if not os.path.exists(infofile):
+                return ''
+            with open(infofile) as f:
+                return f.read()
+
+        def test_update_server_info(self):
+            self.create_ref('refs/heads/master')
+            self.repo.update_server_info()
+            self.assertIn('refs/heads/master', self.server_info_refs())
+
+        def test_update_server_info_disabled_per_repository(self):
+            self.assertShellCmdReturnCode('git --git-dir "%s" config cydra.updateserverinfo false' % self.repo.path, 0)
+            self.create_ref('refs/heads/master')
+            self.repo.update_server_info()
+            self.assertNotIn('refs/heads/master', self.server_info_refs())
+
+        def test_update_server_info_coalesced(self):
+            self.create_ref('refs/heads/master')
+
+            with open(os.path.join(self.repo.path, 'cydra-update-server-info.lock'), 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                # an update is running, ours is left to it
+                self.repo.update_server_info()
+                self.assertNotIn('refs/heads/master', self.server_info_refs())
+                self.assertTrue(os.path.exists(os.path.join(self.repo.path, 'cydra-update-server-info.pending')))
+
+            self.repo.update_server_info()
+            self.assertIn('refs/heads/master', self.server_info_refs())
+            self.assertFalse(os.path.exists(os.path.join(self.repo.path, 'cydra-update-server-info.pending')))
+
+        def test_sync_leaves_unchanged_hook_alone(self):
+            hook = os.path.join(self.repo.path, 'hooks', 'post-receive')
+            inode = os.stat(hook).st_ino
+            self.repo.sync()
+            self.assertEqual(os.stat(hook).st_ino, inode)
+
+            with open(hook, 'w') as f:
+                f.write('tampered')
+            self.repo.sync()
+            with open(hook) as f:
+                self.assertIn('cydra-git-post-receive', f.read())
+            self.assertTrue(os.access(hook, os.X_OK))
+
+        def commit(self, *parents):
+            retcode, commit, _ = self.runShellCmd(
+                'GIT_AUTHOR_NAME=a GIT_AUTHOR_EMAIL=a@b GIT_COMMITTER_NAME=a GIT_COMMITTER_EMAIL=a@b '
+                'git --git-dir "%s" commit-tree %s -m test 4b825dc642cb6eb9a060e54bf8d69288fbee4904 </dev/null'
+                % (self.repo.path, ' '.join('-p ' + p for p in parents)))
+            self.assertEqual(retcode, 0)
+            return commit.strip()
+
+        def test_pushed_revisions(self):
+            null = '0' * 40
+            base = self.commit()
+            self.assertShellCmdReturnCode('git --git-dir "%s" update-ref refs/heads/master %s' % (self.repo.path, base), 0)
+
+            # master moves on, a new branch starts from the new master commit
+            first = self.commit(base)
+            second = self.commit(first)
+            for ref, commit in [('refs/heads/master', first), ('refs/heads/feature', second)]:
+                self.assertShellCmdReturnCode('git --git-dir "%s" update-ref %s %s' % (self.repo.path, ref, commit), 0)
+
+            updates = [(base, first, 'refs/heads/master'), (null, second, 'refs/heads/feature')]
+            revisions = self.repo.get_pushed_revisions(updates)
+            self.assertEqual(list(revisions), [first, second])
+            self.assertEqual(revisions.ref_updates, [('refs/heads/master', base, first), ('refs/heads/feature', null, second)])
+
+            self.assertEqual(list(self.repo.get_pushed_revisions([(second, null, 'refs/heads/gone')])), [])
+
+        def test_index_follows_create_and_delete(self):
+            provider = self.project_project.get_repository_type('git')
+            self.assertEqual([r.name for r in provider.get_repositories(self.project_project)], ['repo'])
+
+            other = provider.create_repository(self.project_project, 'other')
+            self.assertEqual(sorted(r.name for r in provider.get_repositories(self.project_project)), ['other', 'repo'])
+
+            other.delete()
+            self.assertEqual([r.name for r in provider.get_repositories(self.project_project)], ['repo'])
+            self.assertIsNone(provider.get_repository(self.project_project, 'other'))
+
+        def test_index_reconcile(self):
+            self.repo.set_params(description='before')
+            self.assertEqual(self.repo.info.description, 'before')
+
+            with open(os.path.join(self.repo.path, 'description'), 'w') as f:
+                f.write('changed on disk')
+            self.project_project.sync_repositories()
+
+            self.assertEqual(self.repo.info.description, 'changed on disk')
+
+        def test_params_follow_file_changes(self):
+            self.repo.set_params(description='first')
+            self.assertEqual(self.repo.get_param('description'), 'first')
+
+            # same size, possibly within the same mtime tick
+            with open(os.path.join(self.repo.path, 'description.new'), 'w') as f:
+                f.write('other')
+            os.rename(os.path.join(self.repo.path, 'description.new'), os.path.join(self.repo.path, 'description'))
+            self.assertEqual(self.repo.get_param('description'), 'other')
+
+        def test_params_bulk_from_index(self):
+            provider = self.project_project.get_repository_type('git')
+            self.repo.set_params(description='first')
+            self.assertEqual(provider.get_params_bulk(self.project_project), {'repo': {'description': 'first'}})
+
+            # changes on disk are picked up by the next scan
+            with open(os.path.join(self.repo.path, 'description'), 'w') as f:
+                f.write('changed on disk')
+            self.project_project.sync_repositories()
+            self.assertEqual(provider.get_params_bulk(self.project_project), {'repo': {'description': 'changed on disk'}})
+
+    TestGitRepository.__name__ = name
+    return TestGitRepository
+
+TestGitRepository_File = parameterized("TestGitRepository_File", FullWithFileDS)
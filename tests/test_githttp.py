@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of Cydra.
+#
+# Cydra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cydra is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cydra.  If not, see http://www.gnu.org/licenses
+import os
+import subprocess
+from wsgiref.util import setup_testing_defaults
+
+from cydra.test.fixtures import FullWithFileDS
+from cydra.test import getConfiguredTestCase
+from cydraplugins.githttp import GitHTTP
+
+
+def parameterized(name, fixture):
+    class TestGitHTTP(getConfiguredTestCase(fixture,
+            config={'web': {'auth_realm': 'test'}},
+            create_users=[{'username': 'owner', 'full_name': 'Project Owner'}],
+            create_projects={'public': 'owner', 'secret': 'owner'})):
+        """Tests for routing requests to the git handlers"""
+
+        def setUp(self):
+            super(TestGitHTTP, self).setUp()
+            self.repo = self.project_public.get_repository_type('git').create_repository(self.project_public, 'repo')
+            self.project_public.set_permission(self.cydra.get_guest_user(), '*', 'read', True)
+            self.hidden = self.project_secret.get_repository_type('git').create_repository(self.project_secret, 'hidden')
+            subprocess.check_call(['git', '--git-dir', self.hidden.path, 'config', 'secret.value', 'leaked'])
+            self.app = GitHTTP(self.cydra)
+
+        def request(self, path):
+            environ = {'PATH_INFO': path}
+            setup_testing_defaults(environ)
+            response = []
+
+            def start_response(status, headers, exc_info=None):
+                response.append(status)
+
+            body = ''.join(self.app(environ, start_response))
+            return response[0], body
+
+        def test_static(self):
+            status, body = self.request('/public/repo.git/HEAD')
+            self.assertEqual(status[:3], '200')
+            with open(os.path.join(self.repo.path, 'HEAD')) as f:
+                self.assertEqual(body, f.read())
+
+        def test_static_traversal(self):
+            for path in ['/public/repo.git/objects/../../../secret/hidden.git/config',
+                         '/public/repo.git/refs/../../../secret/hidden.git/config',
+                         '/public/repo.git/info/../config',
+                         '/public/repo.git/objects//../config']:
+                status, body = self.request(path)
+                self.assertNotEqual(status[:3], '200', path)
+                self.assertNotIn('leaked', body)
+
+        def test_static_confined_to_repository(self):
+            # the static handler does not leave the repository it is routed to
+            environ = {'PATH_INFO': '/'}
+            setup_testing_defaults(environ)
+            environ['wsgiorg.routing_args'] = ([], {'repository_path': self.repo.path,
+                                                    'working_path': '../../secret/hidden.git/config',
+                                                    'git_command': 'DUMMY-static-read'})
+            response = []
+            body = ''.join(self.app.static_handler(environ, lambda status, headers: response.append(status)))
+            self.assertEqual(response[0][:3], '403')
+            self.assertNotIn('leaked', body)
+
+    TestGitHTTP.__name__ = name
+    return TestGitHTTP
+
+TestGitHTTP_File = parameterized("TestGitHTTP_File", FullWithFileDS)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of Cydra.
+#
+# Cydra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cydra is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cydra.  If not, see http://www.gnu.org/licenses
+import unittest
+
+from cydraplugins.githttp.admission import AdmissionController, AdmittedResponse, Slot, Waiter
+
+
+class TestAdmissionController(unittest.TestCase):
+
+    def test_from_config(self):
+        self.assertIsNone(AdmissionController.from_config({}))
+        controller = AdmissionController.from_config({'max_upload_packs': 3, 'upload_pack_queue_size': 7})
+        self.assertEqual(controller.max_active, 3)
+        self.assertEqual(controller.max_queue, 7)
+
+    def test_global_limit(self):
+        controller = AdmissionController(max_active=1)
+        slot = controller.try_acquire('repo1', 'alice', None)
+        self.assertIsInstance(slot, Slot)
+
+        admitted = []
+        waiter = controller.try_acquire('repo2', 'bob', admitted.append)
+        self.assertIsInstance(waiter, Waiter)
+        self.assertEqual(controller.stats['queued'], 1)
+
+        slot.release()
+        self.assertEqual(len(admitted), 1)
+        self.assertEqual(admitted[0].repository, 'repo2')
+        self.assertEqual(controller.stats['active'], 1)
+
+        # releasing twice does not free another slot
+        slot.release()
+        self.assertEqual(controller.stats['active'], 1)
+
+    def test_per_repository_limit(self):
+        controller = AdmissionController(max_active_per_repository=1)
+        first = controller.try_acquire('repo1', 'alice', None)
+        self.assertIsInstance(controller.try_acquire('repo2', 'alice', None), Slot)
+
+        admitted = []
+        self.assertIsInstance(controller.try_acquire('repo1', 'bob', admitted.append), Waiter)
+        first.release()
+        self.assertEqual([slot.repository for slot in admitted], ['repo1'])
+
+    def test_waiter_for_busy_repository_does_not_block_others(self):
+        controller = AdmissionController(max_active=2, max_active_per_repository=1)
+        busy = controller.try_acquire('repo1', 'alice', None)
+        other = controller.try_acquire('repo2', 'alice', None)
+
+        admitted = []
+        controller.try_acquire('repo1', 'bob', lambda slot: admitted.append(('bob', slot.repository)))
+        controller.try_acquire('repo3', 'carol', lambda slot: admitted.append(('carol', slot.repository)))
+
+        other.release()
+        self.assertEqual(admitted, [('carol', 'repo3')])
+        busy.release()
+        self.assertEqual(admitted, [('carol', 'repo3'), ('bob', 'repo1')])
+
+    def test_users_admitted_round_robin(self):
+        controller = AdmissionController(max_active=1)
+        slot = controller.try_acquire('repo', 'alice', None)
+
+        admitted = []
+        for owner in ('alice', 'alice', 'alice', 'bob'):
+            controller.try_acquire('repo', owner, lambda slot, owner=owner: admitted.append((owner, slot)))
+
+        # every admitted request finishes and lets the next one in
+        slot.release()
+        while len(admitted) < 4:
+            admitted[-1][1].release()
+
+        self.assertEqual([owner for owner, _ in admitted], ['alice', 'bob', 'alice', 'alice'])
+
+    def test_queue_full(self):
+        controller = AdmissionController(max_active=1, max_queue=1)
+        controller.try_acquire('repo', 'alice', None)
+        self.assertIsInstance(controller.try_acquire('repo', 'bob', None), Waiter)
+        self.assertIsNone(controller.try_acquire('repo', 'carol', None))
+        self.assertEqual(controller.stats['rejected'], 1)
+
+    def test_waiter_timeout(self):
+        controller = AdmissionController(max_active=1, max_wait=0.05)
+        slot = controller.try_acquire('repo', 'alice', None)
+
+        self.assertIsNone(controller.acquire('repo', 'bob'))
+        stats = controller.stats
+        self.assertEqual(stats['timed_out'], 1)
+        self.assertEqual(stats['queued'], 0)
+
+        # a cancelled waiter is not admitted any more
+        slot.release()
+        self.assertEqual(controller.stats['active'], 0)
+
+    def test_cancel_after_admission(self):
+        controller = AdmissionController(max_active=1)
+        slot = controller.try_acquire('repo', 'alice', None)
+        waiter = controller.try_acquire('repo', 'bob', lambda slot: None)
+        slot.release()
+        self.assertFalse(waiter.cancel())
+
+    def test_response_close_releases_slot(self):
+        controller = AdmissionController(max_active=1)
+        closed = []
+
+        class Body(list):
+            def close(self):
+                closed.append(True)
+
+        response = AdmittedResponse(Body(['data']), controller.try_acquire('repo', 'alice', None))
+        self.assertEqual(list(response), ['data'])
+        self.assertEqual(controller.stats['active'], 1)
+
+        response.close()
+        self.assertEqual(closed, [True])
+        self.assertEqual(controller.stats['active'], 0)
+        self.assertIsInstance(controller.try_acquire('repo', 'bob', None), Slot)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of Cydra.
+#
+# Cydra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cydra is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cydra.  If not, see http://www.gnu.org/licenses
+import os
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+from cydraplugins.githttp.advertisement import AdvertisementCache, ref_state_fingerprint
+
+
+def git(*args, **kwargs):
+    subprocess.check_call(('git',) + args, stdout=open(os.devnull, 'w'), **kwargs)
+
+
+class TestAdvertisementCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.repo = os.path.join(self.tmpdir, 'repo.git')
+        git('init', '--bare', self.repo)
+
+        self.work = os.path.join(self.tmpdir, 'work')
+        git('init', self.work)
+        git('-c', 'user.name=Test', '-c', 'user.email=test@example.com',
+            'commit', '--allow-empty', '-m', 'first', cwd=self.work)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def push(self, ref):
+        git('push', '-q', self.repo, 'HEAD:' + ref, cwd=self.work)
+
+    def test_fingerprint_follows_refs(self):
+        self.push('refs/heads/master')
+        before = ref_state_fingerprint(self.repo)
+        self.assertEqual(before, ref_state_fingerprint(self.repo))
+
+        self.push('refs/heads/other')
+        self.assertNotEqual(before, ref_state_fingerprint(self.repo))
+
+    def test_served_while_refs_unchanged(self):
+        cache = AdvertisementCache()
+        self.push('refs/heads/master')
+
+        fingerprint = cache.fingerprint(self.repo)
+        self.assertIsNone(cache.get(self.repo, 'upload-pack', fingerprint))
+
+        response = cache.tee(iter(['ref', 'erences']), self.repo, 'upload-pack', fingerprint)
+        self.assertEqual(list(response), ['ref', 'erences'])
+        self.assertEqual(cache.get(self.repo, 'upload-pack', fingerprint), 'references')
+        self.assertIsNone(cache.get(self.repo, 'receive-pack', fingerprint))
+
+        self.push('refs/heads/other')
+        self.assertIsNone(cache.get(self.repo, 'upload-pack', cache.fingerprint(self.repo)))
+
+    def test_not_stored(self):
+        cache = AdvertisementCache(max_entry_size=5)
+        self.push('refs/heads/master')
+        fingerprint = cache.fingerprint(self.repo)
+
+        list(cache.tee(iter(['too', 'large']), self.repo, 'upload-pack', fingerprint))
+        self.assertIsNone(cache.get(self.repo, 'upload-pack', fingerprint))
+
+        # refs changed while the advertisement was generated
+        response = cache.tee(iter(['refs']), self.repo, 'upload-pack', fingerprint)
+        self.push('refs/heads/other')
+        list(response)
+        self.assertIsNone(cache.get(self.repo, 'upload-pack', fingerprint))
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of Cydra.
+#
+# Cydra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cydra is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cydra.  If not, see http://www.gnu.org/licenses
+import io
+import os
+import time
+import zlib
+import shutil
+import tempfile
+import unittest
+from wsgiref.headers import Headers
+
+from cydraplugins.githttp.git_http_backend import BaseWSGIClass, BoundedInput, GzipResponse, StaticWSGIServer, \
+    DeferredCommandResponse
+
+
+def gunzip(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+class TestBoundedInput(unittest.TestCase):
+
+    def test_read_stops_at_length(self):
+        stream = io.BytesIO('0123456789')
+        bounded = BoundedInput(stream, 4)
+        self.assertEqual(bounded.read(3), '012')
+        self.assertEqual(bounded.read(), '3')
+        self.assertEqual(bounded.read(), '')
+        # nothing beyond the body is consumed
+        self.assertEqual(stream.read(), '456789')
+
+    def test_readinto(self):
+        bounded = BoundedInput(io.BytesIO('0123456789'), 6)
+        buf = bytearray(4)
+        self.assertEqual(bounded.readinto(buf), 4)
+        self.assertEqual(buf, '0123')
+        self.assertEqual(bounded.readinto(buf), 2)
+        self.assertEqual(buf[:2], '45')
+        self.assertEqual(bounded.readinto(buf), 0)
+
+    def test_readinto_only_if_supported(self):
+        class Stream(object):
+            def read(self, size):
+                return 'x' * size
+        self.assertFalse(hasattr(BoundedInput(Stream(), 10), 'readinto'))
+
+
+class TestGzipResponse(unittest.TestCase):
+
+    def setUp(self):
+        self.app = BaseWSGIClass()
+        self.app.gzip_response = True
+        self.gzip_environ = {'HTTP_ACCEPT_ENCODING': 'deflate, gzip;q=0.5'}
+
+    def test_accepts_gzip(self):
+        self.assertTrue(self.app.accepts_gzip(self.gzip_environ))
+        self.assertTrue(self.app.accepts_gzip({'HTTP_ACCEPT_ENCODING': '*'}))
+        self.assertFalse(self.app.accepts_gzip({'HTTP_ACCEPT_ENCODING': 'gzip;q=0'}))
+        self.assertFalse(self.app.accepts_gzip({}))
+
+    def test_response_closes_iterable(self):
+        closed = []
+
+        class Body(list):
+            def close(self):
+                closed.append(True)
+
+        response = GzipResponse(['head'], Body(['body']))
+        self.assertEqual(gunzip(''.join(response)), 'headbody')
+        response.close()
+        self.assertEqual(closed, [True])
+
+    def test_compress_iterable(self):
+        headers = Headers([('Content-Length', '5000')])
+        response = self.app.compress_response(iter(['x' * 1000] * 5), self.gzip_environ, headers)
+
+        self.assertEqual(gunzip(''.join(response)), 'x' * 5000)
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertIsNone(headers['Content-Length'])
+
+    def test_small_iterable_sent_as_is(self):
+        headers = Headers([])
+        self.assertEqual(self.app.compress_response(iter(['small']), self.gzip_environ, headers), ['small'])
+        self.assertIsNone(headers['Content-Encoding'])
+
+    def test_compress_file(self):
+        f = tempfile.TemporaryFile()
+        f.write('y' * 5000)
+        headers = Headers([])
+        response = self.app.compress_response(f, self.gzip_environ, headers)
+        self.assertEqual(gunzip(''.join(response)), 'y' * 5000)
+        response.close()
+        self.assertTrue(f.closed)
+
+    def test_not_accepted_or_disabled(self):
+        headers = Headers([])
+        self.assertIsNone(self.app.compress_response(iter(['x' * 5000]), {}, headers))
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+
+        self.app.gzip_response = False
+        self.assertIsNone(self.app.compress_response(iter(['x' * 5000]), self.gzip_environ, Headers([])))
+
+
+class TestDeferredCommandResponse(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.marker = os.path.join(self.tmpdir, 'ran')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def wait_for_marker(self):
+        deadline = time.time() + 5
+        while not os.path.exists(self.marker) and time.time() < deadline:
+            time.sleep(0.01)
+        return os.path.exists(self.marker)
+
+    def test_runs_after_response(self):
+        response = DeferredCommandResponse(iter(['a', 'b']), ['touch', self.marker])
+        self.assertEqual(list(response), ['a', 'b'])
+        self.assertFalse(os.path.exists(self.marker))
+
+        response.close()
+        self.assertTrue(self.wait_for_marker())
+
+    def test_not_run_for_incomplete_response(self):
+        response = DeferredCommandResponse(iter(['a', 'b']), ['touch', self.marker])
+        iter(response).next()
+        response.close()
+        time.sleep(0.2)
+        self.assertFalse(os.path.exists(self.marker))
+
+
+class TestStaticWSGIServer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = StaticWSGIServer(content_path=self.tmpdir)
+
+        self.object_path = os.path.join(self.tmpdir, 'objects', 'ab', 'cd' * 19)
+        os.makedirs(os.path.dirname(self.object_path))
+        with open(self.object_path, 'wb') as f:
+            f.write('object')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def request(self, path, **environ):
+        environ.update({'REQUEST_METHOD': 'GET', 'PATH_INFO': path})
+        response = []
+        body = ''.join(self.app(environ, lambda status, headers: response.append((status, dict(headers)))))
+        return response[0][0][:3], response[0][1], body
+
+    def test_immutable_object_cached(self):
+        path = '/objects/ab/' + 'cd' * 19
+        status, headers, body = self.request(path)
+        self.assertEqual((status, body), ('200', 'object'))
+        self.assertIn('immutable', headers['Cache-Control'])
+
+        status, headers, body = self.request(path, HTTP_IF_NONE_MATCH=headers['ETag'])
+        self.assertEqual(status, '304')
+
+    def test_removed_object_not_served_from_cache(self):
+        path = '/objects/ab/' + 'cd' * 19
+        status, headers, body = self.request(path)
+        self.assertEqual(status, '200')
+
+        # pruned by gc or repack
+        os.remove(self.object_path)
+        self.assertEqual(self.request(path, HTTP_IF_NONE_MATCH=headers['ETag'])[0], '404')
+        self.assertEqual(self.request(path)[0], '404')
+        self.assertEqual(len(self.app.stat_cache), 0)
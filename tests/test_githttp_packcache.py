@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of Cydra.
+#
+# Cydra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cydra is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cydra.  If not, see http://www.gnu.org/licenses
+import os
+import time
+import zlib
+import shutil
+import tempfile
+import unittest
+
+from cydraplugins.githttp.packcache import PackCache, normalize_upload_pack_request
+
+
+def pkt_line(line):
+    return '%04x%s\n' % (len(line) + 5, line)
+
+
+def upload_pack_request(wants, haves=(), capabilities=(), done=True):
+    body = pkt_line(' '.join(['want', wants[0]] + list(capabilities)))
+    body += ''.join(pkt_line('want ' + want) for want in wants[1:]) + '0000'
+    body += ''.join(pkt_line('have ' + have) for have in haves)
+    if done:
+        body += pkt_line('done')
+    return body
+
+
+A = 'a' * 40
+B = 'b' * 40
+C = 'c' * 40
+
+
+class TestNormalizeUploadPackRequest(unittest.TestCase):
+
+    def test_order_and_client_capabilities_ignored(self):
+        first = upload_pack_request([A, B], [C], ['side-band-64k', 'ofs-delta', 'agent=git/2.1'])
+        second = upload_pack_request([B, A], [C], ['ofs-delta', 'side-band-64k', 'agent=git/2.30'])
+        self.assertEqual(normalize_upload_pack_request(first), normalize_upload_pack_request(second))
+
+    def test_different_requests(self):
+        first = normalize_upload_pack_request(upload_pack_request([A], [C], ['ofs-delta']))
+        self.assertNotEqual(first, normalize_upload_pack_request(upload_pack_request([A], [B], ['ofs-delta'])))
+        self.assertNotEqual(first, normalize_upload_pack_request(upload_pack_request([A], [C], ['side-band'])))
+
+    def test_not_cacheable(self):
+        self.assertIsNone(normalize_upload_pack_request(upload_pack_request([A], done=False)))
+        self.assertIsNone(normalize_upload_pack_request('garbage'))
+        self.assertIsNone(normalize_upload_pack_request(pkt_line('done')))
+
+    def test_gzip_body(self):
+        body = upload_pack_request([A])
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compressed = compressor.compress(body) + compressor.flush()
+        self.assertEqual(normalize_upload_pack_request(compressed), normalize_upload_pack_request(body))
+
+    def test_gzip_bomb(self):
+        body = upload_pack_request([A]) + pkt_line('have ' + B) * 1000000
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compressed = compressor.compress(body) + compressor.flush()
+        self.assertIsNone(normalize_upload_pack_request(compressed, max_size=1024 * 1024))
+        self.assertIsNone(normalize_upload_pack_request(body, max_size=1024 * 1024))
+
+    def test_protocol_v2(self):
+        body = pkt_line('command=fetch') + pkt_line('agent=git/2.30') + '0001' + pkt_line('want ' + A) + pkt_line('done') + '0000'
+        self.assertIsNotNone(normalize_upload_pack_request(body, 'version=2'))
+        self.assertIsNone(normalize_upload_pack_request(pkt_line('command=ls-refs') + '0000', 'version=2'))
+
+
+class TestPackCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'cache')
+        self.repo = os.path.join(self.tmpdir, 'repo.git')
+        os.makedirs(os.path.join(self.repo, 'refs', 'heads'))
+        with open(os.path.join(self.repo, 'HEAD'), 'w') as f:
+            f.write('ref: refs/heads/master\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def fill(self, cache, body, chunks):
+        fingerprint = cache.fingerprint(self.repo)
+        key = cache.key(self.repo, body, None, fingerprint)
+        response = cache.tee(iter(chunks), key, self.repo, fingerprint)
+        self.assertEqual(list(response), chunks)
+        response.close()
+        return key
+
+    def make_old(self, key, age):
+        # order of use is kept in the mtime, which is too coarse within a test
+        t = time.time() - age
+        os.utime(os.path.join(self.path, key + '.pack'), (t, t))
+
+    def test_store_and_open(self):
+        cache = PackCache(self.path)
+        key = self.fill(cache, upload_pack_request([A]), ['PACK', 'data'])
+
+        f = cache.open(key)
+        self.assertEqual(f.read(), 'PACKdata')
+        f.close()
+        self.assertEqual(cache.stats['hits'], 1)
+        self.assertEqual(cache.stats['size_max'], 8)
+
+        # entries survive a restart
+        self.assertEqual(PackCache(self.path).stats['entries_max'], 1)
+
+    def test_partial_write_aborted(self):
+        cache = PackCache(self.path)
+        fingerprint = cache.fingerprint(self.repo)
+        key = cache.key(self.repo, upload_pack_request([A]), None, fingerprint)
+
+        response = cache.tee(iter(['PACK', 'data']), key, self.repo, fingerprint)
+        self.assertEqual(iter(response).next(), 'PACK')
+        response.close()
+
+        self.assertIsNone(cache.open(key))
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_large_entry_not_stored(self):
+        cache = PackCache(self.path, max_size=100, max_entry_size=5)
+        key = self.fill(cache, upload_pack_request([A]), ['PACK', 'data'])
+        self.assertIsNone(cache.open(key))
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_lru_eviction(self):
+        cache = PackCache(self.path, max_size=20)
+        first = self.fill(cache, upload_pack_request([A]), ['x' * 8])
+        self.make_old(first, 20)
+        second = self.fill(cache, upload_pack_request([B]), ['x' * 8])
+        self.make_old(second, 10)
+
+        # using the first entry makes the second the least recently used
+        cache.open(first).close()
+        third = self.fill(cache, upload_pack_request([C]), ['x' * 8])
+
+        self.assertIsNone(cache.open(second))
+        self.assertIsNotNone(cache.open(first))
+        self.assertIsNotNone(cache.open(third))
+        self.assertEqual(cache.stats['size_max'], 16)
+
+    def test_shared_directory(self):
+        # workers of the prefork server share the directory and its budget
+        first_worker = PackCache(self.path, max_size=20)
+        second_worker = PackCache(self.path, max_size=20)
+        first = self.fill(first_worker, upload_pack_request([A]), ['x' * 8])
+        self.make_old(first, 20)
+        second = self.fill(second_worker, upload_pack_request([B]), ['x' * 8])
+        self.make_old(second, 10)
+
+        self.assertIsNotNone(second_worker.open(first))
+        third = self.fill(first_worker, upload_pack_request([C]), ['x' * 8])
+
+        self.assertIsNone(first_worker.open(second))
+        self.assertEqual(second_worker.stats['size_max'], 16)
+
+        # temporary files of writes still in progress are kept
+        open(os.path.join(self.path, 'tmp-writing'), 'w').close()
+        PackCache(self.path)
+        self.assertIn('tmp-writing', os.listdir(self.path))
+
+    def test_ref_change_invalidates(self):
+        cache = PackCache(self.path)
+        body = upload_pack_request([A])
+        key = self.fill(cache, body, ['PACK'])
+
+        with open(os.path.join(self.repo, 'refs', 'heads', 'master'), 'w') as f:
+            f.write(A + '\n')
+        self.assertNotEqual(cache.key(self.repo, body, None, cache.fingerprint(self.repo)), key)
+
+    def test_ref_change_while_generating(self):
+        cache = PackCache(self.path)
+        fingerprint = cache.fingerprint(self.repo)
+        key = cache.key(self.repo, upload_pack_request([A]), None, fingerprint)
+
+        response = iter(cache.tee(iter(['PACK', 'data']), key, self.repo, fingerprint))
+        response.next()
+        with open(os.path.join(self.repo, 'refs', 'heads', 'master'), 'w') as f:
+            f.write(A + '\n')
+        list(response)
+
+        self.assertIsNone(cache.open(key))
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of Cydra.
+#
+# Cydra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cydra is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cydra.  If not, see http://www.gnu.org/licenses
+import os
+import json
+import time
+import signal
+import shutil
+import tempfile
+import threading
+import unittest
+
+from cydraplugins.githttp.prefork import Supervisor, aggregate_stats
+
+
+class TestAggregateStats(unittest.TestCase):
+
+    def test_aggregate(self):
+        stats = aggregate_stats([
+            {'requests': 1, 'wait_max': 3, 'processes': {'spawned': 1, 'spawn_time_avg': 1.0, 'spawn_time_max': 1.0}},
+            {'requests': 2, 'wait_max': 1, 'processes': {'spawned': 2, 'spawn_time_avg': 2.0, 'spawn_time_max': 2.0}},
+            {'requests': 3, 'wait_max': 2, 'processes': {'spawned': 3, 'spawn_time_avg': 6.0, 'spawn_time_max': 6.0}},
+        ])
+        self.assertEqual(stats, {'requests': 6, 'wait_max': 3,
+                                 'processes': {'spawned': 6, 'spawn_time_avg': 3.0, 'spawn_time_max': 6.0}})
+
+    def test_partial(self):
+        stats = aggregate_stats([{'requests': 1, 'admission': {'wait_time_avg': 4.0}},
+                                 {'requests': 1},
+                                 {'requests': 1, 'admission': {'wait_time_avg': 2.0}}])
+        self.assertEqual(stats, {'requests': 3, 'admission': {'wait_time_avg': 3.0}})
+        self.assertEqual(aggregate_stats([]), {})
+
+
+def reporting_worker(report):
+    report({'requests': 1, 'processes': {'spawn_time_avg': float(os.getpid() % 2)}})
+    while True:
+        time.sleep(1)
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.handlers = dict((sig, signal.getsignal(sig))
+                             for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGUSR1))
+
+    def tearDown(self):
+        for sig, handler in self.handlers.items():
+            signal.signal(sig, handler)
+        shutil.rmtree(self.tmpdir)
+
+    def wait_for(self, supervisor, condition, timeout=10):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            supervisor.reap()
+            supervisor.spawn_pending()
+            supervisor.read_stats(0.1)
+        self.assertTrue(condition())
+
+    def test_stats_and_restart(self):
+        supervisor = Supervisor(2, reporting_worker)
+        supervisor.restart_delay = 0.1
+        try:
+            for slot in range(2):
+                supervisor.spawn(slot)
+
+            self.wait_for(supervisor, lambda: all(worker.stats for worker in supervisor.workers.values()))
+            stats = supervisor.stats
+            self.assertEqual(stats['workers'], 2)
+            self.assertEqual(stats['requests'], 2)
+
+            # a worker that dies is replaced in the same slot
+            victim = supervisor.workers.keys()[0]
+            slot = supervisor.workers[victim].slot
+            os.kill(victim, signal.SIGKILL)
+            self.wait_for(supervisor, lambda: victim not in supervisor.workers and len(supervisor.workers) == 2)
+            self.assertIn(slot, [worker.slot for worker in supervisor.workers.values()])
+        finally:
+            supervisor._on_stop(signal.SIGTERM, None)
+            self.wait_for(supervisor, lambda: not supervisor.workers)
+
+    def test_run_until_stopped(self):
+        stats_file = os.path.join(self.tmpdir, 'stats.json')
+        supervisor = Supervisor(2, reporting_worker, stats_file=stats_file)
+
+        written = []
+
+        def stop():
+            while not written or written[-1].get('requests') != 2:
+                time.sleep(0.05)
+                if os.path.exists(stats_file):
+                    written.append(json.load(open(stats_file)))
+            os.kill(os.getpid(), signal.SIGTERM)
+
+        stopper = threading.Thread(target=stop)
+        stopper.daemon = True
+        stopper.start()
+
+        supervisor.run()
+        self.assertEqual(supervisor.workers, {})
+        # workers that exit while stopping may be written out as well
+        self.assertEqual(written[-1]['workers'], 2)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of Cydra.
+#
+# Cydra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cydra is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cydra.  If not, see http://www.gnu.org/licenses
+import io
+import os
+import zlib
+import signal
+import unittest
+
+from cydraplugins.githttp.subprocessio import InputDecoder, PollingSubprocessIO
+
+
+class Timeout(Exception):
+    pass
+
+
+def gzip_compress(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class TestInputDecoder(unittest.TestCase):
+    """Tests for reading and inflating request bodies"""
+
+    def test_plain_sources(self):
+        data = os.urandom(100000)
+        self.assertEqual(''.join(InputDecoder(data, 4096)), data)
+        self.assertEqual(''.join(bytes(chunk) for chunk in InputDecoder(io.BytesIO(data), 4096)), data)
+
+        r, w = os.pipe()
+        os.write(w, data[:1000])
+        os.close(w)
+        try:
+            self.assertEqual(''.join(InputDecoder(r, 4096)), data[:1000])
+        finally:
+            os.close(r)
+
+    def test_gzip_inflated_in_bounded_chunks(self):
+        data = 'a' * 10000000
+        decoder = InputDecoder(io.BytesIO(gzip_compress(data)), 65536)
+
+        size = 0
+        for chunk in decoder:
+            self.assertTrue(len(chunk) <= 65536)
+            size += len(chunk)
+
+        self.assertEqual(size, len(data))
+        self.assertEqual(decoder.bytes_decoded, len(data))
+        self.assertTrue(decoder.bytes_read < 100000)
+
+    def test_rejects_unknown_source(self):
+        self.assertRaises(TypeError, InputDecoder, object())
+
+
+class TestPollingSubprocessIO(unittest.TestCase):
+    """Tests for the poll() based subprocess engine"""
+
+    def setUp(self):
+        # a deadlock must fail the test instead of hanging the suite
+        def on_alarm(signum, frame):
+            raise Timeout()
+        self.previous_handler = signal.signal(signal.SIGALRM, on_alarm)
+        signal.alarm(10)
+
+    def tearDown(self):
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, self.previous_handler)
+
+    def test_large_stdout(self):
+        out = PollingSubprocessIO(['sh', '-c', 'head -c 1000000 /dev/zero'], buffer_size=4096, chunk_size=1024)
+        chunks = list(out)
+        self.assertEqual(sum(len(chunk) for chunk in chunks), 1000000)
+        self.assertTrue(all(len(chunk) <= 1024 for chunk in chunks))
+
+    def test_input_is_fed(self):
+        data = 'x' * 500000
+        out = PollingSubprocessIO(['cat'], inputstream=data)
+        self.assertEqual(''.join(out), data)
+
+    def test_gzip_input_is_inflated(self):
+        data = 'x' * 500000
+        out = PollingSubprocessIO(['cat'], inputstream=io.BytesIO(gzip_compress(data)))
+        self.assertEqual(''.join(out), data)
+
+    def test_large_stderr_after_stdout_closed(self):
+        # more than a pipe buffer on stderr once stdout is gone
+        out = PollingSubprocessIO(['sh', '-c', 'echo out; exec >&-; sleep 0.2; head -c 200000 /dev/zero >&2'])
+        self.assertEqual(list(out), ['out\n'])
+        self.assertEqual(out.process.returncode, 0)
+
+    def test_nonzero_exit(self):
+        self.assertRaises(EnvironmentError, PollingSubprocessIO, ['sh', '-c', 'echo failed >&2; exit 1'])
+
+    def test_nonzero_exit_after_output(self):
+        out = PollingSubprocessIO(['sh', '-c', 'head -c 200000 /dev/zero; exit 3'], buffer_size=4096)
+        self.assertRaises(EnvironmentError, list, out)
+        self.assertEqual(out.process.returncode, 3)
+
+    def test_early_close(self):
+        out = PollingSubprocessIO(['sh', '-c', 'while :; do echo data; done'], buffer_size=4096)
+        out.next()
+        out.close()
+        self.assertIsNotNone(out.process.returncode)
+        self.assertIsNone(out.stdout)
+
+    def test_early_close_kills_stubborn_process(self):
+        out = PollingSubprocessIO(['sh', '-c', 'trap "" TERM; head -c 200000 /dev/zero; while :; do sleep 0.05; done'], buffer_size=4096)
+        out.kill_grace = 0.2
+        out.next()
+        out.close()
+        self.assertEqual(out.process.returncode, -9)
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of Cydra.
+#
+# Cydra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cydra is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cydra.  If not, see http://www.gnu.org/licenses
+import time
+import socket
+import threading
+
+import tornado.web
+import tornado.ioloop
+from tornado.testing import AsyncHTTPTestCase
+
+from cydraplugins.githttp.threadedwsgi import ThreadedWSGIContainer
+from cydraplugins.githttp.gittornado_integration import CountingApplication
+
+
+class TestThreadedWSGIContainer(AsyncHTTPTestCase):
+    """Tests for running WSGI applications on a thread pool"""
+
+    def setUp(self):
+        self.released = threading.Event()
+        super(TestThreadedWSGIContainer, self).setUp()
+
+    def tearDown(self):
+        self.released.set()
+        super(TestThreadedWSGIContainer, self).tearDown()
+
+    def get_new_ioloop(self):
+        # the container hands its results to the global IOLoop
+        return tornado.ioloop.IOLoop.instance()
+
+    def application(self, environ, start_response):
+        path = environ['PATH_INFO']
+        if path == '/length':
+            start_response('200 OK', [('Content-Type', 'text/plain'), ('Content-Length', '5')])
+            return ['hello']
+        elif path == '/stream':
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return ('chunk%d' % i for i in range(100))
+        elif path == '/blocked':
+            self.released.wait(10)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return ['released']
+        elif path == '/endless':
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return self.endless()
+        elif path == '/error':
+            raise ValueError("application error")
+        elif path == '/late_error':
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return self.late_error()
+
+    def endless(self):
+        while True:
+            yield 'x' * 65536
+
+    def late_error(self):
+        yield 'partial'
+        raise ValueError("application error")
+
+    def get_app(self):
+        self.container = ThreadedWSGIContainer(self.application, threads=4, buffer_size=65536)
+        self.app = CountingApplication([('.*', tornado.web.FallbackHandler, {'fallback': self.container})])
+        return self.app
+
+    def wait_until_idle(self):
+        deadline = time.time() + 10
+
+        def check():
+            if self.app.active_requests <= 0 or time.time() > deadline:
+                self.stop()
+            else:
+                self.io_loop.add_timeout(time.time() + 0.01, check)
+
+        check()
+        self.wait()
+        self.assertEqual(self.app.active_requests, 0)
+
+    def test_content_length(self):
+        response = self.fetch('/length')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, 'hello')
+
+    def test_streamed_chunked(self):
+        response = self.fetch('/stream')
+        self.assertEqual(response.body, ''.join('chunk%d' % i for i in range(100)))
+        self.assertEqual(response.headers.get('Transfer-Encoding'), 'chunked')
+
+    def raw_request(self, request, read_all=True):
+        """Send request on a plain socket and return what the server sends back
+
+        The socket is read in a separate thread while the IOLoop runs. Unless
+        read_all is set, the connection is closed after the first read"""
+        received = []
+
+        def client():
+            sock = socket.create_connection(('127.0.0.1', self.get_http_port()))
+            sock.sendall(request)
+            while True:
+                chunk = sock.recv(65536)
+                received.append(chunk)
+                if not chunk or not read_all:
+                    break
+            sock.close()
+
+        thread = threading.Thread(target=client)
+        thread.start()
+
+        deadline = time.time() + 10
+        while thread.is_alive() and time.time() < deadline:
+            self.io_loop.add_timeout(time.time() + 0.01, self.stop)
+            self.wait()
+        self.assertFalse(thread.is_alive())
+        return ''.join(received)
+
+    def test_http10_buffered(self):
+        headers, body = self.raw_request('GET /stream HTTP/1.0\r\n\r\n').split('\r\n\r\n', 1)
+        self.assertIn('Content-Length: %d' % len(body), headers)
+        self.assertEqual(body, ''.join('chunk%d' % i for i in range(100)))
+
+    def test_slow_application_does_not_block(self):
+        blocked = []
+        self.http_client.fetch(self.get_url('/blocked'), blocked.append)
+        self.assertEqual(self.fetch('/length').body, 'hello')
+        self.assertEqual(blocked, [])
+
+        self.released.set()
+        self.wait_until_idle()
+
+    def test_application_error(self):
+        self.assertEqual(self.fetch('/error').code, 500)
+        self.wait_until_idle()
+
+        response = self.fetch('/late_error')
+        self.assertNotEqual(response.code, 200)
+        self.wait_until_idle()
+
+    def test_client_disconnect_finishes_request(self):
+        self.raw_request('GET /endless HTTP/1.1\r\nHost: localhost\r\n\r\n', read_all=False)
+        self.wait_until_idle()
+        self.assertEqual(self.app.requests, 1)
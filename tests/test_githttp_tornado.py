@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of Cydra.
+#
+# Cydra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cydra is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cydra.  If not, see http://www.gnu.org/licenses
+import time
+import unittest
+import threading
+
+import tornado.web
+import tornado.ioloop
+from tornado.httpserver import HTTPRequest
+
+from cydra.test.fixtures import FullWithFileDS
+from cydra.test import getConfiguredTestCase
+from cydraplugins.githttp.admission import AdmissionController
+from cydraplugins.githttp.gittornado_integration import CydraHelper, LookupMixin, AdmittedRPCHandler
+
+
+class FakeConnection(object):
+    """Collects what handlers write instead of sending it"""
+
+    stream = None
+    xheaders = False
+    no_keep_alive = False
+
+    def __init__(self):
+        self.written = []
+        self.finished = False
+
+    def set_close_callback(self, callback):
+        pass
+
+    def write(self, chunk, callback=None):
+        self.written.append(chunk)
+
+    def finish(self):
+        self.finished = True
+
+
+class TestAdmittedRPCHandler(unittest.TestCase):
+
+    def test_failed_spawn_releases_slot(self):
+        controller = AdmissionController(max_active=1)
+        slot = controller.try_acquire('repo', 'alice', None)
+
+        connection = FakeConnection()
+        request = HTTPRequest('POST', '/project/repo.git/git-upload-pack', remote_ip='127.0.0.1', connection=connection)
+        handler = AdmittedRPCHandler(tornado.web.Application(), request, gitcommand='/nonexistent/git')
+        # set up by the application when it executes the handler
+        handler._transforms = []
+        handler.run_rpc('/nonexistent/repo.git', 'git-upload-pack', slot)
+
+        self.assertTrue(connection.finished)
+        self.assertIn(' 500 Internal Server Error', ''.join(connection.written).split('\r\n')[0])
+        self.assertEqual(controller.stats['active'], 0)
+
+
+def parameterized(name, fixture):
+    class TestCydraHelper(getConfiguredTestCase(fixture,
+            config={'web': {'auth_realm': 'test'}},
+            create_users=[{'username': 'owner', 'full_name': 'Project Owner'}],
+            create_projects={'project': 'owner'})):
+        """Tests for looking up repositories and users off the IOLoop"""
+
+        def setUp(self):
+            super(TestCydraHelper, self).setUp()
+            self.repo = self.project_project.get_repository_type('git').create_repository(self.project_project, 'repo')
+            self.project_project.set_permission(self.cydra.get_guest_user(), '*', 'read', True)
+            self.helper = CydraHelper(self.cydra)
+            self.ioloop = tornado.ioloop.IOLoop.instance()
+
+        def run_on_ioloop(self, func):
+            """Call func with a callback and run the IOLoop until the callback is called"""
+            results = []
+
+            def callback(result=None):
+                results.append((result, threading.current_thread()))
+                self.ioloop.stop()
+
+            timeout = self.ioloop.add_timeout(time.time() + 5, self.ioloop.stop)
+            self.ioloop.add_callback(lambda: func(callback))
+            self.ioloop.start()
+            self.ioloop.remove_timeout(timeout)
+
+            self.assertEqual(len(results), 1, "callback not called")
+            return results[0]
+
+        def test_lookup_async(self):
+            request = HTTPRequest('GET', '/project/repo.git/info/refs')
+            result, thread = self.run_on_ioloop(lambda callback: self.helper.lookup_async(request, callback))
+
+            # the callback runs on the IOLoop thread again
+            self.assertIs(thread, threading.current_thread())
+            repository, user, read, write = result
+            self.assertEqual(repository.path, self.repo.path)
+            self.assertTrue(user.is_guest)
+            self.assertTrue(read)
+            self.assertFalse(write)
+
+            # auth and gitlookup use the result instead of looking up again
+            self.helper.get_repository = None
+            self.assertEqual(self.helper.auth(request), (read, write))
+            self.assertEqual(self.helper.gitlookup(request), self.repo.path)
+
+        def test_lookup_async_failure(self):
+            def fail(request):
+                raise ValueError("lookup failed")
+            self.helper.get_repository = fail
+
+            request = HTTPRequest('GET', '/project/repo.git/info/refs')
+            result, _ = self.run_on_ioloop(lambda callback: self.helper.lookup_async(request, callback))
+            self.assertIsInstance(result, ValueError)
+            self.assertFalse(hasattr(request, 'cydra_lookup'))
+
+        def test_lookup_mixin(self):
+            helper = self.helper
+
+            class Handler(LookupMixin):
+                def __init__(self):
+                    self.helper = helper
+                    self.request = HTTPRequest('GET', '/project/repo.git/info/refs')
+
+            handler = Handler()
+            self.run_on_ioloop(handler.lookup_then)
+            self.assertEqual(handler.request.cydra_lookup[0].path, self.repo.path)
+
+            # the request is answered with an error if the lookup fails
+            helper.get_repository = None
+            handler = Handler()
+
+            def lookup(callback):
+                handler.send_error = callback
+                handler.lookup_then(lambda: self.fail("method called after failed lookup"))
+
+            result, _ = self.run_on_ioloop(lookup)
+            self.assertEqual(result, 500)
+
+    TestCydraHelper.__name__ = name
+    return TestCydraHelper
+
+TestCydraHelper_File = parameterized("TestCydraHelper_File", FullWithFileDS)
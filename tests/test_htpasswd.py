@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of Cydra.
+#
+# Cydra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cydra is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cydra.  If not, see http://www.gnu.org/licenses
+import os
+from passlib.apache import HtpasswdFile
+
+from cydra.test.fixtures import FullWithFileDS
+from cydra.test import getConfiguredTestCase
+from cydra.permission.htpasswd import HtpasswdUsers
+
+
+def parameterized(name, fixture):
+    class TestHtpasswdUsers(getConfiguredTestCase(fixture,
+            create_users=[{'username': 'test', 'full_name': 'Tester Testesterus'}])):
+        """Tests for the htpasswd user store"""
+
+        def setUp(self):
+            super(TestHtpasswdUsers, self).setUp()
+            self.htpasswdusers = HtpasswdUsers(self.cydra)
+
+        def test_check_password(self):
+            self.user_test.set_password('secret')
+            self.assertTrue(self.user_test.check_password('secret'))
+            self.assertFalse(self.user_test.check_password('wrong'))
+
+        def test_credential_cache_remembers_success_only(self):
+            self.user_test.set_password('secret')
+            self.assertNotIn(('test', 'secret'), self.htpasswdusers.credential_cache)
+
+            self.assertTrue(self.user_test.check_password('secret'))
+            self.assertIn(('test', 'secret'), self.htpasswdusers.credential_cache)
+
+            self.assertFalse(self.user_test.check_password('wrong'))
+            self.assertNotIn(('test', 'wrong'), self.htpasswdusers.credential_cache)
+
+        def test_credential_cache_invalidated_by_set_password(self):
+            self.user_test.set_password('secret')
+            self.assertTrue(self.user_test.check_password('secret'))
+
+            self.user_test.set_password('other')
+            self.assertFalse(self.user_test.check_password('secret'))
+            self.assertTrue(self.user_test.check_password('other'))
+
+        def test_credential_cache_invalidated_by_file_change(self):
+            self.user_test.set_password('secret')
+            self.assertTrue(self.user_test.check_password('secret'))
+
+            # modify the file behind the component's back
+            external = HtpasswdFile(self.htpasswdusers.htpasswd.path)
+            external.set_password('test', 'changed')
+            external.save()
+            mtime = os.path.getmtime(external.path) + 2
+            os.utime(external.path, (mtime, mtime))
+
+            self.assertFalse(self.user_test.check_password('secret'))
+            self.assertTrue(self.user_test.check_password('changed'))
+
+        def test_user_lookup(self):
+            self.assertEqual(self.htpasswdusers.username_to_user('test'), self.user_test)
+            self.assertIsNone(self.htpasswdusers.username_to_user('nonexisting'))
+            self.assertRaises(ValueError, self.cydra.create_user, username='test')
+
+    TestHtpasswdUsers.__name__ = name
+    return TestHtpasswdUsers
+
+
+def parameterizedAppendOnly(name, fixture):
+    class TestHtpasswdAppendOnly(getConfiguredTestCase(fixture,
+            config={
+                'components': {
+                    'cydra.permission.htpasswd.HtpasswdUsers': {
+                        'append_only': True,
+                        'compact_after': 2
+                    }
+                }
+            })):
+        """Tests for appending users to the htpasswd file"""
+
+        def setUp(self):
+            super(TestHtpasswdAppendOnly, self).setUp()
+            self.htpasswdusers = HtpasswdUsers(self.cydra)
+
+        def _read_lines(self):
+            with open(self.htpasswdusers.htpasswd.path, 'r') as f:
+                return f.read().splitlines()
+
+        def test_append_and_compact(self):
+            self.cydra.create_user(username='first')
+            self.cydra.create_user(username='second')
+            self.assertEqual([x.split(':')[0] for x in self._read_lines()], ['first', 'second'])
+
+            # the third user triggers a compaction, the file still contains every user once
+            self.cydra.create_user(username='third')
+            self.assertEqual(sorted(x.split(':')[0] for x in self._read_lines()), ['first', 'second', 'third'])
+
+            external = HtpasswdFile(self.htpasswdusers.htpasswd.path)
+            self.assertEqual(sorted(external.users()), ['first', 'second', 'third'])
+
+        def test_appended_users_are_found(self):
+            self.cydra.create_user(username='first')
+            self.assertIsNotNone(self.htpasswdusers.username_to_user('first'))
+
+            # another instance sees the appended user as well
+            external = HtpasswdFile(self.htpasswdusers.htpasswd.path)
+            self.assertIn('first', external.users())
+
+    TestHtpasswdAppendOnly.__name__ = name
+    return TestHtpasswdAppendOnly
+
+TestHtpasswdUsers_File = parameterized("TestHtpasswdUsers_File", FullWithFileDS)
+TestHtpasswdAppendOnly_File = parameterizedAppendOnly("TestHtpasswdAppendOnly_File", FullWithFileDS)
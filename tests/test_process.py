@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of Cydra.
+#
+# Cydra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cydra is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cydra.  If not, see http://www.gnu.org/licenses
+import os
+import unittest
+from distutils.spawn import find_executable
+
+from cydra.error import CydraError
+from cydra.process import ProcessLauncher
+
+
+class TestProcessLauncher(unittest.TestCase):
+
+    def test_run(self):
+        launcher = ProcessLauncher(env={'CYDRA_TEST': 'value'})
+        returncode, stdout, _ = launcher.run(['sh', '-c', 'echo "$CYDRA_TEST"; exit 3'])
+        self.assertEqual(returncode, 3)
+        self.assertEqual(stdout, 'value\n')
+        self.assertEqual(launcher.stats['spawned'], 1)
+
+    def test_no_shell(self):
+        launcher = ProcessLauncher()
+        self.assertRaises(TypeError, launcher.popen, 'echo foo')
+        self.assertEqual(launcher.run(['echo', '$HOME; foo'])[1], '$HOME; foo\n')
+
+    def test_descriptors_not_inherited(self):
+        r, w = os.pipe()
+        try:
+            # writing to the descriptor fails in the child
+            returncode, _, _ = ProcessLauncher().run(['sh', '-c', 'echo >&%d' % w])
+            self.assertNotEqual(returncode, 0)
+        finally:
+            os.close(r)
+            os.close(w)
+
+    def test_rlimits(self):
+        launcher = ProcessLauncher(rlimits={'nofile': 64})
+        self.assertEqual(launcher.run(['sh', '-c', 'ulimit -n'])[1].strip(), '64')
+        self.assertRaises(CydraError, ProcessLauncher, rlimits={'nonexistent': 1})
+
+    def test_rlimits_without_preexec_fn(self):
+        launcher = ProcessLauncher(rlimits={'nofile': 64})
+        if find_executable('prlimit') is None:
+            self.skipTest("prlimit is not installed")
+
+        self.assertEqual(launcher.wrapper[0], find_executable('prlimit'))
+        self.assertEqual(launcher.wrapper[1:], ['--nofile=64:64', '--'])
+        self.assertEqual(ProcessLauncher().wrapper, [])
+
+    def test_failed_spawn(self):
+        launcher = ProcessLauncher()
+        self.assertRaises(OSError, launcher.run, ['/nonexistent/command'])
+        self.assertEqual(launcher.stats['failed'], 1)
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of Cydra.
+#
+# Cydra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cydra is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cydra.  If not, see http://www.gnu.org/licenses
+import time
+import json
+import threading
+
+from cydra import Cydra
+from cydra.test.fixtures import FullWithFileDS
+from cydra.test.fixtures.common import TieredSubjectCache
+from cydra.test import getConfiguredTestCase
+from cydra.caching.subject import MemorySubjectCache, SQLiteSubjectCache
+from cydra.permission import User, Group
+
+
+def parameterized(name, fixture):
+    class TestTieredSubjectCache(getConfiguredTestCase(fixture,
+            config={
+                'components': {
+                    'cydra.caching.subject.MemorySubjectCache': {'user_size': 2}
+                }
+            },
+            create_users=[{'username': 'test', 'full_name': 'Tester Testesterus'}])):
+        """Tests for the memory and SQLite subject caches"""
+
+        def setUp(self):
+            super(TestTieredSubjectCache, self).setUp()
+            self.l1 = MemorySubjectCache(self.cydra)
+            self.l2 = SQLiteSubjectCache(self.cydra)
+
+        def test_write_through(self):
+            self.assertEqual(self.l1.get_user('test'), self.user_test)
+            self.assertEqual(self.l2.get_user('test'), self.user_test)
+            self.assertEqual(self.l2.get_user_by_name('test'), self.user_test)
+
+        def test_restored_user_is_usable(self):
+            self.user_test.set_password('secret')
+
+            user = self.l2.get_user('test')
+            self.assertIs(user.compmgr, self.cydra)
+            self.assertTrue(user.check_password('secret'))
+
+        def test_shared_between_instances(self):
+            other = Cydra(self.cydra.config._data)
+            user = SQLiteSubjectCache(other).get_user('test')
+            self.assertEqual(user, self.user_test)
+            self.assertIs(user.compmgr, other)
+
+        def test_batch_reads(self):
+            users = [User(self.cydra, 'user%d' % i, username='name%d' % i) for i in range(1200)]
+            self.l2.add_users(users)
+
+            res = self.l2.get_users(['user%d' % i for i in range(1200)] + ['unknown'])
+            self.assertEqual(len(res), 1201)
+            self.assertIsNone(res['unknown'])
+            self.assertEqual(res['user1100'].username, 'name1100')
+
+        def test_groups(self):
+            group = Group(self.cydra, 'group', name='Group')
+            user = User(self.cydra, 'member', username='member', groups=[group])
+            self.l2.add_users([user])
+            self.l2.add_groups([group])
+
+            self.assertEqual(self.l2.get_group('group').name, 'Group')
+            restored = self.l2.get_user('member')
+            self.assertEqual(restored.groups, [group])
+            self.assertIs(restored.groups[0].compmgr, self.cydra)
+
+        def test_rows_are_plain_data(self):
+            self.l2.add_users([self.user_test])
+            conn = self.l2._connection()
+            data = json.loads(conn.execute('SELECT data FROM users WHERE userid = ?', ('test',)).fetchone()[0])
+            self.assertEqual(data['attributes']['username'], 'test')
+
+            # a row that does not describe a known subject type is not loaded
+            conn.execute('UPDATE users SET data = ? WHERE userid = ?',
+                         (json.dumps({'type': 'os.system', 'attributes': {}}), 'test'))
+            conn.commit()
+            self.assertIsNone(self.l2.get_user('test'))
+
+        def test_usernamemap_follows_eviction(self):
+            self.l1.add_users([User(self.cydra, 'user%d' % i, username='name%d' % i) for i in range(5)])
+            self.assertEqual(len(self.l1.usernamemap), len(self.l1.usercache.data))
+            self.assertIsNone(self.l1.get_user_by_name('name0'))
+
+        def test_concurrent_eviction(self):
+            users = [User(self.cydra, 'user%d' % i, username='name%d' % i) for i in range(20)]
+            errors = []
+
+            def writer():
+                try:
+                    for i in range(2000):
+                        self.l1.add_users([users[i % 20]])
+                except Exception as e:
+                    errors.append(e)
+
+            thread = threading.Thread(target=writer)
+            thread.start()
+            while thread.is_alive():
+                for i in range(20):
+                    self.l1.get_user_by_name('name%d' % i)
+            thread.join()
+
+            self.assertEqual(errors, [])
+            self.assertEqual(len(self.l1.usernamemap), len(self.l1.usercache.data))
+
+    TestTieredSubjectCache.__name__ = name
+    return TestTieredSubjectCache
+
+
+def parameterizedRefreshAhead(name, fixture):
+    class TestRefreshAhead(getConfiguredTestCase(fixture,
+            config={
+                'components': {
+                    'cydra.caching.subject.MemorySubjectCache': {'refresh_ahead': 0, 'refresh_rate': 100}
+                }
+            },
+            create_users=[{'username': 'test', 'full_name': 'Tester Testesterus'}])):
+        """Tests for refreshing cached subjects in the background"""
+
+        def test_stale_value_served_and_refreshed(self):
+            cache = MemorySubjectCache(self.cydra)
+            stale = User(self.cydra, 'test', username='test', full_name='Stale')
+            cache.add_users([stale])
+
+            self.assertIs(cache.get_user('test'), stale)
+
+            deadline = time.time() + 5
+            while cache.usercache.get('test') is stale and time.time() < deadline:
+                time.sleep(0.01)
+
+            self.assertEqual(cache.usercache.get('test').full_name, 'test')
+
+    TestRefreshAhead.__name__ = name
+    return TestRefreshAhead
+
+TestTieredSubjectCache_File = parameterized("TestTieredSubjectCache_File", TieredSubjectCache(FullWithFileDS))
+TestRefreshAhead_File = parameterizedRefreshAhead("TestRefreshAhead_File", FullWithFileDS)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of Cydra.
+#
+# Cydra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cydra is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cydra.  If not, see http://www.gnu.org/licenses
+import threading
+import unittest
+
+from cydra.util import SimpleCache
+
+
+class TestSimpleCache(unittest.TestCase):
+
+    def test_expiry(self):
+        removed = []
+        cache = SimpleCache(lifetime=-1, on_remove=lambda key, value: removed.append((key, value)))
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(removed, [('a', 1)])
+
+    def test_maxsize(self):
+        cache = SimpleCache(maxsize=2)
+        for i in range(5):
+            cache.set(i, i)
+        self.assertEqual(len(cache.data), 2)
+
+    def test_concurrent_access(self):
+        removed = []
+        cache = SimpleCache(maxsize=10, on_remove=lambda key, value: removed.append(key))
+        errors = []
+
+        def worker(n):
+            try:
+                for i in range(2000):
+                    cache.set((n, i), i)
+                    cache.get((n, i - 1))
+                    (n, i - 2) in cache
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertTrue(len(cache.data) <= 10)
+        # every item is either still cached or has been reported exactly once
+        self.assertEqual(len(removed), len(set(removed)))
+        self.assertEqual(len(removed) + len(cache.data), 4 * 2000)